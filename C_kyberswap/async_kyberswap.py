@@ -0,0 +1,269 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+from typing import Dict, List, Optional, Sequence
+from web3 import Web3
+from web3.providers.async_rpc import AsyncHTTPProvider
+from web3._utils.abi import map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.types import (
+    BlockIdentifier,
+    TxParams,
+    HexBytes,
+)
+from async_utils import web3_module, async_request_manager_middlewares
+from kyberswap import (
+    _Kyberswapv3Base,
+    KyberswapPositionParam,
+    KyberswapRemovePositionParam,
+    KyberswapNewLiquidityParam,
+    KyberswapRebalanceParam,
+    REBALANCE_GAS_CAP,
+)
+from batch import AsyncBatchCoalescer, AsyncRPCBatch
+from encoders import encode_multicall, encode_positions
+from fee_engine import FeeEngine
+from multicall import Multicall, output_types
+from nonce_manager import NonceManager
+from pool_state import PoolState, PoolStateCache
+from position_fees import FeeReader, PositionFees, compute_fees
+from position_index import PositionIndex
+from rpc_pool import AsyncPooledHTTPProvider
+from utils import _addr_to_str, _get_web3
+
+
+class AsyncKyberswapv3Client(_Kyberswapv3Base):
+    """
+    Kyberswapv3f3000ApiTrade 的 asyncio 版本，query_get_position/add_position/remove_position 都是协程，
+    同一个事件循环里可以并发跑多个池子、多个 position 的读和下单。
+    web3 v5 没有异步合约对象，合约只用来编码 calldata，eth_call/发交易走 AsyncEth。
+    """
+
+    def __init__(self,
+                 pub_key,
+                 secret_key: str,
+                 uniswapv3_rpc_url=None,
+                 nonce_lock_path=None,
+                 gas_model_path=None
+                 ):
+        self.provider = uniswapv3_rpc_url
+        if isinstance(uniswapv3_rpc_url, (list, tuple)) and len(uniswapv3_rpc_url) > 1:
+            provider = AsyncPooledHTTPProvider(uniswapv3_rpc_url)
+        elif isinstance(uniswapv3_rpc_url, (list, tuple)):
+            provider = AsyncHTTPProvider(uniswapv3_rpc_url[0])
+        else:
+            provider = AsyncHTTPProvider(uniswapv3_rpc_url)
+        self.w3 = Web3(
+            provider,
+            modules=web3_module,
+            middlewares=async_request_manager_middlewares,
+        )
+        # 同一个事件循环里几毫秒内的读请求合成一个 JSON-RPC batch
+        self.rpc = AsyncBatchCoalescer(self.w3)
+        # 不连网络，只给合约对象编码/解码和本地签名用
+        self.codec_w3 = _get_web3()
+        super().__init__(pub_key, secret_key, self.codec_w3)
+        # NonceManager 是同步的，第一次用之前在 _allocate_nonce 里异步同步一次；第一次分配之后起后台定时校正，
+        # 在它自己的线程里用同步 Web3 读，不占事件循环，close() 时停
+        self.nonce_manager = NonceManager(
+            _get_web3(tuple(uniswapv3_rpc_url) if isinstance(uniswapv3_rpc_url, list) else uniswapv3_rpc_url),
+            self.address, lock_path=nonce_lock_path, auto_start=True)
+        # 没有后台线程，feeHistory 过期时在组交易的时候和其他读请求合进一个 batch 刷新
+        self.fee_engine = FeeEngine(None, gas_model_path=gas_model_path)
+        self._chain_id = None
+        # 只用本地状态，网络请求在 list_positions 里异步发
+        self.position_index = PositionIndex(self.codec_w3, self.UNIS_V3_NFT_MANAGER_ADDRESS)
+        # 和同步 client 一样的池子状态和手续费输入，这里只用来组 multicall 和解码，请求走 self.rpc
+        self.multicall = Multicall(self.codec_w3)
+        self.pool_state_cache = PoolStateCache(self.codec_w3)
+        self.fee_reader = FeeReader(self.codec_w3, self.multicall, self.UNI_V3_FACTORY_ADDRESS)
+
+    def close(self):
+        """停掉 nonce 校正线程"""
+        self.nonce_manager.stop()
+
+    def batch(self) -> AsyncRPCBatch:
+        """async with client.batch() as batch: ... 显式把一组请求合成一个 batch"""
+        return AsyncRPCBatch(self.w3)
+
+    async def query_get_position(self, param: KyberswapPositionParam):
+        """
+        同 Kyberswapv3f3000ApiTrade.query_get_position：positions() 和池子状态固定在同一个区块，并发读（合成一个 batch），
+        israw=False 时再用一次 multicall 读手续费输入，结果里带上未领取的手续费
+        """
+        symbol, token_id, israw = param.symbol, param.token_id, param.israw
+        pool_address = self.markets.market(symbol).pool
+        block = await self.rpc.block_number()
+        position_info, pool_state = await asyncio.gather(
+            self._query_get_lp_position(token_id, block),
+            self._query_pool_state(pool_address, block),
+        )
+        try:
+            fees = None
+            if not israw:
+                fees = (await self._query_uncollected_fees({token_id: position_info}, [pool_address], block))[token_id]
+            return self._format_position(symbol, position_info, pool_state, fees)
+        except Exception as e:
+            print(e)
+            print(position_info)
+            return position_info
+
+    async def _query_get_lp_position(self, token_id, block: BlockIdentifier = 'latest'):
+        call_result = await self.rpc.call({
+            'to': self.v3_nft_manager.address,
+            'data': encode_positions(token_id),
+        }, block)
+        types = output_types(self.v3_nft_manager, "positions")
+        return map_abi_data(BASE_RETURN_NORMALIZERS, types, self.w3.codec.decode_abi(types, call_result))
+
+    async def _aggregate(self, calls, block: BlockIdentifier):
+        """同 Multicall.aggregate，调用不多，一次 eth_call 发完"""
+        contract = self.multicall.contract
+        data = contract.encodeABI("tryBlockAndAggregate", [False, [(Web3.toChecksumAddress(target), calldata)
+                                                                   for target, calldata in calls]])
+        call_result = await self.rpc.call({'to': contract.address, 'data': data}, block)
+        block_number, _, results = self.w3.codec.decode_abi(output_types(contract, "tryBlockAndAggregate"),
+                                                            call_result)
+        return block_number, results
+
+    async def _query_pool_state(self, pool_address, block: BlockIdentifier) -> Optional[PoolState]:
+        """池子状态读不到时返回 None，不影响 position 查询"""
+        try:
+            block_number, results = await self._aggregate(self.pool_state_cache.calls(pool_address), block)
+            pool_state = self.pool_state_cache.decode(pool_address, block_number, *results)
+            if pool_state is None:
+                raise Exception(f"getPoolState/getLiquidityState call failed for pool {pool_address} at block {block}")
+        except Exception as e:
+            print(e)
+            return None
+        self.pool_state_cache.put(pool_address, pool_state)
+        return pool_state
+
+    async def _query_uncollected_fees(self, positions: Dict[int, tuple], pool_addresses: Sequence[str],
+                                      block: BlockIdentifier) -> Dict[int, PositionFees]:
+        pool_ticks = self.fee_reader.pool_ticks(positions, pool_addresses)
+        block_number, results = await self._aggregate(self.fee_reader.calls(pool_ticks), block)
+        return compute_fees(positions, pool_addresses, self.fee_reader.decode(pool_ticks, block_number, results))
+
+    async def add_position(self, param: KyberswapNewLiquidityParam):
+        multicall_list, value, increase_result = self._add_position_calls(param)
+        tx_params = {
+            "from": _addr_to_str(self.address),
+            "value": value,
+            "nonce": await self._allocate_nonce(),
+        }
+        tx = await self._build_and_send_tx(multicall_list, tx_params)
+        increase_result['txn_hash'] = tx.hex()
+        return increase_result
+
+    async def remove_position(self, param: KyberswapRemovePositionParam):
+        token_id, reduce_percent, burn = param.token_id, param.reduce_percent, param.burn
+        position_info, nonce = await asyncio.gather(
+            self._query_get_lp_position(token_id),
+            self._allocate_nonce(),
+        )
+        multicall_list, liquidity = self._remove_position_calls(token_id, position_info, reduce_percent, burn)
+        tx_params = {
+            "from": _addr_to_str(self.address),
+            "value": 0,
+            "nonce": nonce,
+        }
+        tx = await self._build_and_send_tx(multicall_list, tx_params)
+        remove_result = {
+            'txn_hash': tx.hex(),
+            'token_id': token_id,
+            'remove_liquidity': liquidity,
+        }
+        return remove_result
+
+    async def rebalance_positions(self, params: List[KyberswapRebalanceParam], gas_cap: int = REBALANCE_GAS_CAP):
+        """同 Kyberswapv3f3000ApiTrade.rebalance_positions，positions 查询合成一个 batch，几笔交易并发发送"""
+        token_ids = [param.token_id for param in params]
+        positions_info = dict(zip(token_ids, await asyncio.gather(
+            *[self._query_get_lp_position(token_id) for token_id in token_ids])))
+
+        async def send(multicall_list, value, op_results):
+            tx_params = {
+                "from": _addr_to_str(self.address),
+                "value": value,
+                "nonce": await self._allocate_nonce(),
+            }
+            tx = await self._build_and_send_tx(multicall_list, tx_params)
+            return {'txn_hash': tx.hex(), 'positions': op_results}
+
+        txs = self._rebalance_txs(params, positions_info, self.fee_engine.gas_models.estimate, gas_cap)
+        return await asyncio.gather(*[send(*tx) for tx in txs])
+
+    async def list_positions(self, owner=None) -> List[int]:
+        """同 Kyberswapv3f3000ApiTrade.list_positions，读请求都走 self.rpc，tokenOfOwnerByIndex 合成一个 batch"""
+        owner = Web3.toChecksumAddress(owner or self.address)
+        index = self.position_index
+        nft_manager = self.v3_nft_manager
+        block = await self.rpc.block_number()
+        if owner not in index.owners():
+            balance = self.w3.codec.decode_single('uint256', await self.rpc.call({
+                'to': nft_manager.address, 'data': nft_manager.encodeABI("balanceOf", [owner])}, block))
+            results = await asyncio.gather(*[self.rpc.call({
+                'to': nft_manager.address, 'data': nft_manager.encodeABI("tokenOfOwnerByIndex", [owner, i])}, block)
+                for i in range(balance)])
+            index.set_tokens(owner, [self.w3.codec.decode_single('uint256', r) for r in results], block)
+        else:
+            owners, filters = index.log_filters(block)
+            if owners:
+                logs = await asyncio.gather(*[self.rpc.get_logs(log_filter) for log_filter in filters])
+                index.apply_logs([log for result in logs for log in result], block, owners)
+        return index.token_ids(owner)
+
+    async def _allocate_nonce(self):
+        if not self.nonce_manager.synced:
+            latest, pending = await asyncio.gather(
+                self.rpc.get_transaction_count(self.address, 'latest'),
+                self.rpc.get_transaction_count(self.address, 'pending'),
+            )
+            self.nonce_manager.update(latest, pending)
+        return self.nonce_manager.allocate()
+
+    async def _build_and_send_tx(self, multicall_list, tx_params: TxParams) -> HexBytes:
+        """Build the NFT manager multicall transaction, fill chainId/gas/fees locally and send it."""
+        transaction = dict(tx_params)
+        transaction['to'] = self.v3_nft_manager.address
+        transaction['data'] = encode_multicall(multicall_list)
+        try:
+            await asyncio.gather(self._ensure_chain_id(), self._ensure_fee_history())
+            transaction.setdefault('chainId', self._chain_id)
+            transaction = self.fee_engine.fill(transaction)
+            signed_txn = self.codec_w3.eth.account.sign_transaction(
+                transaction, private_key=self.wallet_private_key
+            )
+            tx_hash = await self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+        except Exception:
+            self.nonce_manager.release(tx_params["nonce"])
+            raise
+        self.nonce_manager.mark_sent(tx_params["nonce"])
+        self.fee_engine.track(tx_hash, transaction)
+        return tx_hash
+
+    async def _ensure_chain_id(self):
+        if self._chain_id is None:
+            self._chain_id = await self.rpc.chain_id()
+
+    async def _ensure_fee_history(self):
+        if self.fee_engine.stale:
+            await self.fee_engine.async_refresh(self.rpc)
+
+
+if __name__ == '__main__':
+    RPC_URL = 'https://mainnet.infura.io/v3/2e9062cf4c124537a722b068f2f40a0a'
+    PUB_KEY = ""
+    SECRET_KEY = ""
+
+    async def main():
+        uni_cli = AsyncKyberswapv3Client(
+            pub_key=PUB_KEY,
+            secret_key=SECRET_KEY,
+            uniswapv3_rpc_url=RPC_URL
+        )
+        result2 = await uni_cli.query_get_position(KyberswapPositionParam(token_id=75, symbol='ETH_USDT', israw=False))
+        print(result2)
+
+    asyncio.run(main())
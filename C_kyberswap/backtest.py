@@ -0,0 +1,198 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LP 区间回测：用历史 Swap 的价格路径，对一组 (区间宽度, 手续费, 调仓规则) 同时模拟手续费收入和持仓。
+
+    save_swap_path('eth_usdt_path', LogIngester(w3, ['ETH_USDT'], start_block, end_block, events=('Swap',)))
+    configs = grid([600, 1200, 2400, 4800], [500, 3000, 10000], [REBALANCE_NONE, REBALANCE_OUT_OF_RANGE])
+    results = run_grid('eth_usdt_path', configs, capital=10 ** 12)
+
+价格路径存成 .npy，worker 进程用 mmap 只读打开，多个进程共用同一份页缓存。
+每个 worker 拿一批配置，按时间逐笔 swap 推进，配置维度用 numpy 向量化。
+持仓数量用 vector_math.get_amounts_for_liquidity，即 utils.get_amounts_for_liquidity 的公式，
+价格用池子的原始价格 1.0001^tick（token1/token0 最小单位），两个 decimal 都传 0。
+
+简化：
+- 手续费按 swap 开始时的 tick 是否在区间内计，份额 = L / (swap 后池子活跃流动性 + L)，不考虑自己的流动性对价格路径的影响
+- 不同 fee tier 假设成交量不变，只按比例缩放手续费
+- 调仓时先把区间内的仓位按当前价格全部取出，偏离新区间比例的那部分按 fee 付一次 swap 手续费，手续费收入不复投
+"""
+import multiprocessing
+import os
+from typing import Iterable, List, NamedTuple
+import numpy as np
+from config import TICK_SPACING
+from vector_math import get_amounts_for_liquidity
+
+REBALANCE_NONE = 0
+# 价格出区间时以当前价格为中心重建
+REBALANCE_OUT_OF_RANGE = 1
+# 价格偏离区间中心超过 threshold * 半宽时重建
+REBALANCE_DRIFT = 2
+
+BACKTEST_CHUNK_SIZE = 256
+_PATH_FIELDS = ('block', 'tick', 'liquidity', 'amount0', 'amount1')
+
+
+class BacktestConfig(NamedTuple):
+    width: int            # 区间半宽，tick 数
+    fee: int              # 手续费，百万分之一，3000 = 0.3%
+    rebalance: int        # REBALANCE_*
+    threshold: float = 1.0
+
+
+class BacktestResult(NamedTuple):
+    config: BacktestConfig
+    value: float          # 期末仓位 + 手续费，token1 最小单位
+    fees: float           # 手续费收入，token1 最小单位
+    hodl_value: float     # 期初资金按期初比例拿着不动的期末价值
+    rebalances: int
+    in_range: float       # 在区间内的 swap 占比
+
+
+def grid(widths: Iterable[int], fees: Iterable[int], rebalances: Iterable[int],
+         thresholds: Iterable[float] = (1.0,)) -> List[BacktestConfig]:
+    return [BacktestConfig(w, f, r, t) for w in widths for f in fees for r in rebalances for t in thresholds]
+
+
+def save_swap_path(directory: str, swaps) -> int:
+    """
+    SwapLog（log_ingester）序列存成 directory/<field>.npy，返回 swap 条数。
+    liquidity/amount 超出 int64，统一存 float64
+    """
+    columns = {field: [] for field in _PATH_FIELDS}
+    for swap in swaps:
+        columns['block'].append(swap.blockNumber)
+        columns['tick'].append(swap.tick)
+        columns['liquidity'].append(float(swap.liquidity))
+        columns['amount0'].append(float(swap.amount0))
+        columns['amount1'].append(float(swap.amount1))
+    os.makedirs(directory, exist_ok=True)
+    dtypes = {'block': np.int64, 'tick': np.int32}
+    for field, values in columns.items():
+        np.save(os.path.join(directory, f"{field}.npy"), np.asarray(values, dtype=dtypes.get(field, np.float64)))
+    return len(columns['block'])
+
+
+def load_swap_path(directory: str) -> dict:
+    return {field: np.load(os.path.join(directory, f"{field}.npy"), mmap_mode='r') for field in _PATH_FIELDS}
+
+
+def _range_around(tick, width, spacing):
+    lower = (tick - width) // spacing * spacing
+    upper = lower + np.maximum((2 * width) // spacing, 1) * spacing
+    return lower, upper
+
+
+def _amounts_per_liquidity(price, lower, upper):
+    """1 单位流动性在 price 下的 (amount0, amount1)"""
+    return get_amounts_for_liquidity(price, np.power(1.0001, lower), np.power(1.0001, upper), 1.0, 0, 0)
+
+
+def simulate(path: dict, configs: List[BacktestConfig], capital: float,
+             spacing: int = TICK_SPACING['MEDIUM']) -> List[BacktestResult]:
+    """一批配置在同一条价格路径上的回测，capital 是期初资金（token1 最小单位）"""
+    ticks = np.asarray(path['tick'])
+    pool_liquidity = np.asarray(path['liquidity'])
+    amount0 = np.asarray(path['amount0'])
+    amount1 = np.asarray(path['amount1'])
+    prices = np.power(1.0001, ticks.astype(np.float64))
+
+    width = np.array([c.width for c in configs], dtype=np.int64)
+    fee_rate = np.array([c.fee for c in configs], dtype=np.float64) / 1e6
+    rule = np.array([c.rebalance for c in configs], dtype=np.int64)
+    threshold = np.array([c.threshold for c in configs], dtype=np.float64)
+
+    # 期初按第一笔 swap 开始前的价格建仓，全部资金换算成流动性
+    start_tick = np.full(len(configs), ticks[0], dtype=np.int64)
+    lower, upper = _range_around(start_tick, width, spacing)
+    per0, per1 = _amounts_per_liquidity(prices[0], lower, upper)
+    liquidity = capital / (per0 * prices[0] + per1)
+    hodl0, hodl1 = liquidity * per0, liquidity * per1
+    fees0 = np.zeros(len(configs))
+    fees1 = np.zeros(len(configs))
+    rebalances = np.zeros(len(configs), dtype=np.int64)
+    in_range_count = np.zeros(len(configs), dtype=np.int64)
+
+    prev_tick = ticks[0]
+    for i in range(1, len(ticks)):
+        # 第 i 笔 swap 从上一笔结束的价格开始
+        in_range = (lower <= prev_tick) & (prev_tick < upper)
+        in_range_count += in_range
+        share = np.where(in_range, liquidity / (pool_liquidity[i] + liquidity), 0.0)
+        if amount0[i] > 0:
+            fees0 += share * amount0[i] * fee_rate
+        else:
+            fees1 += share * amount1[i] * fee_rate
+
+        tick = ticks[i]
+        center = (lower + upper) / 2
+        rebalance = ((rule == REBALANCE_OUT_OF_RANGE) & ((tick < lower) | (tick >= upper))) | \
+                    ((rule == REBALANCE_DRIFT) & (np.abs(tick - center) > threshold * width))
+        if rebalance.any():
+            price = prices[i]
+            idx = np.nonzero(rebalance)[0]
+            old0, old1 = _amounts_per_liquidity(price, lower[idx], upper[idx])
+            value = liquidity[idx] * (old0 * price + old1)
+            new_lower, new_upper = _range_around(np.full(len(idx), tick, dtype=np.int64), width[idx], spacing)
+            new0, new1 = _amounts_per_liquidity(price, new_lower, new_upper)
+            # 新旧区间 token1 占比之差就是要换的那部分
+            old_share = old1 * liquidity[idx] / value
+            new_share = new1 / (new0 * price + new1)
+            value = value * (1 - np.abs(new_share - old_share) * fee_rate[idx])
+            liquidity[idx] = value / (new0 * price + new1)
+            lower[idx], upper[idx] = new_lower, new_upper
+            rebalances[idx] += 1
+        prev_tick = tick
+
+    end_price = prices[-1]
+    end0, end1 = _amounts_per_liquidity(end_price, lower, upper)
+    fees = fees0 * end_price + fees1
+    value = liquidity * (end0 * end_price + end1) + fees
+    hodl_value = hodl0 * end_price + hodl1
+    steps = max(len(ticks) - 1, 1)
+    return [BacktestResult(config, float(v), float(f), float(h), int(r), float(n) / steps)
+            for config, v, f, h, r, n in zip(configs, value, fees, hodl_value, rebalances, in_range_count)]
+
+
+_worker_path = None
+
+
+def _init_worker(directory: str):
+    global _worker_path
+    _worker_path = load_swap_path(directory)
+
+
+def _simulate_chunk(args):
+    configs, capital, spacing = args
+    return simulate(_worker_path, configs, capital, spacing)
+
+
+def run_grid(directory: str, configs: List[BacktestConfig], capital: float, spacing: int = TICK_SPACING['MEDIUM'],
+             processes: int = None, chunk_size: int = BACKTEST_CHUNK_SIZE) -> List[BacktestResult]:
+    """
+    配置切成 chunk_size 一批分给进程池，worker 启动时 mmap 打开 directory 下的价格路径，只读共享。
+    返回顺序和 configs 一致
+    """
+    chunks = [(configs[i:i + chunk_size], capital, spacing) for i in range(0, len(configs), chunk_size)]
+    if processes == 1 or len(chunks) <= 1:
+        _init_worker(directory)
+        return [result for chunk in chunks for result in _simulate_chunk(chunk)]
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(directory,)) as pool:
+        return [result for results in pool.imap(_simulate_chunk, chunks) for result in results]
+
+
+if __name__ == '__main__':
+    from log_ingester import LogIngester
+    from utils import _get_web3
+
+    RPC_URL = 'https://mainnet.infura.io/v3/2e9062cf4c124537a722b068f2f40a0a'
+    w3 = _get_web3(RPC_URL)
+    end_block = w3.eth.block_number
+    save_swap_path('eth_usdt_path', LogIngester(w3, ['ETH_USDT'], start_block=end_block - 50000, end_block=end_block,
+                                                 checkpoint_path=None, events=('Swap',)))
+    results = run_grid('eth_usdt_path', grid(range(60, 6001, 60), [500, 3000, 10000],
+                                             [REBALANCE_NONE, REBALANCE_OUT_OF_RANGE, REBALANCE_DRIFT],
+                                             [0.5, 1.0]), capital=10 ** 12)
+    for result in sorted(results, key=lambda r: r.value, reverse=True)[:10]:
+        print(result)
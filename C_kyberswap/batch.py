@@ -0,0 +1,285 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON-RPC batch：多个互相独立的请求拼成一个 JSON 数组发一次 HTTP，响应按 id 分回各自的 future。
+
+同步：
+    with RPCBatch(w3) as batch:
+        block = batch.block_number()
+        nonce = batch.get_transaction_count(address, 'pending')
+    block.result(), nonce.result()
+
+异步，显式 batch 或者自动合并几毫秒内的请求：
+    async with AsyncRPCBatch(w3) as batch:
+        ...
+    coalescer = AsyncBatchCoalescer(w3, window=0.002)
+    await asyncio.gather(coalescer.block_number(), coalescer.gas_price())
+
+结果和 w3.eth 对应方法一样经过 web3 的 PYTHONIC_RESULT_FORMATTERS（int、HexBytes、AttributeDict）。
+batch 直接走 provider，不经过 w3 的 middleware（eth_call 缓存等）；
+provider 不是 HTTP 的（IPC、测试用的 provider）时退化成逐个 make_request。
+"""
+import asyncio
+import itertools
+import json
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from typing import Any, List, Optional
+from eth_utils import to_bytes, to_text
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.method_formatters import PYTHONIC_RESULT_FORMATTERS
+from web3._utils.request import async_make_post_request, make_post_request
+from web3.datastructures import AttributeDict
+from web3.providers import HTTPProvider
+from web3.providers.async_rpc import AsyncHTTPProvider
+from web3.types import BlockIdentifier, TxParams
+from rpc_pool import HEDGED_METHODS, AsyncPooledHTTPProvider, PooledHTTPProvider
+
+BATCH_COALESCE_WINDOW = 0.002
+BATCH_MAX_SIZE = 100
+
+_request_ids = itertools.count()
+
+
+class RPCError(ValueError):
+    """batch 里单个请求返回的 JSON-RPC error，和 web3 一样是 ValueError"""
+
+
+def _block_param(block: BlockIdentifier) -> str:
+    if isinstance(block, int):
+        return hex(block)
+    if isinstance(block, bytes):
+        return Web3.toHex(block)
+    return block
+
+
+def _tx_param(tx: TxParams) -> dict:
+    return {key: hex(value) if isinstance(value, int) else Web3.toHex(value) if isinstance(value, bytes) else value
+            for key, value in tx.items()}
+
+
+def _format_result(method: str, response: dict):
+    if 'error' in response:
+        raise RPCError(response['error'])
+    formatter = PYTHONIC_RESULT_FORMATTERS.get(method)
+    result = response.get('result')
+    result = formatter(result) if formatter is not None and result is not None else result
+    return AttributeDict.recursive(result) if isinstance(result, dict) else result
+
+
+def _encode_batch(requests: List[tuple]) -> bytes:
+    return to_bytes(text=json.dumps([
+        {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': request_id}
+        for request_id, method, params in requests]))
+
+
+def _decode_batch(requests: List[tuple], raw: bytes) -> List[dict]:
+    """按请求顺序返回响应，节点可能打乱顺序或者对整个 batch 只返回一个 error"""
+    decoded = json.loads(to_text(raw))
+    if isinstance(decoded, dict):
+        return [decoded] * len(requests)
+    by_id = {response.get('id'): response for response in decoded}
+    return [by_id.get(request_id, {'error': {'code': -32603, 'message': 'missing response in batch'}})
+            for request_id, _, _ in requests]
+
+
+def _is_hedgeable(requests: List[tuple]) -> bool:
+    return all(method in HEDGED_METHODS for _, method, _ in requests)
+
+
+class _BatchMethods(ABC):
+    """batch 里常用的请求，参数整理成 JSON-RPC 格式后交给子类的 add()"""
+
+    @abstractmethod
+    def add(self, method: str, params: list):
+        """加入一个请求，返回它的 future"""
+
+    def block_number(self):
+        return self.add('eth_blockNumber', [])
+
+    def chain_id(self):
+        return self.add('eth_chainId', [])
+
+    def gas_price(self):
+        return self.add('eth_gasPrice', [])
+
+    def get_transaction_count(self, address, block: BlockIdentifier = 'latest'):
+        return self.add('eth_getTransactionCount', [Web3.toChecksumAddress(address), _block_param(block)])
+
+    def get_balance(self, address, block: BlockIdentifier = 'latest'):
+        return self.add('eth_getBalance', [Web3.toChecksumAddress(address), _block_param(block)])
+
+    def call(self, tx: TxParams, block: BlockIdentifier = 'latest'):
+        return self.add('eth_call', [_tx_param(tx), _block_param(block)])
+
+    def get_transaction_receipt(self, tx_hash):
+        return self.add('eth_getTransactionReceipt', [HexBytes(tx_hash).hex()])
+
+    def get_block(self, block: BlockIdentifier = 'latest', full_transactions: bool = False):
+        return self.add('eth_getBlockByNumber', [_block_param(block), full_transactions])
+
+    def get_logs(self, filter_params: dict):
+        return self.add('eth_getLogs', [{key: _block_param(value) if key in ('fromBlock', 'toBlock') else value
+                                         for key, value in filter_params.items()}])
+
+    def fee_history(self, block_count: int, newest_block: BlockIdentifier = 'latest', reward_percentiles=()):
+        return self.add('eth_feeHistory', [hex(block_count), _block_param(newest_block), list(reward_percentiles)])
+
+
+class RPCBatch(_BatchMethods):
+    """同步 batch，退出 with 时发送；add() 返回 concurrent.futures.Future"""
+
+    def __init__(self, w3: Web3):
+        self.w3 = w3
+        self._requests = []
+        self._futures = []
+
+    def add(self, method: str, params: list) -> Future:
+        future = Future()
+        self._requests.append((next(_request_ids), method, params))
+        self._futures.append(future)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute()
+
+    def _send(self, requests: List[tuple]) -> List[dict]:
+        provider = self.w3.provider
+        if isinstance(provider, PooledHTTPProvider):
+            raw = provider.send_raw(_encode_batch(requests), 'eth_call' if _is_hedgeable(requests) else None)
+        elif isinstance(provider, HTTPProvider):
+            raw = make_post_request(provider.endpoint_uri, _encode_batch(requests), **provider.get_request_kwargs())
+        else:
+            return [provider.make_request(method, params) for _, method, params in requests]
+        return _decode_batch(requests, raw)
+
+    def execute(self):
+        requests, futures = self._requests, self._futures
+        self._requests, self._futures = [], []
+        if not requests:
+            return
+        try:
+            responses = self._send(requests)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            raise
+        for (_, method, _), future, response in zip(requests, futures, responses):
+            try:
+                future.set_result(_format_result(method, response))
+            except Exception as e:
+                future.set_exception(e)
+
+
+async def _async_send(w3: Web3, requests: List[tuple]) -> List[dict]:
+    provider = w3.provider
+    if isinstance(provider, AsyncPooledHTTPProvider):
+        raw = await provider.send_raw(_encode_batch(requests), 'eth_call' if _is_hedgeable(requests) else None)
+    elif isinstance(provider, AsyncHTTPProvider):
+        raw = await async_make_post_request(provider.endpoint_uri, _encode_batch(requests),
+                                            **provider.get_request_kwargs())
+    else:
+        return [await provider.make_request(method, params) for _, method, params in requests]
+    return _decode_batch(requests, raw)
+
+
+def _resolve(requests: List[tuple], futures: List[asyncio.Future], responses: Optional[List[dict]], error=None):
+    for (_, method, _), future, response in zip(requests, futures, responses or [None] * len(futures)):
+        if future.done():
+            continue
+        if error is not None:
+            future.set_exception(error)
+            continue
+        try:
+            future.set_result(_format_result(method, response))
+        except Exception as e:
+            future.set_exception(e)
+
+
+class AsyncRPCBatch(_BatchMethods):
+    """异步 batch，退出 async with 时发送；add() 返回 asyncio.Future，退出之后再 await"""
+
+    def __init__(self, w3: Web3):
+        self.w3 = w3
+        self._requests = []
+        self._futures = []
+
+    def add(self, method: str, params: list) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        self._requests.append((next(_request_ids), method, params))
+        self._futures.append(future)
+        return future
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.execute()
+
+    async def execute(self):
+        requests, futures = self._requests, self._futures
+        self._requests, self._futures = [], []
+        if not requests:
+            return
+        try:
+            responses = await _async_send(self.w3, requests)
+        except Exception as e:
+            _resolve(requests, futures, None, e)
+            raise
+        _resolve(requests, futures, responses)
+
+
+class AsyncBatchCoalescer(_BatchMethods):
+    """
+    第一个请求进来后等 window 秒（或者攒够 max_size 个），把这段时间里所有请求合成一个 batch 发出去。
+    asyncio.gather 起来的并发请求不用改调用方式就能合并成一次 HTTP。
+    """
+
+    def __init__(self, w3: Web3, window: float = BATCH_COALESCE_WINDOW, max_size: int = BATCH_MAX_SIZE):
+        self.w3 = w3
+        self.window = window
+        self.max_size = max_size
+        self._requests = []
+        self._futures = []
+        self._timer = None
+        # 发送中的 _send task，事件循环只保留弱引用，不留引用的话 task 可能被回收，等结果的调用方会一直挂着
+        self._tasks = set()
+
+    def add(self, method: str, params: list) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._requests.append((next(_request_ids), method, params))
+        self._futures.append(future)
+        if len(self._requests) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return future
+
+    async def request(self, method: str, params: list) -> Any:
+        return await self.add(method, params)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        requests, futures = self._requests, self._futures
+        self._requests, self._futures = [], []
+        if requests:
+            task = asyncio.ensure_future(self._send(requests, futures))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, requests: List[tuple], futures: List[asyncio.Future]):
+        try:
+            responses = await _async_send(self.w3, requests)
+        except Exception as e:
+            _resolve(requests, futures, None, e)
+            return
+        _resolve(requests, futures, responses)
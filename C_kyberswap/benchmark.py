@@ -0,0 +1,268 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地性能测试，不访问网络。
+python3 benchmark.py [startup ...]
+"""
+import json
+import os
+import sys
+import time
+from web3 import Web3
+
+# SwapSimulator 按 Uniswap v3 的 swap 算法报价，tick_index/swap_simulator 基准都用 Uniswap v3 USDC/ETH 0.3%
+UNISWAP_V3_POOL = '0x8ad599c3a0ff1de082011efddc58f1908eb6e6d8'
+
+
+def _timeit(fn, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - start) / number
+
+
+def _report(name, seconds, baseline=None):
+    line = f"{name:<40} {seconds * 1e6:>12.1f} us"
+    if baseline:
+        line += f"  x{baseline / seconds:.1f}"
+    print(line)
+
+
+def bench_startup(number=200):
+    """client 构造耗时：旧的每次读 json + 建合约 vs 进程级 ABI/合约缓存"""
+    from kyberswap import Kyberswapv3f3000ApiTrade
+    pub_key = "0x" + "11" * 20
+    abi_dir = f"{os.path.dirname(os.path.abspath(__file__))}/abi/"
+    w3 = Web3(Web3.HTTPProvider("http://127.0.0.1:8545"))
+
+    def old_init():
+        abis = {}
+        for name in ("UniswapV3Factory", "NonfungiblePositionManager", "SwapRouter", "UniswapV3Pool"):
+            with open(abi_dir + f"{name}.json") as f:
+                data = json.load(f)
+            abis[name] = data["abi"] if isinstance(data, dict) else data
+        w3.eth.contract(address=Kyberswapv3f3000ApiTrade.UNI_V3_FACTORY_ADDRESS, abi=abis["UniswapV3Factory"])
+        w3.eth.contract(address=Kyberswapv3f3000ApiTrade.UNIS_V3_NFT_MANAGER_ADDRESS,
+                        abi=abis["NonfungiblePositionManager"])
+
+    def new_init():
+        with Kyberswapv3f3000ApiTrade(pub_key=pub_key, secret_key="", uniswapv3_rpc_url="http://127.0.0.1:8545") as cli:
+            cli.v3_nft_manager
+            cli.v3_factory
+
+    t0 = time.perf_counter()
+    new_init()
+    first = time.perf_counter() - t0
+    baseline = _timeit(old_init, max(number // 10, 1))
+    _report("startup: json.load + contract (old)", baseline)
+    _report("startup: first client in process", first)
+    _report("startup: cached client", _timeit(new_init, number), baseline)
+
+
+def bench_calldata(number=2000):
+    """add_position/remove_position 的 calldata：contract.encodeABI vs encoders，顺便校验逐字节一致"""
+    import encoders
+    from utils import _get_web3, _load_contract_json
+    from kyberswap import Kyberswapv3f3000ApiTrade
+    nft = _load_contract_json(_get_web3(), "NonfungiblePositionManager",
+                              Kyberswapv3f3000ApiTrade.UNIS_V3_NFT_MANAGER_ADDRESS)
+    token0 = Web3.toChecksumAddress("0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2")
+    token1 = Web3.toChecksumAddress("0xdac17f958d2ee523a2206206994597c13d831ec7")
+    recipient = Web3.toChecksumAddress("0x" + "11" * 20)
+    mint_args = (token0, token1, 300, -208380, -200460, [-208380, -200460], 10 ** 18, 2000 * 10 ** 6, 0, 0,
+                 recipient, 1700000000)
+
+    def old():
+        mint = nft.encodeABI("mint", args=(mint_args,))
+        refund = nft.encodeABI("refundEth")
+        remove = nft.encodeABI("removeLiquidity", args=((75, 447150632383970, 0, 0, 1700000000),))
+        unwrap = nft.encodeABI("unwrapWeth", args=(0, recipient))
+        burn = nft.encodeABI("burn", args=(75,))
+        return [nft.encodeABI("multicall", args=([mint, refund],)),
+                nft.encodeABI("multicall", args=([remove, unwrap, burn],))]
+
+    def new():
+        mint = encoders.encode_mint(*mint_args)
+        refund = encoders.encode_refund_eth()
+        remove = encoders.encode_remove_liquidity(75, 447150632383970, 0, 0, 1700000000)
+        unwrap = encoders.encode_unwrap_weth(0, recipient)
+        burn = encoders.encode_burn(75)
+        return [encoders.encode_multicall([mint, refund]), encoders.encode_multicall([remove, unwrap, burn])]
+
+    assert old() == new(), "encoders output differs from encodeABI"
+    baseline = _timeit(old, number // 10)
+    _report("calldata: encodeABI", baseline)
+    _report("calldata: encoders", _timeit(new, number), baseline)
+
+
+def bench_vector_math(positions=2000, scenarios=50):
+    """position book 在价格情景网格上的估值：逐个调用 utils.get_amounts_for_liquidity vs vector_math 广播"""
+    import numpy as np
+    import utils
+    import vector_math
+    rng = np.random.default_rng(0)
+    low = rng.uniform(1000, 2000, positions)
+    high = low * rng.uniform(1.01, 2, positions)
+    liquidity = rng.uniform(1e10, 1e15, positions)
+    prices = np.linspace(800, 4500, scenarios)
+
+    def scalar():
+        return [[utils.get_amounts_for_liquidity(p, lo, hi, liq) for lo, hi, liq in zip(low, high, liquidity)]
+                for p in prices]
+
+    def vector():
+        return vector_math.get_amounts_for_liquidity(prices[:, None], low, high, liquidity)
+
+    baseline = _timeit(scalar, 1)
+    _report(f"valuation {scenarios}x{positions}: scalar", baseline)
+    _report(f"valuation {scenarios}x{positions}: numpy", _timeit(vector, 20), baseline)
+
+
+def bench_tick_index(ticks=5000, number=100000):
+    """tick 流动性查询：逐个 tick 累加 liquidityNet vs TickIndex 前缀和 + bisect"""
+    import random
+    from tick_index import TickIndex
+    from utils import _get_web3
+    rng = random.Random(0)
+    # 不 bootstrap，直接用随机 position 填充
+    index = TickIndex(_get_web3(), UNISWAP_V3_POOL)
+    for _ in range(ticks // 2):
+        lower = rng.randrange(-14000, 14000) * 60
+        index.apply_position(lower, lower + rng.randrange(1, 500) * 60, rng.randrange(1, 10 ** 20))
+    pairs = list(zip(index.ticks, index.liquidity_net))
+
+    def scan():
+        return sum(net for tick, net in pairs if tick <= 1234)
+
+    assert scan() == index.liquidity_at(1234)
+    baseline = _timeit(scan, 100)
+    _report(f"liquidity_at {len(index)} ticks: scan", baseline)
+    _report(f"liquidity_at {len(index)} ticks: index", _timeit(lambda: index.liquidity_at(1234), number), baseline)
+    _report("next_initialized_tick", _timeit(lambda: index.next_initialized_tick(1234, False), number))
+
+
+def bench_log_decode(logs=5000):
+    """Swap 日志解码：w3.eth.get_logs 的格式化 + get_event_data 逐条 vs EventDecoder 批量"""
+    from eth_abi import encode_abi
+    from hexbytes import HexBytes
+    from web3._utils.events import get_event_data
+    from constant import MARKET_INFO_DICT
+    from log_ingester import pool_event_decoders
+    from utils import _get_web3, _load_abi_json
+    w3 = _get_web3()
+    pool_address = MARKET_INFO_DICT['kyberswapv3']['ETH_USDT']['id']
+    decoder = next(iter(pool_event_decoders(w3, ('Swap',)).values()))
+    event_abi = next(item for item in _load_abi_json("ElasticPool") if item.get('name') == 'Swap')
+    sender = "0x" + "00" * 12 + "11" * 20
+    data = encode_abi(['int256', 'int256', 'uint160', 'uint128', 'int24'],
+                      [-10 ** 18, 2000 * 10 ** 6, 2 ** 96, 10 ** 18, -200000])
+    raw = [{'address': pool_address, 'blockNumber': hex(15000000 + i), 'logIndex': '0x0', 'transactionIndex': '0x0',
+            'transactionHash': '0x' + '22' * 32, 'blockHash': '0x' + '33' * 32, 'data': '0x' + data.hex(),
+            'topics': [decoder.topic.hex(), sender, sender]} for i in range(logs)]
+
+    def old():
+        records = []
+        for log in raw:
+            log = dict(log, address=Web3.toChecksumAddress(log['address']), blockNumber=int(log['blockNumber'], 16),
+                       logIndex=int(log['logIndex'], 16), transactionIndex=0,
+                       topics=[HexBytes(t) for t in log['topics']],
+                       transactionHash=HexBytes(log['transactionHash']), blockHash=HexBytes(log['blockHash']))
+            records.append(get_event_data(w3.codec, event_abi, log))
+        return records
+
+    def new():
+        return decoder.decode(raw, {pool_address: 'ETH_USDT'})
+
+    assert [tuple(r['args'].values()) for r in old()[:10]] == [r[4:] for r in new()[:10]]
+    baseline = _timeit(old, 1)
+    _report(f"decode {logs} swap logs: get_event_data", baseline)
+    _report(f"decode {logs} swap logs: EventDecoder", _timeit(new, 5), baseline)
+
+
+def bench_swap_simulator(quotes=2000):
+    """exact input 报价：逐个 SwapSimulator.swap vs quote_exact_input_many 共用完整步"""
+    import random
+    from pool_state import PoolState
+    from swap_simulator import SwapSimulator
+    from tick_index import TickIndex
+    from tick_math import get_sqrt_ratio_at_tick
+    from utils import _get_web3
+    rng = random.Random(0)
+    index = TickIndex(_get_web3(), UNISWAP_V3_POOL)
+    for _ in range(2000):
+        lower = (-200000 + rng.randrange(-20000, 20000)) // 60 * 60
+        index.apply_position(lower, lower + rng.randrange(1, 300) * 60, rng.randrange(10 ** 15, 10 ** 19))
+    sqrt_price = get_sqrt_ratio_at_tick(-200000) + 1
+    simulator = SwapSimulator(PoolState(0, sqrt_price, -200000, index.liquidity_at(-200000), 60), index, 3000)
+    amounts = [10 ** 21 * i for i in range(1, quotes + 1)]
+
+    def single():
+        return [simulator.swap(True, amount) for amount in amounts]
+
+    def many():
+        simulator._paths.clear()
+        return simulator.quote_exact_input_many(True, amounts)
+
+    assert single() == many()
+    baseline = _timeit(single, 1) / quotes
+    _report(f"swap quote (up to {single()[-1].ticksCrossed} ticks): swap", baseline)
+    _report("swap quote: quote_exact_input_many", _timeit(many, 3) / quotes, baseline)
+
+
+def bench_backtest(swaps=20000, configs=512):
+    """LP 区间回测吞吐：一批配置按 numpy 向量化，单进程每秒能跑多少 配置 x swap"""
+    import tempfile
+    import numpy as np
+    import backtest
+    from log_ingester import SwapLog
+    rng = np.random.default_rng(0)
+    ticks = (-200000 + np.cumsum(rng.normal(0, 15, swaps))).astype(int)
+    amounts = rng.normal(0, 1e19, swaps)
+    path = [SwapLog('ETH_USDT', i, '', 0, '', '', int(a), int(-a * 1.0001 ** t), 0, 10 ** 19, int(t))
+            for i, (t, a) in enumerate(zip(ticks, amounts))]
+    grid = backtest.grid(range(60, 6001, 60), [500, 3000, 10000],
+                         [backtest.REBALANCE_NONE, backtest.REBALANCE_OUT_OF_RANGE])[:configs]
+    with tempfile.TemporaryDirectory() as directory:
+        backtest.save_swap_path(directory, path)
+        seconds = _timeit(lambda: backtest.run_grid(directory, grid, 1e12, processes=1, chunk_size=configs), 1)
+    _report(f"backtest {len(grid)} configs x {swaps} swaps", seconds)
+    print(f"{len(grid) * swaps / seconds / 1e6:.1f}M config-swaps/s per process")
+
+
+def bench_signing(transactions=400):
+    """批量签名吞吐：当前线程逐笔 w3.eth.account.sign_transaction vs SigningService 进程池"""
+    from signer import SigningService
+    w3 = Web3()
+    private_key = "0x" + "42" * 32
+    txs = [{'chainId': 1, 'nonce': nonce, 'to': Web3.toChecksumAddress("0x" + "22" * 20), 'value': 0,
+            'data': "0x" + "ab" * 1000, 'gas': 500000, 'maxFeePerGas': 30 * 10 ** 9,
+            'maxPriorityFeePerGas': 10 ** 9, 'type': 2} for nonce in range(transactions)]
+
+    def current():
+        return [bytes(w3.eth.account.sign_transaction(tx, private_key=private_key).rawTransaction) for tx in txs]
+
+    with SigningService([private_key]) as signer:
+        signer.sign_many(txs)
+        assert signer.sign_many(txs) == current()
+        baseline = _timeit(current, 1)
+        seconds = _timeit(lambda: signer.sign_many(txs), 3)
+    _report(f"sign {transactions} txs: sign_transaction", baseline / transactions)
+    _report(f"sign {transactions} txs: SigningService x{signer.processes}", seconds / transactions,
+            baseline / transactions)
+    print(f"{transactions / baseline:.0f} -> {transactions / seconds:.0f} signatures/s")
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'calldata': bench_calldata,
+    'vector_math': bench_vector_math,
+    'tick_index': bench_tick_index,
+    'log_decode': bench_log_decode,
+    'swap_simulator': bench_swap_simulator,
+    'backtest': bench_backtest,
+    'signing': bench_signing,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,100 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NFT manager 常用函数的 calldata 编码器。
+selector 从 ABI 预先算好，参数都是静态类型，直接按 32 字节一个 word 拼起来，
+结果和 contract.encodeABI 逐字节一致，但不走 web3 的函数查找、参数归一化和类型解析。
+"""
+import functools
+from typing import Iterable, Union
+from eth_utils import function_abi_to_4byte_selector
+from utils import _load_abi_json
+
+_UINT_MAX = 2 ** 256
+_ZERO_PAD = bytes(12)
+
+
+@functools.lru_cache()
+def selector(abi_name: str, fn_name: str) -> bytes:
+    for fn_abi in _load_abi_json(abi_name):
+        if fn_abi.get('type') == 'function' and fn_abi['name'] == fn_name:
+            return function_abi_to_4byte_selector(fn_abi)
+    raise ValueError(f"{fn_name} not found in {abi_name}")
+
+
+def _nft_selector(fn_name: str) -> bytes:
+    return selector("NonfungiblePositionManager", fn_name)
+
+
+def _uint(value: int) -> bytes:
+    return value.to_bytes(32, 'big')
+
+
+def _int(value: int) -> bytes:
+    return (value % _UINT_MAX).to_bytes(32, 'big')
+
+
+def _address(value: Union[str, bytes]) -> bytes:
+    if isinstance(value, str):
+        value = bytes.fromhex(value[2:])
+    if len(value) != 20:
+        raise ValueError(f"invalid address {value!r}")
+    return _ZERO_PAD + value
+
+
+def _to_bytes(data: Union[str, bytes]) -> bytes:
+    if isinstance(data, str):
+        return bytes.fromhex(data[2:] if data.startswith('0x') else data)
+    return data
+
+
+def encode_mint(token0, token1, fee: int, tick_lower: int, tick_upper: int, ticks_previous: Iterable[int],
+                amount0_desired: int, amount1_desired: int, amount0_min: int, amount1_min: int,
+                recipient, deadline: int) -> str:
+    tick_previous_lower, tick_previous_upper = ticks_previous
+    return '0x' + b''.join((
+        _nft_selector("mint"),
+        _address(token0), _address(token1), _uint(fee), _int(tick_lower), _int(tick_upper),
+        _int(tick_previous_lower), _int(tick_previous_upper),
+        _uint(amount0_desired), _uint(amount1_desired), _uint(amount0_min), _uint(amount1_min),
+        _address(recipient), _uint(deadline),
+    )).hex()
+
+
+def encode_refund_eth() -> str:
+    return '0x' + _nft_selector("refundEth").hex()
+
+
+def encode_remove_liquidity(token_id: int, liquidity: int, amount0_min: int, amount1_min: int, deadline: int) -> str:
+    return '0x' + b''.join((
+        _nft_selector("removeLiquidity"),
+        _uint(token_id), _uint(liquidity), _uint(amount0_min), _uint(amount1_min), _uint(deadline),
+    )).hex()
+
+
+def encode_unwrap_weth(min_amount: int, recipient) -> str:
+    return '0x' + (_nft_selector("unwrapWeth") + _uint(min_amount) + _address(recipient)).hex()
+
+
+def encode_burn(token_id: int) -> str:
+    return '0x' + (_nft_selector("burn") + _uint(token_id)).hex()
+
+
+def encode_positions(token_id: int) -> str:
+    return '0x' + (_nft_selector("positions") + _uint(token_id)).hex()
+
+
+def encode_multicall(data: Iterable[Union[str, bytes]]) -> str:
+    """multicall(bytes[]): head 是每个元素相对数组开头的 offset，tail 是 length + 右补零的数据"""
+    items = [_to_bytes(d) for d in data]
+    head = []
+    tail = []
+    offset = 32 * len(items)
+    for item in items:
+        head.append(_uint(offset))
+        padded = item + bytes(-len(item) % 32)
+        tail.append(_uint(len(item)) + padded)
+        offset += 32 + len(padded)
+    return '0x' + b''.join((
+        _nft_selector("multicall"), _uint(32), _uint(len(items)), *head, *tail,
+    )).hex()
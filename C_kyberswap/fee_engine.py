@@ -0,0 +1,357 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EIP-1559 手续费和 gas limit 在本地算好，组交易时不再调用 eth_gasPrice / eth_maxPriorityFeePerGas / eth_estimateGas。
+
+- FeeHistory：最近 FEE_HISTORY_BLOCKS 个区块的 eth_feeHistory（baseFee、gasUsedRatio、reward 分位数），
+  每个新区块只补拉新增的区块。maxPriorityFeePerGas 取窗口内 reward 分位数的中位数，
+  maxFeePerGas = 下一个区块的 baseFee * BASE_FEE_MULTIPLIER + priority。
+- GasModels：按 NFT manager multicall 的形状（里面各个调用的函数名，比如 ('mint', 'refundEth')、
+  ('removeLiquidity', 'unwrapWeth', 'burn')）记录最近的 receipt.gasUsed，gas limit = 窗口最大值 * (1 + GAS_MARGIN)。
+  样本不够时用每个调用的先验值相加。
+- FeeEngine：把两者和已发交易的 receipt 跟踪放在一起。刷新时 feeHistory 和待确认交易的 receipt 放在同一个 JSON-RPC batch 里。
+
+同步：
+    engine = FeeEngine(w3)
+    tx = engine.fill(tx)            # 第一次会拉一次 feeHistory 并启动后台线程，之后每个新区块在后台刷新
+    tx_hash = send(tx)
+    engine.track(tx_hash, tx)       # 上链后用 receipt.gasUsed 更新这个形状的 gas 模型
+异步：
+    if engine.stale:
+        await engine.async_refresh(coalescer)
+    tx = engine.fill(tx)
+"""
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from hexbytes import HexBytes
+from web3 import Web3
+from batch import RPCBatch
+from encoders import selector
+from utils import _load_abi_json
+
+FEE_HISTORY_BLOCKS = 20
+FEE_HISTORY_PERCENTILES = (10, 50, 90)
+PRIORITY_PERCENTILE = 50
+# baseFee 每个区块最多涨 12.5%，乘 2 能撑住连续 5 个满块
+BASE_FEE_MULTIPLIER = 2
+# 异步 client 没有后台线程，数据超过这个秒数就在下一次组交易时顺带刷新
+FEE_HISTORY_TTL = 12.0
+BLOCK_POLL_INTERVAL = 3.0
+
+GAS_MODEL_WINDOW = 50
+GAS_MODEL_MIN_SAMPLES = 3
+GAS_MARGIN = 0.15
+# 没有样本时 multicall 里每个调用的 gas 先验值，偏保守
+DEFAULT_CALL_GAS = {
+    'mint': 600000,
+    'addLiquidity': 350000,
+    'removeLiquidity': 300000,
+    'burnRTokens': 200000,
+    'syncFeeGrowth': 150000,
+    'createAndUnlockPoolIfNecessary': 5000000,
+    'refundEth': 30000,
+    'unwrapWeth': 50000,
+    'transferAllTokens': 60000,
+    'burn': 50000,
+}
+DEFAULT_UNKNOWN_CALL_GAS = 200000
+TX_BASE_GAS = 21000
+# 跟踪的交易超过这个秒数还没有 receipt 就不再查（被替换或者丢了）
+TRACK_MAX_AGE = 600.0
+
+
+class FeeSuggestion(NamedTuple):
+    maxFeePerGas: int
+    maxPriorityFeePerGas: int
+    baseFeePerGas: int     # 下一个区块的 baseFee
+    block: int             # 数据对应的最新区块
+
+
+def _selector_names(abi_name: str = "NonfungiblePositionManager") -> Dict[bytes, str]:
+    return {selector(abi_name, fn['name']): fn['name']
+            for fn in _load_abi_json(abi_name) if fn.get('type') == 'function'}
+
+
+_NFT_SELECTOR_NAMES = None
+
+
+def _call_name(call_selector: bytes) -> str:
+    global _NFT_SELECTOR_NAMES
+    if _NFT_SELECTOR_NAMES is None:
+        _NFT_SELECTOR_NAMES = _selector_names()
+    return _NFT_SELECTOR_NAMES.get(call_selector, call_selector.hex())
+
+
+def calls_shape(calls) -> Tuple[str, ...]:
+    """multicall 子调用 calldata 列表（还没有 encode_multicall）的形状"""
+    return tuple(_call_name(bytes(HexBytes(call))[:4]) for call in calls)
+
+
+def multicall_shape(data) -> Tuple[str, ...]:
+    """
+    交易 data 对应的调用形状。multicall(bytes[]) 按 ABI 布局直接读出每个子调用的 selector，不做完整解码；
+    不是 multicall 时就是 (函数名,)
+    """
+    data = bytes(HexBytes(data))
+    name = _call_name(data[:4])
+    if name != 'multicall':
+        return (name,)
+    args = data[4:]
+    head = int.from_bytes(args[0:32], 'big')
+    count = int.from_bytes(args[head:head + 32], 'big')
+    offsets = args[head + 32:head + 32 + 32 * count]
+    shape = []
+    for i in range(count):
+        item = head + 32 + int.from_bytes(offsets[32 * i:32 * i + 32], 'big')
+        shape.append(_call_name(args[item + 32:item + 36]))
+    return tuple(shape)
+
+
+class FeeHistory():
+    """eth_feeHistory 的滚动窗口，ingest 接收 web3 格式化之后的结果（int 字段）"""
+
+    def __init__(self, block_count: int = FEE_HISTORY_BLOCKS, percentiles: Iterable[int] = FEE_HISTORY_PERCENTILES):
+        self.block_count = block_count
+        self.percentiles = tuple(percentiles)
+        self.newest = None
+        self.next_base_fee = None
+        self.updated = 0.0
+        # (区块号, baseFee, gasUsedRatio, 各分位数 reward)
+        self._blocks = deque(maxlen=block_count)
+        self._lock = threading.Lock()
+
+    def request_size(self, head: Optional[int] = None) -> int:
+        """知道最新区块号时只补拉缺的区块"""
+        if head is None or self.newest is None:
+            return self.block_count
+        return min(max(head - self.newest, 1), self.block_count)
+
+    def ingest(self, result):
+        oldest = result['oldestBlock']
+        base_fees = result['baseFeePerGas']
+        ratios = result['gasUsedRatio']
+        rewards = result.get('reward') or [()] * len(ratios)
+        if not ratios:
+            return
+        with self._lock:
+            # 重叠的区块（包括 reorg 之后的）以新数据为准
+            while self._blocks and self._blocks[-1][0] >= oldest:
+                self._blocks.pop()
+            for i, ratio in enumerate(ratios):
+                self._blocks.append((oldest + i, base_fees[i], ratio, tuple(rewards[i])))
+            self.newest = oldest + len(ratios) - 1
+            # baseFeePerGas 比区块数多一个，最后一个就是下一个区块的 baseFee
+            self.next_base_fee = base_fees[len(ratios)] if len(base_fees) > len(ratios) else base_fees[-1]
+            self.updated = time.monotonic()
+
+    def priority_fee(self, percentile: int = PRIORITY_PERCENTILE) -> int:
+        """窗口内各区块 reward 在 percentile 分位的中位数，空块（reward 全 0）不计"""
+        column = self.percentiles.index(percentile)
+        with self._lock:
+            rewards = [block[3][column] for block in self._blocks if block[3] and block[3][column] > 0]
+        return int(statistics.median(rewards)) if rewards else 0
+
+    def suggest(self, percentile: int = PRIORITY_PERCENTILE, base_fee_multiplier: float = BASE_FEE_MULTIPLIER,
+                min_priority_fee: int = 0) -> FeeSuggestion:
+        if self.next_base_fee is None:
+            raise Exception("fee history is empty, refresh first")
+        priority = max(self.priority_fee(percentile), min_priority_fee)
+        base_fee = self.next_base_fee
+        return FeeSuggestion(int(base_fee * base_fee_multiplier) + priority, priority, base_fee, self.newest)
+
+
+class GasModels():
+    """
+    每种 multicall 形状最近 GAS_MODEL_WINDOW 个 gasUsed。
+    传了 path 时样本保存在 json 文件里，进程重启后接着用。
+    """
+
+    def __init__(self, path: Optional[str] = None, window: int = GAS_MODEL_WINDOW,
+                 min_samples: int = GAS_MODEL_MIN_SAMPLES, margin: float = GAS_MARGIN):
+        self.path = path
+        self.window = window
+        self.min_samples = min_samples
+        self.margin = margin
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def prior(shape: Tuple[str, ...]) -> int:
+        return TX_BASE_GAS + sum(DEFAULT_CALL_GAS.get(name, DEFAULT_UNKNOWN_CALL_GAS) for name in shape)
+
+    def observe(self, shape: Tuple[str, ...], gas_used: int, gas_limit: Optional[int] = None, status: int = 1):
+        """
+        记一笔 receipt。失败且 gas 基本用完的是 out of gas，gasUsed 不代表真实需要的量，
+        按 gas limit 的 1.5 倍记，下次估出来的 limit 会明显变大
+        """
+        if not status and gas_limit and gas_used >= gas_limit * 0.98:
+            gas_used = int(gas_limit * 1.5)
+        elif not status:
+            # revert 的 gasUsed 偏小，不能拿来估正常执行
+            return
+        with self._lock:
+            samples = self._samples.get(shape)
+            if samples is None:
+                samples = self._samples[shape] = deque(maxlen=self.window)
+            samples.append(gas_used)
+        self._save()
+
+    def estimate(self, shape: Tuple[str, ...]) -> int:
+        with self._lock:
+            samples = self._samples.get(shape)
+            learned = int(max(samples) * (1 + self.margin)) if samples else 0
+            count = len(samples) if samples else 0
+        if count >= self.min_samples:
+            return learned
+        return max(learned, self.prior(shape))
+
+    def shapes(self) -> Dict[Tuple[str, ...], List[int]]:
+        with self._lock:
+            return {shape: list(samples) for shape, samples in self._samples.items()}
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for key, samples in json.load(f).items():
+                self._samples[tuple(key.split(','))] = deque(samples, maxlen=self.window)
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump({','.join(shape): samples for shape, samples in self.shapes().items()}, f)
+        os.replace(tmp_path, self.path)
+
+
+class FeeEngine():
+    """
+    w3 用于同步刷新和后台线程；异步 client 传 None，用 async_refresh 刷新。
+    fill() 只读本地状态：type 2 交易的 maxFeePerGas / maxPriorityFeePerGas / gas
+    """
+
+    def __init__(self, w3: Optional[Web3] = None, gas_model_path: Optional[str] = None,
+                 block_count: int = FEE_HISTORY_BLOCKS, percentile: int = PRIORITY_PERCENTILE,
+                 base_fee_multiplier: float = BASE_FEE_MULTIPLIER, min_priority_fee: int = 0,
+                 ttl: float = FEE_HISTORY_TTL):
+        self.w3 = w3
+        self.history = FeeHistory(block_count, sorted(set(FEE_HISTORY_PERCENTILES) | {percentile}))
+        self.gas_models = GasModels(gas_model_path)
+        self.percentile = percentile
+        self.base_fee_multiplier = base_fee_multiplier
+        self.min_priority_fee = min_priority_fee
+        self.ttl = ttl
+        # tx hash -> (形状, gas limit, 发出时间)
+        self._tracked = {}
+        self._lock = threading.Lock()
+        self._poll_thread = None
+        self._stop = threading.Event()
+
+    @property
+    def stale(self) -> bool:
+        return self.history.newest is None or time.monotonic() - self.history.updated > self.ttl
+
+    def suggest(self) -> FeeSuggestion:
+        if self.history.newest is None and self.w3 is not None:
+            # 第一次用：同步拉一次，之后交给后台线程
+            self.refresh()
+            self.start()
+        return self.history.suggest(self.percentile, self.base_fee_multiplier, self.min_priority_fee)
+
+    def estimate_gas(self, data) -> int:
+        return self.gas_models.estimate(multicall_shape(data))
+
+    def fill(self, tx: dict) -> dict:
+        """补上 gas 和 EIP-1559 手续费，已经填了的字段不动；填了 gasPrice 的 legacy 交易不加 1559 字段"""
+        tx = dict(tx)
+        if 'gas' not in tx:
+            tx['gas'] = self.estimate_gas(tx.get('data', b''))
+        if 'gasPrice' not in tx and 'maxFeePerGas' not in tx:
+            fees = self.suggest()
+            tx['maxFeePerGas'] = fees.maxFeePerGas
+            tx.setdefault('maxPriorityFeePerGas', fees.maxPriorityFeePerGas)
+        return tx
+
+    def track(self, tx_hash, tx: dict):
+        """已发出的交易，之后刷新时查 receipt，把 gasUsed 记到它的形状下"""
+        with self._lock:
+            self._tracked[HexBytes(tx_hash).hex()] = (multicall_shape(tx.get('data', b'')), tx.get('gas'),
+                                                      time.monotonic())
+
+    def untrack(self, tx_hash):
+        with self._lock:
+            self._tracked.pop(HexBytes(tx_hash).hex(), None)
+
+    def observe_receipt(self, tx_hash, receipt) -> bool:
+        """用一个 receipt 更新 gas 模型（别处拿到 receipt 时也可以直接喂进来），不是跟踪中的交易返回 False"""
+        with self._lock:
+            tracked = self._tracked.pop(HexBytes(tx_hash).hex(), None)
+        if tracked is None:
+            return False
+        shape, gas_limit, _ = tracked
+        self.gas_models.observe(shape, receipt['gasUsed'], gas_limit, receipt.get('status', 1))
+        return True
+
+    def _pending_hashes(self) -> List[str]:
+        now = time.monotonic()
+        with self._lock:
+            for tx_hash in [h for h, (_, _, sent) in self._tracked.items() if now - sent > TRACK_MAX_AGE]:
+                del self._tracked[tx_hash]
+            return list(self._tracked)
+
+    def _add_requests(self, batch, head: Optional[int]):
+        history = batch.fee_history(self.history.request_size(head), head if head is not None else 'latest',
+                                    self.history.percentiles)
+        receipts = [(tx_hash, batch.get_transaction_receipt(tx_hash)) for tx_hash in self._pending_hashes()]
+        return history, receipts
+
+    def _apply(self, history, receipts):
+        self.history.ingest(history)
+        for tx_hash, receipt in receipts:
+            if receipt is not None:
+                self.observe_receipt(tx_hash, receipt)
+
+    def refresh(self, head: Optional[int] = None):
+        """feeHistory 和待确认交易的 receipt 用一个 batch 读回来"""
+        with RPCBatch(self.w3) as batch:
+            history, receipts = self._add_requests(batch, head)
+        self._apply(history.result(), [(tx_hash, future.result()) for tx_hash, future in receipts])
+
+    async def async_refresh(self, rpc, head: Optional[int] = None):
+        """rpc 是 batch.AsyncBatchCoalescer（或者任何有同样方法的对象），请求会合进同一个 batch"""
+        history, receipts = self._add_requests(rpc, head)
+        results = await asyncio.gather(history, *[future for _, future in receipts])
+        self._apply(results[0], [(tx_hash, result) for (tx_hash, _), result in zip(receipts, results[1:])])
+
+    def on_new_block(self, block_number: int):
+        """外部已经知道有新区块时（比如订阅了 newHeads）直接调这个，只补拉新增的区块"""
+        if self.history.newest is None or block_number > self.history.newest:
+            self.refresh(block_number)
+
+    def start(self, interval: float = BLOCK_POLL_INTERVAL):
+        """Start a daemon thread that polls the block number and refreshes on every new block."""
+        if self._poll_thread is not None or self.w3 is None:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.on_new_block(self.w3.eth.block_number)
+                except Exception as e:
+                    print(e)
+
+        self._poll_thread = threading.Thread(target=run, name='fee-history', daemon=True)
+        self._poll_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._poll_thread = None
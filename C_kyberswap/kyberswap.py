@@ -1,19 +1,41 @@
 # !/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import time
-from web3 import Web3, HTTPProvider
-from web3.contract import ContractFunction
-from typing import Optional, NamedTuple
+from concurrent.futures import Future
+from web3 import Web3
+from web3.contract import Contract, ContractFunction
+from web3._utils.transactions import fill_transaction_defaults
+from typing import Callable, Dict, Optional, NamedTuple, List
 from web3.types import (
+    BlockIdentifier,
     TxParams,
     Wei,
-    Nonce,
     HexBytes,
 )
-import json
-import os
-from utils import _str_to_addr, _addr_to_str, tick2price
+from utils import _str_to_addr, _addr_to_str, _get_web3, _load_abi_json, _load_contract_json, tick2price
 from constant import MARKET_INFO_DICT
+from market_registry import MarketRegistry, address_key, get_market_registry
+from multicall import Multicall, MULTICALL_CHUNK_SIZE, output_types
+from nonce_manager import NonceManager
+from batch import RPCBatch
+from fee_engine import FeeEngine, calls_shape
+from tx_pipeline import TxPipeline
+from signer import SigningService
+from pool_state import PoolState, PoolStateCache, get_pool_state_cache
+from position_index import PositionIndex, get_position_index
+from position_fees import FeeReader, PositionFees
+from portfolio import PortfolioValuer
+from tick_math import get_amounts_for_liquidity, sqrt_ratio_at_tick
+from config import TICK_SPACING
+from encoders import (
+    encode_burn,
+    encode_mint,
+    encode_multicall,
+    encode_positions,
+    encode_refund_eth,
+    encode_remove_liquidity,
+    encode_unwrap_weth,
+)
 
 
 class KyberswapPositionParam(NamedTuple):
@@ -39,51 +61,325 @@ class KyberswapNewLiquidityParam(NamedTuple):
     quote_amountMin: float
 
 
+class KyberswapRebalanceParam(NamedTuple):
+    token_id: int
+    reduce_percent: int
+    burn: bool
+    new_position: KyberswapNewLiquidityParam
+
+
 FeeTier = 3000
+# rebalance_positions 每笔 multicall 交易的 gas 上限
+REBALANCE_GAS_CAP = 5000000
 
-class Kyberswapv3f3000ApiTrade():
+class _Kyberswapv3Base():
+    """ABI、合约对象和不需要访问网络的 calldata/结果组装，同步和异步 client 共用"""
     UNI_V3_ROUTER_ADDRESS = _str_to_addr("0xF9c2b5746c946EF883ab2660BbbB1f10A5bdeAb4")
     UNI_V3_FACTORY_ADDRESS = _str_to_addr("0xC7a590291e07B9fe9E64b86c58fD8fC764308C4A")
     UNIS_V3_NFT_MANAGER_ADDRESS = _str_to_addr("0x2b1c7b41f6a8f2b2bc45c3233a5d5fb3cd6dc9a8")
 
-    def __init__(self,
-                 pub_key,
-                 secret_key: str,
-                 loop=None,
-                 uniswapv3_rpc_url=None
-                 ):
-        self.provider = uniswapv3_rpc_url
+    def __init__(self, pub_key, secret_key: str, contract_w3: Web3):
+        # 这里不访问网络也不解析 ABI，ABI 和合约对象在第一次用到时从进程级缓存里取
+        # contract_w3 是合约对象绑定的 Web3：同步 client 用它读链，异步 client 只用它编码/解码
+        self._contract_w3 = contract_w3
         self.market_info_map = MARKET_INFO_DICT['kyberswapv3']
-        self.V3_Factory_ABI = json.load(
-            open(os.path.abspath(f"{os.path.dirname(os.path.abspath(__file__))}/abi/" + "UniswapV3Factory.json")))[
-            "abi"]
-        self.V3_NFT_Manager_ABI = json.load(
-            open(os.path.abspath(
-                f"{os.path.dirname(os.path.abspath(__file__))}/abi/" + "NonfungiblePositionManager.json")))
-        self.V3_ROUTER_ABI = json.load(
-            open(os.path.abspath(
-                f"{os.path.dirname(os.path.abspath(__file__))}/abi/" + "SwapRouter.json")))[
-            "abi"]
-        self.V3_POOL_ABI = json.load(
-            open(os.path.abspath(
-                f"{os.path.dirname(os.path.abspath(__file__))}/abi/" + "UniswapV3Pool.json")))[
-            "abi"]
-
+        # 预先算好 checksum 地址的 token/池子索引，组交易时不再拆 symbol、转 checksum
+        self.markets: MarketRegistry = get_market_registry('kyberswapv3')
         self.address = Web3.toChecksumAddress(pub_key)
         self.wallet_private_key = secret_key
-        self.sync_w3 = Web3(
-            Web3.HTTPProvider(self.provider),
-        )
-        self.w3 = Web3(HTTPProvider(self.provider))
-        self.last_nonce: Nonce = self.sync_w3.eth.get_transaction_count(self.address)
         self.router_address = self.UNI_V3_ROUTER_ADDRESS
-        self.v3_factory = self.sync_w3.eth.contract(address=self.UNI_V3_FACTORY_ADDRESS, abi=self.V3_Factory_ABI)
-        self.v3_nft_manager = self.sync_w3.eth.contract(address=self.UNIS_V3_NFT_MANAGER_ADDRESS,
-                                                        abi=self.V3_NFT_Manager_ABI)
         self.max_approval_hex = f"0x{64 * 'f'}"
         self.max_approval_int = int(self.max_approval_hex, 16)
         self.max_128_int = int(f"0x{32 * 'f'}", 16)
 
+    @property
+    def V3_Factory_ABI(self):
+        return _load_abi_json("UniswapV3Factory")
+
+    @property
+    def V3_NFT_Manager_ABI(self):
+        return _load_abi_json("NonfungiblePositionManager")
+
+    @property
+    def V3_ROUTER_ABI(self):
+        return _load_abi_json("SwapRouter")
+
+    @property
+    def V3_POOL_ABI(self):
+        return _load_abi_json("UniswapV3Pool")
+
+    @property
+    def v3_factory(self) -> Contract:
+        return _load_contract_json(self._contract_w3, "UniswapV3Factory", self.UNI_V3_FACTORY_ADDRESS)
+
+    @property
+    def v3_nft_manager(self) -> Contract:
+        return _load_contract_json(self._contract_w3, "NonfungiblePositionManager", self.UNIS_V3_NFT_MANAGER_ADDRESS)
+
+    def _pool_contract(self, pool_address) -> Contract:
+        return _load_contract_json(self._contract_w3, "UniswapV3Pool", pool_address)
+
+    def _position_pool(self, position_info) -> str:
+        """positions() 结果对应的已登记池子地址，fee 是 Elastic 的单位，换成 feeTier 查注册表"""
+        token0, fee, token1 = position_info[1]
+        market = self.markets.elastic_pool(token0, token1, fee)
+        if market is None:
+            raise Exception(f"pool {token0}/{token1} with fee {fee} is not registered in MARKET_INFO_DICT")
+        return market.pool
+
+    def _format_position(self, symbol, position_info, pool_state: Optional[PoolState] = None,
+                         fees: Optional[PositionFees] = None):
+        market = self.markets.market(symbol)
+        base_coin = market.base.symbol
+        quote_coin = market.quote.symbol
+
+        base_token_decimal = market.base.decimals
+        quote_token_decimal = market.quote.decimals
+        symbol_pool_address = market.pool
+
+        poolId = position_info[0][2]
+        # feetier = position_info[4]
+        tickLower = position_info[0][3]
+        tickUpper = position_info[0][4]
+        liquidity = position_info[0][5]
+        rTokenOwed = position_info[0][6]
+        feeGrowthInsideLast = position_info[0][7]
+
+        token0 = position_info[1][0]
+        fee = position_info[1][1]
+        token1 = position_info[1][2]
+        lowerPrice = tick2price(tickUpper, base_token_decimal, quote_token_decimal)
+        upperPrice = tick2price(tickLower, base_token_decimal, quote_token_decimal)
+        base_computed = quote_computed = None
+        if pool_state is not None:
+            spacing = pool_state.tickSpacing or TICK_SPACING['MEDIUM']
+            amount0, amount1 = get_amounts_for_liquidity(pool_state.sqrtPriceX96,
+                                                         sqrt_ratio_at_tick(tickLower, spacing),
+                                                         sqrt_ratio_at_tick(tickUpper, spacing),
+                                                         liquidity)
+            if address_key(token0) == market.base.address_bytes:
+                base_computed, quote_computed = amount0, amount1
+            else:
+                base_computed, quote_computed = amount1, amount0
+            base_computed = base_computed / 10 ** base_token_decimal
+            quote_computed = quote_computed / 10 ** quote_token_decimal
+        base_fee = quote_fee = None
+        if fees is not None:
+            # 未领取的手续费（israw=False 时）加进数量里
+            if address_key(token0) == market.base.address_bytes:
+                base_fee, quote_fee = fees.amount0, fees.amount1
+            else:
+                base_fee, quote_fee = fees.amount1, fees.amount0
+            base_fee = base_fee / 10 ** base_token_decimal
+            quote_fee = quote_fee / 10 ** quote_token_decimal
+            if base_computed is not None:
+                base_computed = base_computed + base_fee
+                quote_computed = quote_computed + quote_fee
+        result = {
+            'poolId': poolId,
+            'base_coin': base_coin,
+            'quote_coin': quote_coin,
+            'base_amount': base_computed,
+            'quote_amount': quote_computed,
+            'lowerPrice': lowerPrice,
+            'upperPrice': upperPrice,
+            'liquidity': liquidity,
+            'rTokenOwed': rTokenOwed,
+            'token0': token0,
+            'fee': fee,
+            'token1': token1,
+            'feeGrowthInsideLast': feeGrowthInsideLast,
+            'symbol_pool_address': symbol_pool_address
+        }
+        if pool_state is not None:
+            result.update({
+                'block': pool_state.block,
+                'sqrtPriceX96': pool_state.sqrtPriceX96,
+                'tick': pool_state.tick,
+                'pool_liquidity': pool_state.liquidity,
+            })
+        if fees is not None:
+            result.update({
+                'base_fee': base_fee,
+                'quote_fee': quote_fee,
+                'rTokenFee': fees.rToken,
+            })
+        return result
+
+    def _add_position_calls(self, param: KyberswapNewLiquidityParam):
+        """组装 mint + refundEth 的 multicall 数据，返回 (calldata 列表, value, 结果)"""
+        symbol = param.symbol
+        quote_amountDesired = param.quote_amountDesired
+        # lowerPrice = param.lowerPrice
+        # upperPrice = param.upperPrice
+        tickLower = param.tickLower
+        tickUpper = param.tickUpper
+        base_amountDesired = param.base_amountDesired
+        base_amountMin = param.base_amountMin
+        quote_amountMin = param.quote_amountMin
+
+        deadline = int(time.time() + 10 ** 3)
+        market = self.markets.market(symbol)
+        fee = market.fee
+        recipient = self.address
+        base_token_addr = market.base.address
+        quote_token_addr = market.quote.address
+        base_token_decimal = market.base.decimals
+        quote_token_decimal = market.quote.decimals
+        # tickLower = price2tick(upperPrice, base_token_decimal=base_token_decimal,
+        #                        quote_token_decimal=quote_token_decimal)
+        # tickUpper = price2tick(lowerPrice, base_token_decimal=base_token_decimal,
+        #                        quote_token_decimal=quote_token_decimal)
+        # if not base_amountDesired:
+        #     base_amountDesired = compute_base_amount_from_quote_amount(quote_amountDesired, price=quote_token_price,
+        #                                                                low=lowerPrice,
+        #                                                                high=upperPrice)
+        base_amountDesired = int(base_amountDesired * 10 ** base_token_decimal)
+        quote_amountDesired = int(quote_amountDesired * 10 ** quote_token_decimal)
+        ticksPrevious = [tickLower, tickUpper]
+        hex_str = encode_mint(base_token_addr, quote_token_addr, fee, tickLower, tickUpper, ticksPrevious,
+                              base_amountDesired, quote_amountDesired, base_amountMin, quote_amountMin, recipient,
+                              deadline)
+        refund_hex_str = encode_refund_eth()
+        if market.base.is_weth:
+            value = base_amountDesired
+        elif market.quote.is_weth:
+            value = quote_amountDesired
+        else:
+            value = 0
+        increase_result = {
+            'ori_base_amount': base_amountDesired / 10 ** base_token_decimal,
+            'ori_quote_amount': quote_amountDesired / 10 ** quote_token_decimal,
+            'tickLower': tickLower,
+            'tickUpper': tickUpper,
+            'ticksPrevious': [tickLower, tickUpper],
+            # 'lowerPrice': lowerPrice,
+            # 'upperPrice': upperPrice,
+        }
+        return [hex_str, refund_hex_str], value, increase_result
+
+    def _remove_position_calls(self, token_id, position_info, reduce_percent, burn):
+        """组装 removeLiquidity [+ unwrapWeth] [+ burn] 的 multicall 数据，返回 (calldata 列表, 移除的 liquidity)"""
+        multicall_list = []
+        # [0, '0x0000000000000000000000000000000000000000', '0x07865c6E87B9F70255377e024ace6630C1Eaa37F', '0xc778417E063141139Fce010982780140Aa0cD5Ab', 3000, 197880, 198600, 447150632383970, 0, 0, 0, 0]
+        liquidity = int(position_info[0][5] * reduce_percent * 0.01)
+        base_token = position_info[1][0]
+        quote_token = position_info[1][2]
+        base_amountMin = 0
+        quote_amountMin = 0
+        deadline = int(time.time() + 10 ** 3)
+        dec_hex_str = encode_remove_liquidity(token_id, liquidity, base_amountMin, quote_amountMin, deadline)
+        multicall_list.append(dec_hex_str)
+
+        if self.markets.is_weth(base_token) or self.markets.is_weth(quote_token):
+            unwrap_hex_str = encode_unwrap_weth(0, self.address)
+            multicall_list.append(unwrap_hex_str)
+        if burn:
+            burn_hex_str = encode_burn(token_id)
+            multicall_list.append(burn_hex_str)
+        return multicall_list, liquidity
+
+    def _rebalance_txs(self, params: List[KyberswapRebalanceParam], positions_info: Dict[int, tuple],
+                       gas_estimate: Callable[[tuple], int], gas_cap: int):
+        """
+        把多个 (remove + 新建) 装进尽量少的 multicall，返回 [(calldata 列表, value, 每个 param 的结果)]。
+        每笔交易的顺序：removeLiquidity... burn... unwrapWeth mint... refundEth，
+        unwrapWeth/refundEth 每笔交易只放一次。同一个 param 的 remove 和 mint 一定在同一笔交易里，
+        gas_estimate(形状) 超过 gas_cap 就开新的一笔；单个 param 本身超过 gas_cap 时单独一笔
+        """
+        unwrap_call = encode_unwrap_weth(0, self.address)
+        refund_call = encode_refund_eth()
+        ops = []
+        for param in params:
+            remove_calls, liquidity = self._remove_position_calls(
+                param.token_id, positions_info[param.token_id], param.reduce_percent, param.burn)
+            mint_calls, value, increase_result = self._add_position_calls(param.new_position)
+            result = dict(increase_result, token_id=param.token_id, remove_liquidity=liquidity)
+            ops.append((remove_calls, [call for call in mint_calls if call != refund_call], value, result))
+
+        burn_prefix = encode_burn(0)[:10]
+
+        def compose(batch):
+            removes = [call for op in batch for call in op[0] if call != unwrap_call]
+            # burn 要在同一个 token 的 removeLiquidity 之后，统一放在所有 remove 后面
+            burns = [call for call in removes if call.startswith(burn_prefix)]
+            calls = [call for call in removes if not call.startswith(burn_prefix)] + burns
+            if any(unwrap_call in op[0] for op in batch):
+                calls.append(unwrap_call)
+            mints = [call for op in batch for call in op[1]]
+            calls.extend(mints)
+            if mints:
+                calls.append(refund_call)
+            return calls
+
+        txs = []
+        batch = []
+        for op in ops:
+            if batch and gas_estimate(calls_shape(compose(batch + [op]))) > gas_cap:
+                txs.append(batch)
+                batch = []
+            batch.append(op)
+        if batch:
+            txs.append(batch)
+        return [(compose(batch), sum(op[2] for op in batch), [op[3] for op in batch]) for batch in txs]
+
+
+class Kyberswapv3f3000ApiTrade(_Kyberswapv3Base):
+
+    def __init__(self,
+                 pub_key,
+                 secret_key: str,
+                 loop=None,
+                 uniswapv3_rpc_url=None,
+                 nonce_lock_path=None,
+                 gas_model_path=None
+                 ):
+        # uniswapv3_rpc_url 可以是一个 url，也可以是多个节点的 list，多个节点时走 rpc_pool.PooledHTTPProvider
+        self.provider = tuple(uniswapv3_rpc_url) if isinstance(uniswapv3_rpc_url, list) else uniswapv3_rpc_url
+        super().__init__(pub_key, secret_key, _get_web3(self.provider))
+        # 同一个钱包多进程下单时传 nonce_lock_path，共用一个 nonce 状态文件
+        # 第一次分配 nonce 时起后台线程，定时用链上计数校正（其他进程发的交易、没人用的空洞），close() 时停
+        self.nonce_manager = NonceManager(self.sync_w3, self.address, lock_path=nonce_lock_path, auto_start=True)
+        # gas limit 和 EIP-1559 手续费在本地算，gas_model_path 保存按 multicall 形状学到的 gasUsed
+        self.fee_engine = FeeEngine(self.sync_w3, gas_model_path=gas_model_path)
+        # 未领取手续费在本地算，池子和边界 tick 的输入一次 multicall 读
+        self.fee_reader = FeeReader(self.sync_w3, factory_address=self.UNI_V3_FACTORY_ADDRESS)
+        self._tx_pipeline = None
+        self._signer = None
+
+    def close(self):
+        """停掉后台线程和签名进程池：nonce 校正、手续费刷新、交易流水线、signer"""
+        self.nonce_manager.stop()
+        self.fee_engine.stop()
+        if self._tx_pipeline is not None:
+            self._tx_pipeline.stop()
+            self._tx_pipeline = None
+        if self._signer is not None:
+            self._signer.stop()
+            self._signer = None
+
+    def __enter__(self) -> 'Kyberswapv3f3000ApiTrade':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def sync_w3(self) -> Web3:
+        return _get_web3(self.provider)
+
+    @property
+    def w3(self) -> Web3:
+        return _get_web3(self.provider)
+
+    @property
+    def pool_state_cache(self) -> PoolStateCache:
+        return get_pool_state_cache(self.sync_w3)
+
+    def batch(self) -> RPCBatch:
+        """with client.batch() as batch: ... 退出时把里面的请求作为一个 JSON-RPC batch 发出去"""
+        return RPCBatch(self.sync_w3)
+
     # # 同步等返回结果，可先不返回结果，返回txhash
     # def approve_uniswap_spender(self, coin: str):
     #     """
@@ -117,54 +413,34 @@ class Kyberswapv3f3000ApiTrade():
     #     result = self.w3.codec.decode_single('uint256', call_result)
     #     return result
 
+    @property
+    def position_index(self) -> PositionIndex:
+        return get_position_index(self.sync_w3, self.UNIS_V3_NFT_MANAGER_ADDRESS)
+
+    def list_positions(self, owner=None, with_positions: bool = False, block: BlockIdentifier = 'latest'):
+        """
+        owner（默认自己的钱包）持有的 position token id。第一次 balanceOf + tokenOfOwnerByIndex 批量读，
+        之后只按 Transfer 事件增量更新本地索引。with_positions 时返回 {token_id: positions() 原始结果}
+        """
+        return self.position_index.list_positions(owner or self.address, with_positions, block)
+
     def query_get_position(self, param: KyberswapPositionParam):
         symbol, token_id, israw = param.symbol, param.token_id, param.israw
-        base_coin = symbol.split('_')[0].upper()
-        quote_coin = symbol.split('_')[1].upper()
-
-        base_token_decimal = self.market_info_map.get(base_coin)['decimals']
-        quote_token_decimal = self.market_info_map.get(quote_coin)['decimals']
-        address = self.market_info_map.get(symbol)['id']
-        symbol_pool_address = Web3.toChecksumAddress(address)
-        print(111)
-        position_info = self._query_get_lp_position(token_id)
+        # 池子状态按区块缓存，同一个区块里的多个 position 查询只读一次 getPoolState/getLiquidityState
+        pool_address = self.markets.market(symbol).pool
+        block = self.pool_state_cache.block_number()
+        position_info = self._query_get_lp_position(token_id, block)
+        pool_state = None
         try:
-            poolId = position_info[0][2]
-            # feetier = position_info[4]
-            tickLower = position_info[0][3]
-            tickUpper = position_info[0][4]
-            liquidity = position_info[0][5]
-            rTokenOwed = position_info[0][6]
-            feeGrowthInsideLast = position_info[0][7]
-
-            token0 = position_info[1][0]
-            fee = position_info[1][1]
-            token1 = position_info[1][2]
-            print(tickUpper, base_token_decimal, quote_token_decimal)
-            lowerPrice = tick2price(tickUpper, base_token_decimal, quote_token_decimal)
-            upperPrice = tick2price(tickLower, base_token_decimal, quote_token_decimal)
-            # quote_computed, base_computed = get_amounts_for_liquidity(quote_token_price, lowerPrice, upperPrice, liquidity)
-            # if not israw:
-            #     base_token_fee_amout, quote_token_fee_amount, _base_coin, _quote_coin = self._query_get_collect_fee(
-            #         param)
-            #     base_computed = base_computed + base_token_fee_amout
-            #     quote_computed = quote_computed + quote_token_fee_amount
-            result = {
-                'poolId': poolId,
-                'base_coin': base_coin,
-                'quote_coin': quote_coin,
-                # 'base_amount': base_computed,
-                # 'quote_amount': quote_computed,
-                'lowerPrice': lowerPrice,
-                'upperPrice': upperPrice,
-                'liquidity': liquidity,
-                'rTokenOwed': rTokenOwed,
-                'token0': token0,
-                'fee': fee,
-                'token1': token1,
-                'feeGrowthInsideLast': feeGrowthInsideLast,
-                'symbol_pool_address': symbol_pool_address
-            }
+            pool_state = self.pool_state_cache.get(pool_address, block)
+        except Exception as e:
+            # 池子状态读不到时不影响 position 查询，结果里只是没有数量
+            print(e)
+        try:
+            fees = None
+            if not israw:
+                fees = self.fee_reader.read({token_id: position_info}, [pool_address], block)[token_id]
+            result = self._format_position(symbol, position_info, pool_state, fees)
             print(result)
             return result
         except Exception as e:
@@ -172,8 +448,70 @@ class Kyberswapv3f3000ApiTrade():
             print(position_info)
             return position_info
 
-    def _query_get_lp_position(self, token_id):
-        positions_info = self.v3_nft_manager.functions.positions(token_id).call()
+    def query_get_positions(self, symbol: str, token_ids: List[int], block: BlockIdentifier = 'latest',
+                            chunk_size: int = MULTICALL_CHUNK_SIZE, israw: bool = True):
+        """
+        批量查询同一个池子的多个 position，positions() 和池子的 getPoolState/getLiquidityState 一起打包进 multicall，
+        所有结果固定在同一个区块。返回 {token_id: result}，result 和 query_get_position 相同。
+        israw=False 时再用一次 multicall（同一个区块）读手续费输入，全部 position 的未领取手续费一起算
+        """
+        pool_address = self.markets.market(symbol).pool
+        calls = self.pool_state_cache.calls(pool_address)
+        n_pool_calls = len(calls)
+        calls.extend((self.UNIS_V3_NFT_MANAGER_ADDRESS, encode_positions(token_id)) for token_id in token_ids)
+        multicall = Multicall(self.sync_w3, chunk_size=chunk_size)
+        block_number, results = multicall.aggregate(calls, block=block)
+
+        pool_state = self.pool_state_cache.decode(pool_address, block_number, *results[:n_pool_calls])
+        if pool_state is not None:
+            self.pool_state_cache.put(pool_address, pool_state)
+        positions_types = output_types(self.v3_nft_manager, "positions")
+        infos = {token_id: multicall.decode(positions_types, result)
+                 for token_id, result in zip(token_ids, results[n_pool_calls:])}
+        found = {token_id: info for token_id, info in infos.items() if info is not None}
+        fees = {}
+        if not israw and found:
+            fees = FeeReader(self.sync_w3, multicall, self.UNI_V3_FACTORY_ADDRESS).read(
+                found, [pool_address] * len(found), block_number)
+        return {token_id: None if info is None else self._format_position(symbol, info, pool_state,
+                                                                          fees.get(token_id))
+                for token_id, info in infos.items()}
+
+    def portfolio(self, owner=None, start: bool = True) -> PortfolioValuer:
+        """owner（默认自己）全部 position 的常驻估值，先估一次，start 时每个新区块只重算价格动了的池子"""
+        valuer = PortfolioValuer(self.sync_w3, self.UNIS_V3_NFT_MANAGER_ADDRESS, self.markets)
+        valuer.load(owner or self.address)
+        valuer.refresh()
+        return valuer.start() if start else valuer
+
+    def query_get_uncollected_fees(self, token_ids: List[int], block: BlockIdentifier = 'latest'
+                                   ) -> Dict[int, PositionFees]:
+        """
+        多个 position 的未领取手续费 {token_id: PositionFees(rToken, amount0, amount1)}，不需要在同一个池子。
+        positions() 一次 multicall，所有池子的手续费输入再一次 multicall，两次固定在同一个区块
+        """
+        if block == 'latest':
+            block = self.pool_state_cache.block_number()
+        positions_info = self._query_get_lp_positions(token_ids, block)
+        return self.fee_reader.read(positions_info, [self._position_pool(info) for info in positions_info.values()],
+                                    block)
+
+    def _query_get_lp_positions(self, token_ids: List[int], block: BlockIdentifier = 'latest'):
+        """多个 token 的原始 positions() 结果，一次 multicall，{token_id: position_info}"""
+        multicall = Multicall(self.sync_w3)
+        _, results = multicall.aggregate(
+            [(self.UNIS_V3_NFT_MANAGER_ADDRESS, encode_positions(token_id)) for token_id in token_ids], block=block)
+        positions_types = output_types(self.v3_nft_manager, "positions")
+        positions = {}
+        for token_id, result in zip(token_ids, results):
+            position_info = multicall.decode(positions_types, result)
+            if position_info is None:
+                raise Exception(f"positions({token_id}) call failed")
+            positions[token_id] = position_info
+        return positions
+
+    def _query_get_lp_position(self, token_id, block: BlockIdentifier = 'latest'):
+        positions_info = self.v3_nft_manager.functions.positions(token_id).call(block_identifier=block)
         print(positions_info)
         return positions_info
 
@@ -204,116 +542,100 @@ class Kyberswapv3f3000ApiTrade():
     #     return pool_address
 
 
-    # slippageTolerance not used,
-    def add_position(self, param: KyberswapNewLiquidityParam):
-        symbol = param.symbol
-        quote_amountDesired = param.quote_amountDesired
-        # lowerPrice = param.lowerPrice
-        # upperPrice = param.upperPrice
-        tickLower = param.tickLower
-        tickUpper = param.tickUpper
-        base_amountDesired = param.base_amountDesired
-        base_amountMin = param.base_amountMin
-        quote_amountMin = param.quote_amountMin
+    @property
+    def tx_pipeline(self) -> TxPipeline:
+        """submit_* 用的发送/确认/替换流水线，第一次用时启动后台线程"""
+        if self._tx_pipeline is None:
+            self._tx_pipeline = TxPipeline(self.sync_w3, self.wallet_private_key, self.nonce_manager,
+                                           self.fee_engine).start()
+        return self._tx_pipeline
 
-        deadline = int(time.time() + 10 ** 3)
-        fee = self.market_info_map.get(symbol)['feeTier']
-        base_coin = symbol.split('_')[0].upper()
-        quote_coin = symbol.split('_')[1].upper()
-        address = self.market_info_map.get(symbol)['id']
-        # symbol_pool_address = Web3.toChecksumAddress(address)
-        recipient = self.address
-        base_token_addr = Web3.toChecksumAddress(self.market_info_map.get(base_coin)['id'])
+    @property
+    def signer(self) -> SigningService:
+        """批量交易用的多进程签名服务，第一次用时启动进程池"""
+        if self._signer is None:
+            self._signer = SigningService([self.wallet_private_key]).start()
+        return self._signer
 
-        quote_token_addr = Web3.toChecksumAddress(self.market_info_map.get(quote_coin)['id'])
-        base_token_decimal = self.market_info_map.get(base_coin)['decimals']
-        quote_token_decimal = self.market_info_map.get(quote_coin)['decimals']
-        # tickLower = price2tick(upperPrice, base_token_decimal=base_token_decimal,
-        #                        quote_token_decimal=quote_token_decimal)
-        # tickUpper = price2tick(lowerPrice, base_token_decimal=base_token_decimal,
-        #                        quote_token_decimal=quote_token_decimal)
-        # if not base_amountDesired:
-        #     base_amountDesired = compute_base_amount_from_quote_amount(quote_amountDesired, price=quote_token_price,
-        #                                                                low=lowerPrice,
-        #                                                                high=upperPrice)
-        base_amountDesired = int(base_amountDesired * 10 ** base_token_decimal)
-        quote_amountDesired = int(quote_amountDesired * 10 ** quote_token_decimal)
-        ticksPrevious = [tickLower, tickUpper]
-        args = ((base_token_addr, quote_token_addr, fee, tickLower, tickUpper, ticksPrevious, base_amountDesired,
-                 quote_amountDesired,
-                 base_amountMin, quote_amountMin, recipient, deadline),)
-        print(args)
-        hex_str = self.v3_nft_manager.encodeABI("mint", args=args)
-        refund_hex_str = self.v3_nft_manager.encodeABI("refundEth")
-        result = self.v3_nft_manager.functions.multicall([hex_str, refund_hex_str])
-        if Web3.toChecksumAddress(base_token_addr) == Web3.toChecksumAddress(self.market_info_map['ETH']['id']):
-            value = base_amountDesired
-        elif Web3.toChecksumAddress(quote_token_addr) == Web3.toChecksumAddress(self.market_info_map['ETH']['id']):
-            value = quote_amountDesired
-        else:
-            value = 0
-        current_nonce = self.w3.eth.get_transaction_count(self.address)
-        tx_patams = {
+    def _nft_manager_tx(self, multicall_list, value) -> TxParams:
+        return {
             "from": _addr_to_str(self.address),
+            "to": self.v3_nft_manager.address,
+            "data": encode_multicall(multicall_list),
             "value": value,
-            # "gas": Wei(880000),
-            # "gasPrice": self.w3.toWei(12,"gwei"), gasPrice不填默认使用全网平均价
-            "nonce": max(self.last_nonce, current_nonce)
         }
-        tx = self._build_and_send_tx(result, tx_patams)
-        increase_result = {
-            'txn_hash': tx.hex(),
-            'ori_base_amount': base_amountDesired / 10 ** base_token_decimal,
-            'ori_quote_amount': quote_amountDesired / 10 ** quote_token_decimal,
-            'tickLower': tickLower,
-            'tickUpper': tickUpper,
-            'ticksPrevious': [tickLower, tickUpper],
-            # 'lowerPrice': lowerPrice,
-            # 'upperPrice': upperPrice,
+
+    def submit_add_position(self, param: KyberswapNewLiquidityParam) -> Future:
+        """
+        不等发送和上链，马上返回 Future，结果是 add_position 的返回值加上 receipt。
+        发送在流水线的后台线程里按提交顺序进行，几个区块没上链会自动加价替换
+        """
+        def build():
+            multicall_list, value, increase_result = self._add_position_calls(param)
+            return self._nft_manager_tx(multicall_list, value), increase_result
+        return self.tx_pipeline.submit(build)
+
+    def submit_remove_position(self, param: KyberswapRemovePositionParam) -> Future:
+        """同 submit_add_position，position 的查询也放在后台线程里"""
+        def build():
+            token_id, reduce_percent, burn = param.token_id, param.reduce_percent, param.burn
+            position_info = self._query_get_lp_position(token_id)
+            multicall_list, liquidity = self._remove_position_calls(token_id, position_info, reduce_percent, burn)
+            return self._nft_manager_tx(multicall_list, 0), {'token_id': token_id, 'remove_liquidity': liquidity}
+        return self.tx_pipeline.submit(build)
+
+    def rebalance_positions(self, params: List[KyberswapRebalanceParam], gas_cap: int = REBALANCE_GAS_CAP):
+        """
+        批量移仓：每个 param 移除 token_id 的 reduce_percent 流动性（可选 burn），再按 new_position 建新仓位，
+        全部装进尽量少的 NFT manager multicall 交易（每笔估算 gas 不超过 gas_cap）。
+        position 一次 multicall 读完，返回每笔交易的 {'txn_hash', 'positions': [每个 param 的结果]}
+        """
+        positions_info = self._query_get_lp_positions([param.token_id for param in params])
+        txs = list(self._rebalance_txs(params, positions_info, self.fee_engine.gas_models.estimate, gas_cap))
+        tx_hashes = self._build_and_send_txs([self._nft_manager_tx(multicall_list, value)
+                                              for multicall_list, value, _ in txs])
+        return [{'txn_hash': tx_hash.hex(), 'positions': op_results}
+                for tx_hash, (_, _, op_results) in zip(tx_hashes, txs)]
+
+    def submit_rebalance_positions(self, params: List[KyberswapRebalanceParam],
+                                   gas_cap: int = REBALANCE_GAS_CAP) -> List[Future]:
+        """rebalance_positions 的流水线版本，每笔交易一个 Future，结果是 {'positions', 'txn_hash', 'receipt'}"""
+        positions_info = self._query_get_lp_positions([param.token_id for param in params])
+        futures = []
+        for multicall_list, value, op_results in self._rebalance_txs(
+                params, positions_info, self.fee_engine.gas_models.estimate, gas_cap):
+            tx_params = self._nft_manager_tx(multicall_list, value)
+            futures.append(self.tx_pipeline.submit(
+                lambda tx_params=tx_params, op_results=op_results: (tx_params, {'positions': op_results})))
+        return futures
+
+    # slippageTolerance not used,
+    def add_position(self, param: KyberswapNewLiquidityParam):
+        multicall_list, value, increase_result = self._add_position_calls(param)
+        tx_patams = {
+            "from": _addr_to_str(self.address),
+            "to": self.v3_nft_manager.address,
+            "data": encode_multicall(multicall_list),
+            "value": value,
+            # gas / maxFeePerGas / maxPriorityFeePerGas 由 fee_engine 填
+            "nonce": self.nonce_manager.allocate()
         }
+        tx = self._build_and_send_tx(None, tx_patams)
+        increase_result['txn_hash'] = tx.hex()
         return increase_result
 
     def remove_position(self, param: KyberswapRemovePositionParam):
         token_id, reduce_percent, burn = param.token_id, param.reduce_percent, param.burn
-        multicall_list = []
         position_info = self._query_get_lp_position(token_id)
-        # [0, '0x0000000000000000000000000000000000000000', '0x07865c6E87B9F70255377e024ace6630C1Eaa37F', '0xc778417E063141139Fce010982780140Aa0cD5Ab', 3000, 197880, 198600, 447150632383970, 0, 0, 0, 0]
-        liquidity = int(position_info[0][5] * reduce_percent * 0.01)
-        base_token = Web3.toChecksumAddress(position_info[1][0])
-        quote_token = Web3.toChecksumAddress(position_info[1][2])
-        base_amountMin = 0
-        quote_amountMin = 0
-        collect_base_amountMax = self.max_128_int
-        collect_quote_amountMax = self.max_128_int
-        deadline = int(time.time() + 10 ** 3)
-        decrease_params = ((token_id, liquidity, base_amountMin, quote_amountMin, deadline),)
-        dec_hex_str = self.v3_nft_manager.encodeABI("removeLiquidity", args=decrease_params)
-        multicall_list.append(dec_hex_str)
-
-        if base_token == Web3.toChecksumAddress(self.market_info_map['ETH']['id']):
-            unwrapWeth_params = (0, self.address)
-            unwrap_hex_str = self.v3_nft_manager.encodeABI("unwrapWeth", args=unwrapWeth_params)
-            multicall_list.append(unwrap_hex_str)
-        elif quote_token == Web3.toChecksumAddress(self.market_info_map['ETH']['id']):
-            unwrapWeth_params = (0, self.address)
-            unwrap_hex_str = self.v3_nft_manager.encodeABI("unwrapWeth", args=unwrapWeth_params)
-            multicall_list.append(unwrap_hex_str)
-        else:
-            pass
-        if burn:
-            burn_hex_str = self.v3_nft_manager.encodeABI("burn", args=(token_id,))
-            multicall_list.append(burn_hex_str)
-        result = self.v3_nft_manager.functions.multicall(multicall_list)
-        current_nonce = self.w3.eth.get_transaction_count(self.address)
-
+        multicall_list, liquidity = self._remove_position_calls(token_id, position_info, reduce_percent, burn)
         tx_patams = {
             "from": _addr_to_str(self.address),
+            "to": self.v3_nft_manager.address,
+            "data": encode_multicall(multicall_list),
             "value": 0,
-            "gas": Wei(22500),
-            # "gasPrice": self.w3.toWei(88,"gwei"), #gasPrice不填默认使用全网平均价
-            "nonce": max(self.last_nonce, current_nonce)
+            "nonce": self.nonce_manager.allocate()
         }
-        tx = self._build_and_send_tx(result, tx_patams)
+        tx = self._build_and_send_tx(None, tx_patams)
         print(tx)
         remove_result = {
             'txn_hash': tx.hex(),
@@ -324,34 +646,64 @@ class Kyberswapv3f3000ApiTrade():
 
     def _get_tx_params(self, value: Wei = Wei(0), gas: Wei = Wei(25000)) -> TxParams:
         """Get generic transaction parameters."""
-        current_nonce = self.w3.eth.get_transaction_count(self.address)
 
         return {
             "from": _addr_to_str(self.address),
             "value": value,
             "gas": gas,
             # "gasPrice": self.w3.toWei(12,"gwei"),
-            "nonce": max(self.last_nonce, current_nonce)
+            "nonce": self.nonce_manager.allocate()
         }
 
     def _build_and_send_tx(
-            self, function: ContractFunction, tx_params: Optional[TxParams] = None
+            self, function: Optional[ContractFunction], tx_params: Optional[TxParams] = None
     ) -> HexBytes:
-        """Build and send a transaction."""
+        """Build and send a transaction. With no `function`, tx_params must already carry `to` and `data`."""
         if not tx_params:
             tx_params = self._get_tx_params()
-        transaction = function.buildTransaction(tx_params)
-        # transaction['gas'] = self.sync_w3.eth.estimateGas(transaction)
-        signed_txn = self.sync_w3.eth.account.sign_transaction(
-            transaction, private_key=self.wallet_private_key
-        )
-        # TODO: This needs to get more complicated if we want to support replacing a transaction
-        # FIXME: This does not play nice if transactions are sent from other places using the same wallet.
+        # 发出去就返回 hash，不跟踪上链和替换；需要这些时用 submit_* (tx_pipeline)
         try:
-            return self.sync_w3.eth.send_raw_transaction(signed_txn.rawTransaction)
-        finally:
-            self.last_nonce = Nonce(tx_params["nonce"] + 1)
+            if function is None:
+                transaction = fill_transaction_defaults(self.sync_w3, self.fee_engine.fill(tx_params))
+            else:
+                transaction = function.buildTransaction(tx_params)
+            # transaction['gas'] = self.sync_w3.eth.estimateGas(transaction)
+            signed_txn = self.sync_w3.eth.account.sign_transaction(
+                transaction, private_key=self.wallet_private_key
+            )
+            tx_hash = self.sync_w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+        except Exception:
+            # 没发出去的 nonce 还给 nonce_manager
+            self.nonce_manager.release(tx_params["nonce"])
+            raise
+        self.nonce_manager.mark_sent(tx_params["nonce"])
+        if function is None:
+            self.fee_engine.track(tx_hash, transaction)
+        return tx_hash
 
+    def _build_and_send_txs(self, tx_params_list: List[TxParams]) -> List[HexBytes]:
+        """
+        一批已经带 to/data 的交易：连续分配 nonce、填 gas 和手续费，signer 多进程一起签，再按 nonce 顺序发送。
+        某一笔发送失败时它和后面没发的 nonce 都还回去，异常往上抛
+        """
+        nonces = [self.nonce_manager.allocate() for _ in tx_params_list]
+        sent = 0
+        try:
+            transactions = [fill_transaction_defaults(self.sync_w3, self.fee_engine.fill(dict(tx_params, nonce=nonce)))
+                            for tx_params, nonce in zip(tx_params_list, nonces)]
+            raw_txs = self.signer.sign_many(transactions)
+            tx_hashes = []
+            for transaction, raw_tx in zip(transactions, raw_txs):
+                tx_hash = self.sync_w3.eth.send_raw_transaction(raw_tx)
+                self.nonce_manager.mark_sent(transaction['nonce'])
+                self.fee_engine.track(tx_hash, transaction)
+                tx_hashes.append(tx_hash)
+                sent += 1
+        except Exception:
+            for nonce in reversed(nonces[sent:]):
+                self.nonce_manager.release(nonce)
+            raise
+        return tx_hashes
 
 if __name__ == '__main__':
     RPC_URL = 'https://mainnet.infura.io/v3/2e9062cf4c124537a722b068f2f40a0a'
@@ -363,6 +715,7 @@ if __name__ == '__main__':
         secret_key=SECRET_KEY,
         uniswapv3_rpc_url=RPC_URL
     )
+    print(uni_cli.list_positions())
     result2 = uni_cli.query_get_position(KyberswapPositionParam(token_id=75, symbol='ETH_USDT', israw=False))
     # result2 = uni_cli.remove_position(KyberswapRemovePositionParam(token_id=75, reduce_percent=100, burn=False))
     # result2 = uni_cli.add_position(KyberswapNewLiquidityParam(
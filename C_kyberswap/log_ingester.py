@@ -0,0 +1,314 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+池子 Swap/Mint/Burn/BurnRTokens 历史日志的分段拉取，可以断点续传。
+
+    ingester = LogIngester(w3, ['ETH_USDT'], start_block=15000000, checkpoint_path='eth_usdt.ckpt')
+    for record in ingester:
+        ...
+
+每段区块范围一次 eth_getLogs（所有池子、四种事件一起拉）：节点报结果太多就把范围减半重试，
+结果稀疏就把范围翻倍，尽量贴着节点的上限跑。限流（HTTP 429、rate limit / 请求数超额）和结果太多分开处理：
+按指数退避等一会再拉同一段，不缩小范围。每段的记录全部 yield 完之后才写 checkpoint，
+进程挂掉重启后从 checkpoint 的下一段开始，最多重拉没处理完的那一段。
+"""
+import functools
+import json
+import os
+import re
+import time
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from eth_utils import event_abi_to_log_topic
+from hexbytes import HexBytes
+from requests.exceptions import HTTPError, Timeout
+from web3 import Web3
+from web3.types import BlockIdentifier, RPCEndpoint
+from constant import MARKET_INFO_DICT
+from utils import _load_abi_json
+
+LOG_SPAN_INITIAL = 2000
+LOG_SPAN_MAX = 100000
+# 一次返回的日志条数目标，常见节点的上限是 10000 条
+LOG_TARGET_COUNT = 5000
+# 限流时的退避：第一次等 RATE_LIMIT_DELAY_MIN 秒，每次翻倍，连续 RATE_LIMIT_RETRIES 次都被限流就抛异常
+RATE_LIMIT_DELAY_MIN = 1.0
+RATE_LIMIT_DELAY_MAX = 60.0
+RATE_LIMIT_RETRIES = 8
+# 节点返回结果条数或区块范围超限时的关键字，只认这两类，限流/额度的 "exceeded" 不算
+_TOO_MANY_PATTERNS = re.compile(
+    r"more than \d+ results|too many (results|logs)|response size|block range|range is too (large|wide)|"
+    r"range (should|must) (not exceed|be less)|limited to (a )?[\d,]+ (block )?range", re.IGNORECASE)
+# 限流或额度用完，换小范围没用，等一会再试同一段
+_RATE_LIMIT_PATTERNS = re.compile(
+    r"rate limit|too many requests|request count exceeded|request rate exceeded|exceeded .*capacity|"
+    r"compute units|throughput|quota", re.IGNORECASE)
+# alchemy 等节点会在错误里给出可以用的范围: [0x..., 0x...]
+_SUGGESTED_RANGE = re.compile(r"\[(0x[0-9a-fA-F]+),\s*(0x[0-9a-fA-F]+)\]")
+# classify_log_error 的分类
+TOO_MANY_RESULTS = 'too_many_results'
+RATE_LIMITED = 'rate_limited'
+
+
+class SwapLog(NamedTuple):
+    symbol: str
+    blockNumber: int
+    transactionHash: str
+    logIndex: int
+    sender: str
+    recipient: str
+    amount0: int
+    amount1: int
+    sqrtPriceX96: int
+    liquidity: int
+    tick: int
+
+
+class MintLog(NamedTuple):
+    symbol: str
+    blockNumber: int
+    transactionHash: str
+    logIndex: int
+    sender: str
+    owner: str
+    tickLower: int
+    tickUpper: int
+    amount: int
+    amount0: int
+    amount1: int
+
+
+class BurnLog(NamedTuple):
+    symbol: str
+    blockNumber: int
+    transactionHash: str
+    logIndex: int
+    owner: str
+    tickLower: int
+    tickUpper: int
+    amount: int
+    amount0: int
+    amount1: int
+
+
+class BurnRTokensLog(NamedTuple):
+    """Elastic 没有 Collect：手续费是 reinvest 的 rToken，领取时 burnRTokens 换成两个 token"""
+    symbol: str
+    blockNumber: int
+    transactionHash: str
+    logIndex: int
+    owner: str
+    amount: int
+    amount0: int
+    amount1: int
+
+
+POOL_EVENT_RECORDS = {'Swap': SwapLog, 'Mint': MintLog, 'Burn': BurnLog, 'BurnRTokens': BurnRTokensLog}
+# Elastic 事件参数名 -> record 字段名，record 沿用 Uniswap v3 的命名，顺序和类型不变
+_FIELD_NAMES = {'qty': 'amount', 'qty0': 'amount0', 'qty1': 'amount1', 'deltaQty0': 'amount0',
+                'deltaQty1': 'amount1', 'sqrtP': 'sqrtPriceX96', 'currentTick': 'tick'}
+
+
+def classify_log_error(error) -> Tuple[Optional[str], Optional[int]]:
+    """
+    eth_getLogs 返回的 JSON-RPC error：结果太多/范围太大是 (TOO_MANY_RESULTS, 建议的 to_block 或 None)，
+    限流是 (RATE_LIMITED, None)，其他错误 (None, None)
+    """
+    message = error.get('message', '') if isinstance(error, dict) else str(error)
+    code = error.get('code') if isinstance(error, dict) else None
+    if _TOO_MANY_PATTERNS.search(message):
+        suggested = _SUGGESTED_RANGE.search(message)
+        return TOO_MANY_RESULTS, int(suggested.group(2), 16) if suggested else None
+    # infura 的 -32005 既用于结果太多也用于限流，不带结果条数的就是限流
+    if code in (429, -32005) or _RATE_LIMIT_PATTERNS.search(message):
+        return RATE_LIMITED, None
+    return None, None
+
+
+@functools.lru_cache(maxsize=4096)
+def _checksum(address: str) -> str:
+    return Web3.toChecksumAddress(address)
+
+
+class EventDecoder():
+    """
+    一种事件的原始日志 -> NamedTuple。同一种事件的一批日志拼在一起只调一次 decode_abi，
+    事件参数都是定长类型，N 条日志的 data 就是 N 份参数类型连在一起的编码。
+    """
+
+    def __init__(self, w3: Web3, event_abi: dict, record_type):
+        self.w3 = w3
+        self.record_type = record_type
+        self.topic = HexBytes(event_abi_to_log_topic(event_abi))
+        inputs = event_abi['inputs']
+        self.indexed_types = [i['type'] for i in inputs if i['indexed']]
+        self.data_types = [i['type'] for i in inputs if not i['indexed']]
+        # record 字段顺序和 abi 一致，解码结果按这个顺序重新拼
+        self._order = []
+        indexed_i = data_i = 0
+        for i in inputs:
+            if i['indexed']:
+                self._order.append((True, indexed_i, i['type'] == 'address'))
+                indexed_i += 1
+            else:
+                self._order.append((False, data_i, i['type'] == 'address'))
+                data_i += 1
+        names = [_FIELD_NAMES.get(i['name'], i['name']) for i in inputs]
+        if list(record_type._fields[4:]) != names:
+            raise Exception(f"{record_type.__name__} fields {record_type._fields[4:]} do not match abi {names}")
+
+    def _decode_columns(self, types: List[str], blobs: List[bytes]) -> List[tuple]:
+        if not types:
+            return [()] * len(blobs)
+        width = len(types)
+        flat = self.w3.codec.decode_abi(types * len(blobs), b''.join(blobs))
+        return [flat[i:i + width] for i in range(0, len(flat), width)]
+
+    def decode(self, logs: List[dict], symbols: Dict[str, str]) -> List[NamedTuple]:
+        """logs 是 eth_getLogs 的原始结果（hex 字符串），symbols 是 池子地址小写 -> symbol"""
+        data = self._decode_columns(self.data_types, [HexBytes(log['data']) for log in logs])
+        indexed = self._decode_columns(self.indexed_types,
+                                       [b''.join(HexBytes(t) for t in log['topics'][1:]) for log in logs])
+        records = []
+        for log, data_values, indexed_values in zip(logs, data, indexed):
+            values = []
+            for is_indexed, i, is_address in self._order:
+                value = indexed_values[i] if is_indexed else data_values[i]
+                values.append(_checksum(value) if is_address else value)
+            records.append(self.record_type(
+                symbols[log['address'].lower()],
+                int(log['blockNumber'], 16) if isinstance(log['blockNumber'], str) else log['blockNumber'],
+                HexBytes(log['transactionHash']).hex(),
+                int(log['logIndex'], 16) if isinstance(log['logIndex'], str) else log['logIndex'],
+                *values))
+        return records
+
+
+def pool_event_decoders(w3: Web3, events=tuple(POOL_EVENT_RECORDS)) -> Dict[HexBytes, EventDecoder]:
+    """
+    topic0 -> EventDecoder，事件定义取自 ElasticPool abi。Swap/Mint/Burn 的 topic 和 Uniswap v3 相同，
+    Elastic 池子不发 Collect，领手续费对应的是 BurnRTokens
+    """
+    abi = {item['name']: item for item in _load_abi_json("ElasticPool") if item.get('type') == 'event'}
+    decoders = {}
+    for name in events:
+        decoder = EventDecoder(w3, abi[name], POOL_EVENT_RECORDS[name])
+        decoders[decoder.topic] = decoder
+    return decoders
+
+
+class LogIngester():
+    """
+    symbols 是 MARKET_INFO_DICT['kyberswapv3'] 里的池子名（如 'ETH_USDT'），迭代得到按 (区块, logIndex) 排序的
+    SwapLog/MintLog/BurnLog/BurnRTokensLog。end_block 为 'latest' 时在开始迭代时取一次当前区块减 confirmations。
+    """
+
+    def __init__(self, w3: Web3, symbols: List[str], start_block: int = 0, end_block: BlockIdentifier = 'latest',
+                 checkpoint_path: Optional[str] = None, events=tuple(POOL_EVENT_RECORDS),
+                 span: int = LOG_SPAN_INITIAL, max_span: int = LOG_SPAN_MAX, target_count: int = LOG_TARGET_COUNT,
+                 confirmations: int = 0):
+        market_info = MARKET_INFO_DICT['kyberswapv3']
+        self.w3 = w3
+        self.symbols = {market_info[symbol]['id'].lower(): symbol for symbol in symbols}
+        self.addresses = [_checksum(address) for address in self.symbols]
+        self.decoders = pool_event_decoders(w3, events)
+        self.start_block = start_block
+        self.end_block = end_block
+        self.checkpoint_path = checkpoint_path
+        self.span = span
+        self.max_span = max_span
+        self.target_count = target_count
+        self.confirmations = confirmations
+        self.next_block = start_block
+        self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if sorted(checkpoint.get('addresses', [])) != sorted(self.addresses):
+            raise Exception(f"checkpoint {self.checkpoint_path} was written for other pools")
+        self.next_block = max(self.next_block, checkpoint['next_block'])
+        self.span = checkpoint.get('span', self.span)
+
+    def _save_checkpoint(self):
+        if self.checkpoint_path is None:
+            return
+        tmp_path = f"{self.checkpoint_path}.{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump({'next_block': self.next_block, 'span': self.span, 'addresses': self.addresses}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _get_logs(self, from_block: int, to_block: int):
+        """
+        原始 eth_getLogs，不经过 web3 的结果格式化（逐条转 AttributeDict/HexBytes 在大批量时很慢）。
+        返回 (logs, None)，范围太大时返回 (None, 建议的 to_block 或 None)。被限流时在这里退避重试同一段
+        """
+        params = {
+            'address': self.addresses,
+            'fromBlock': hex(from_block),
+            'toBlock': hex(to_block),
+            'topics': [[decoder.topic.hex() for decoder in self.decoders.values()]],
+        }
+        delay = RATE_LIMIT_DELAY_MIN
+        for _ in range(RATE_LIMIT_RETRIES):
+            try:
+                response = self.w3.provider.make_request(RPCEndpoint('eth_getLogs'), [params])
+            except Timeout:
+                return None, None
+            except HTTPError as e:
+                if e.response is None or e.response.status_code != 429:
+                    raise
+                response = {'error': {'code': 429, 'message': str(e)}}
+            if 'error' not in response:
+                return response['result'], None
+            error = response['error']
+            kind, suggested = classify_log_error(error)
+            if kind == TOO_MANY_RESULTS:
+                return None, suggested
+            if kind != RATE_LIMITED:
+                raise ValueError(error)
+            print(f"eth_getLogs [{from_block}, {to_block}] rate limited: {error}, retrying in {delay}s")
+            time.sleep(delay)
+            delay = min(delay * 2, RATE_LIMIT_DELAY_MAX)
+        raise ValueError(f"eth_getLogs [{from_block}, {to_block}] still rate limited after {RATE_LIMIT_RETRIES} tries")
+
+    def decode(self, logs: List[dict]) -> List[NamedTuple]:
+        """按事件分组批量解码，再按 (区块, logIndex) 排回原来的顺序"""
+        groups = {}
+        for log in logs:
+            if log.get('removed'):
+                continue
+            groups.setdefault(HexBytes(log['topics'][0]), []).append(log)
+        records = []
+        for topic, group in groups.items():
+            records.extend(self.decoders[topic].decode(group, self.symbols))
+        records.sort(key=lambda record: (record.blockNumber, record.logIndex))
+        return records
+
+    def __iter__(self) -> Iterator[NamedTuple]:
+        end_block = self.end_block
+        if end_block == 'latest':
+            end_block = self.w3.eth.block_number - self.confirmations
+        while self.next_block <= end_block:
+            from_block = self.next_block
+            to_block = min(from_block + self.span - 1, end_block)
+            logs, suggested = self._get_logs(from_block, to_block)
+            if logs is None:
+                if to_block == from_block:
+                    raise Exception(f"too many logs in block {from_block}, cannot split further")
+                if suggested is not None and from_block <= suggested < to_block:
+                    self.span = suggested - from_block + 1
+                else:
+                    self.span = max((to_block - from_block + 1) // 2, 1)
+                continue
+            yield from self.decode(logs)
+            # 这一段全部交给调用方之后才推进 checkpoint
+            self.next_block = to_block + 1
+            if len(logs) > self.target_count:
+                self.span = max(self.span // 2, 1)
+            elif len(logs) < self.target_count // 2 and to_block - from_block + 1 == self.span:
+                self.span = min(self.span * 2, self.max_span)
+            self._save_checkpoint()
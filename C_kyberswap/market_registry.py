@@ -0,0 +1,139 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MARKET_INFO_DICT 预处理成的只读注册表，进程里第一次用到时构建一次。
+
+地址统一预先算好 checksum 字符串和 20 字节 bytes，查询只剩几次 dict 查找：
+    registry = get_market_registry()
+    market = registry.market('ETH_USDT')              # Market: base/quote Token、pool 地址、fee、token0/token1
+    registry.token('USDT').decimals
+    registry.token_by_address('0xdac17f958d2ee523a2206206994597c13d831ec7')
+    registry.pool(usdt, weth, 3000)                   # 两个 token 不分顺序
+    registry.elastic_pool(usdt, weth, 300)            # positions() 返回的 Elastic fee（十万分之一）
+    registry.is_weth(token_address)
+
+地址 key 是 20 字节 bytes，字符串地址不区分大小写，不需要先转 checksum。
+"""
+import functools
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+from web3 import Web3
+from constant import MARKET_INFO_DICT
+
+WETH_SYMBOL = 'ETH'
+# MARKET_INFO_DICT 的 feeTier 是百万分之一，Elastic 合约（positions()、swapFeeUnits）的 fee 是十万分之一
+FEE_TIER_PER_ELASTIC_FEE_UNIT = 10
+
+
+class Token(NamedTuple):
+    symbol: str
+    address: str          # checksum
+    address_bytes: bytes
+    decimals: int
+    is_weth: bool
+
+
+class Market(NamedTuple):
+    symbol: str           # 'ETH_USDT'
+    base: Token
+    quote: Token
+    pool: str             # checksum
+    pool_bytes: bytes
+    fee: int              # feeTier，百万分之一
+    token0: Token         # 按地址排序，和池子合约的 token0/token1 一致
+    token1: Token
+
+    @property
+    def base_is_token0(self) -> bool:
+        return self.base.address_bytes == self.token0.address_bytes
+
+    @property
+    def has_weth(self) -> bool:
+        return self.base.is_weth or self.quote.is_weth
+
+
+def address_key(address: Union[str, bytes]) -> bytes:
+    """'0x...'（任意大小写）或 20 字节地址 -> 20 字节 bytes"""
+    if isinstance(address, str):
+        return bytes.fromhex(address[2:] if address.startswith(('0x', '0X')) else address)
+    return bytes(address)
+
+
+class MarketRegistry():
+
+    def __init__(self, market_info: dict, weth_symbol: str = WETH_SYMBOL):
+        self._tokens = {}
+        self._tokens_by_address = {}
+        self._markets = {}
+        self._markets_by_pool = {}
+        self._markets_by_pair = {}
+        weth_key = address_key(market_info[weth_symbol]['id']) if weth_symbol in market_info else None
+        for symbol, info in market_info.items():
+            if 'decimals' not in info:
+                continue
+            key = address_key(info['id'])
+            token = Token(symbol, Web3.toChecksumAddress(info['id']), key, info['decimals'], key == weth_key)
+            self._tokens[symbol] = token
+            # client 一直用 symbol.upper() 查 token，大写也注册一份
+            self._tokens.setdefault(symbol.upper(), token)
+            # 同一个地址多个名字时（比如 ETH/WETH）保留第一个
+            self._tokens_by_address.setdefault(key, token)
+        for symbol, info in market_info.items():
+            if 'feeTier' not in info:
+                continue
+            base_symbol, quote_symbol = (s.upper() for s in symbol.split('_'))
+            base, quote = self._tokens.get(base_symbol), self._tokens.get(quote_symbol)
+            if base is None or quote is None:
+                raise Exception(f"market {symbol} references unknown token {base_symbol if base is None else quote_symbol}")
+            token0, token1 = sorted((base, quote), key=lambda t: t.address_bytes)
+            pool_key = address_key(info['id'])
+            market = Market(symbol, base, quote, Web3.toChecksumAddress(info['id']), pool_key, info['feeTier'],
+                            token0, token1)
+            self._markets[symbol] = market
+            self._markets_by_pool[pool_key] = market
+            self._markets_by_pair[(token0.address_bytes, token1.address_bytes, market.fee)] = market
+        self.weth = self._tokens_by_address.get(weth_key)
+
+    def market(self, symbol: str) -> Market:
+        market = self._markets.get(symbol)
+        if market is None:
+            raise KeyError(f"unknown market {symbol}")
+        return market
+
+    def markets(self) -> Dict[str, Market]:
+        return dict(self._markets)
+
+    def tokens(self) -> List[Token]:
+        """不重复的 token，同一个地址只出现一次"""
+        return list(self._tokens_by_address.values())
+
+    def token(self, symbol: str) -> Token:
+        token = self._tokens.get(symbol)
+        if token is None:
+            raise KeyError(f"unknown token {symbol}")
+        return token
+
+    def token_by_address(self, address: Union[str, bytes]) -> Optional[Token]:
+        return self._tokens_by_address.get(address_key(address))
+
+    def market_by_pool(self, pool_address: Union[str, bytes]) -> Optional[Market]:
+        return self._markets_by_pool.get(address_key(pool_address))
+
+    def pool(self, token_a: Union[str, bytes], token_b: Union[str, bytes], fee: int) -> Optional[Market]:
+        """(tokenA, tokenB, fee) 对应的已登记池子，token 不分顺序"""
+        return self._markets_by_pair.get(self.sorted_pair(token_a, token_b) + (fee,))
+
+    def elastic_pool(self, token_a: Union[str, bytes], token_b: Union[str, bytes], fee_units: int) -> Optional[Market]:
+        """同 pool，fee 是 Elastic 合约自己的单位（positions() 返回的 fee），先换成 feeTier 再查"""
+        return self.pool(token_a, token_b, fee_units * FEE_TIER_PER_ELASTIC_FEE_UNIT)
+
+    def is_weth(self, address: Union[str, bytes]) -> bool:
+        return self.weth is not None and address_key(address) == self.weth.address_bytes
+
+    def sorted_pair(self, token_a: Union[str, bytes], token_b: Union[str, bytes]) -> Tuple[bytes, bytes]:
+        key_a, key_b = address_key(token_a), address_key(token_b)
+        return (key_a, key_b) if key_a < key_b else (key_b, key_a)
+
+
+@functools.lru_cache()
+def get_market_registry(exchange: str = 'kyberswapv3') -> MarketRegistry:
+    return MarketRegistry(MARKET_INFO_DICT[exchange])
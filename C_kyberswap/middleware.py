@@ -0,0 +1,122 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+ETH_CALL_CACHE_SIZE = 4096
+HEAD_TTL = 1.0
+# 这些 tag 解析成当前区块号后再做 key，pending 是 mempool 状态，不缓存
+_HEAD_TAGS = ('latest', 'safe', 'finalized')
+
+
+class EthCallCacheMiddleware():
+    """
+    eth_call / eth_getCode / eth_chainId 的结果缓存，eth_call 的 key 是 (method, 区块号, from, to, value, data)：
+    collect/removeLiquidity 的静态调用、quoter 这类结果和 msg.sender / msg.value 有关，不同钱包的调用不能共用。
+
+    'latest' 先解析成当前区块号：最多每 head_ttl 秒调一次 eth_blockNumber，经过这个 middleware 的
+    eth_blockNumber 响应也会顺便更新。发现新区块后 'latest' 写进来的旧条目失效，
+    显式区块号的条目在区块内不会变，一直保留到 LRU 淘汰。
+
+        w3.middleware_onion.add(EthCallCacheMiddleware(), 'eth_call_cache')
+    """
+
+    def __init__(self, maxsize: int = ETH_CALL_CACHE_SIZE, head_ttl: float = HEAD_TTL):
+        self.maxsize = maxsize
+        self.head_ttl = head_ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._latest_keys = set()
+        self._head = None
+        self._head_time = 0.0
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache), 'head': self._head}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._latest_keys.clear()
+
+    def _set_head(self, head: int):
+        with self._lock:
+            if self._head is not None and head > self._head:
+                for key in self._latest_keys:
+                    self._cache.pop(key, None)
+                self._latest_keys.clear()
+            if self._head is None or head >= self._head:
+                self._head = head
+            self._head_time = time.monotonic()
+
+    def _resolve_block(self, block, make_request: Callable):
+        """Returns (block_number, resolved_from_tag), or (None, False) when the block must not be cached."""
+        if block is None:
+            block = 'latest'
+        if isinstance(block, int):
+            return block, False
+        if isinstance(block, str) and block.startswith('0x'):
+            return int(block, 16), False
+        if block in _HEAD_TAGS:
+            if self._head is None or time.monotonic() - self._head_time > self.head_ttl:
+                response = make_request('eth_blockNumber', [])
+                if 'result' not in response:
+                    return None, False
+                self._set_head(int(response['result'], 16) if isinstance(response['result'], str)
+                               else response['result'])
+            return self._head, True
+        return None, False
+
+    def _key(self, method: str, params: Any, make_request: Callable):
+        if method == 'eth_chainId':
+            return (method,), False
+        if method == 'eth_call':
+            tx = params[0]
+            block, from_tag = self._resolve_block(params[1] if len(params) > 1 else None, make_request)
+            if block is None or len(params) > 2:
+                # state override 之类的不缓存
+                return None, False
+            return (method, block, str(tx.get('from', '')).lower(), str(tx.get('to', '')).lower(),
+                    str(tx.get('value', 0)), str(tx.get('data', tx.get('input', '')))), from_tag
+        if method == 'eth_getCode':
+            block, from_tag = self._resolve_block(params[1] if len(params) > 1 else None, make_request)
+            if block is None:
+                return None, False
+            return (method, block, str(params[0]).lower()), from_tag
+        return None, False
+
+    def __call__(self, make_request: Callable, w3) -> Callable:
+        def middleware(method, params):
+            if method == 'eth_blockNumber':
+                response = make_request(method, params)
+                if 'result' in response:
+                    result = response['result']
+                    self._set_head(int(result, 16) if isinstance(result, str) else result)
+                return response
+
+            key, from_tag = self._key(method, params, make_request)
+            if key is None:
+                return make_request(method, params)
+            with self._lock:
+                response = self._cache.get(key)
+                if response is not None:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return response
+                self.misses += 1
+            response = make_request(method, params)
+            if 'error' in response or 'result' not in response:
+                return response
+            with self._lock:
+                self._cache[key] = response
+                if from_tag:
+                    self._latest_keys.add(key)
+                while len(self._cache) > self.maxsize:
+                    old_key, _ = self._cache.popitem(last=False)
+                    self._latest_keys.discard(old_key)
+            return response
+
+        return middleware
@@ -0,0 +1,51 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from typing import List, Tuple, Union
+from web3 import Web3
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.types import BlockIdentifier
+from utils import AddressLike, _load_contract_multicall
+
+# Multicall3 is deployed at the same address on every EVM chain
+MULTICALL_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+MULTICALL_CHUNK_SIZE = 100
+
+Call = Tuple[AddressLike, Union[bytes, str]]
+
+
+def output_types(contract, fn_name: str) -> List[str]:
+    """ABI output types of `fn_name`, ready for `w3.codec.decode_abi`."""
+    return get_abi_output_types(contract.get_function_by_name(fn_name).abi)
+
+
+class Multicall():
+    """
+    把多个 eth_call 打包成 Multicall3.tryBlockAndAggregate，每 chunk_size 个一次请求。
+    第一个 chunk 返回的区块号会用来固定后续 chunk，保证所有结果来自同一个区块。
+    """
+
+    def __init__(self, w3: Web3, address: str = MULTICALL_ADDRESS, chunk_size: int = MULTICALL_CHUNK_SIZE):
+        self.w3 = w3
+        self.chunk_size = chunk_size
+        self.contract = _load_contract_multicall(w3, address)
+
+    def aggregate(self, calls: List[Call], block: BlockIdentifier = 'latest') -> Tuple[int, List[Tuple[bool, bytes]]]:
+        """Returns (block_number, [(success, return_data), ...]) in the order of `calls`."""
+        block_number = None
+        results = []
+        for start in range(0, max(len(calls), 1), self.chunk_size):
+            chunk = [(Web3.toChecksumAddress(target), data) for target, data in calls[start:start + self.chunk_size]]
+            block_number, _, return_data = self.contract.functions.tryBlockAndAggregate(False, chunk).call(
+                block_identifier=block)
+            block = block_number
+            results.extend(return_data)
+        return block_number, results
+
+    def decode(self, types: List[str], result: Tuple[bool, bytes]):
+        success, data = result
+        if not success or not data:
+            return None
+        decoded = self.w3.codec.decode_abi(types, data)
+        # 和 ContractFunction.call() 一样把地址转成 checksum
+        return map_abi_data(BASE_RETURN_NORMALIZERS, types, decoded)
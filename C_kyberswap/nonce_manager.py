@@ -0,0 +1,145 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+from web3 import Web3
+from web3.types import Nonce
+from batch import RPCBatch
+
+try:
+    import fcntl
+except ImportError:  # windows, 只能保证进程内安全
+    fcntl = None
+
+NONCE_STALE_SECONDS = 120
+NONCE_RESYNC_INTERVAL = 15
+
+
+class NonceManager():
+    """
+    本地分配 nonce，发交易前不再调用 get_transaction_count。
+
+    状态: next（下一个新 nonce）、in_flight（已分配还没发出去）、sent（已发出还没上链）、gaps（空出来可以复用的 nonce）。
+    传了 lock_path 时状态保存在这个 json 文件里，用 flock 加锁，多个进程共用同一个钱包也不会冲突。
+    resync() 用链上 latest/pending 计数清理已上链的 nonce、跟上其他地方发的交易、找出没人占用的空洞。
+    auto_start=True 时第一次 allocate() 才启动后台 resync 线程（和 FeeEngine 第一次 suggest() 一样），
+    只构造不发交易的 client 不会起线程；stop() 之后不再自动启动。
+    """
+
+    def __init__(self, w3: Optional[Web3], address, lock_path: Optional[str] = None,
+                 stale_seconds: float = NONCE_STALE_SECONDS, auto_start: bool = False):
+        self.w3 = w3
+        self.auto_start = auto_start
+        self.address = Web3.toChecksumAddress(address)
+        self.lock_path = lock_path
+        self.stale_seconds = stale_seconds
+        self._lock = threading.RLock()
+        self._state = {'next': None, 'in_flight': {}, 'sent': {}, 'gaps': []}
+        self._resync_thread = None
+        self._stop = threading.Event()
+
+    @property
+    def synced(self) -> bool:
+        with self._locked() as state:
+            return state['next'] is not None
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if self.lock_path is None:
+                yield self._state
+                return
+            with open(self.lock_path, 'a+') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    state = json.loads(content) if content else dict(self._state)
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    def allocate(self) -> Nonce:
+        """Hand out the lowest free nonce without an RPC call (one sync on first use)."""
+        if not self.synced:
+            self.resync()
+        if self.auto_start and self._resync_thread is None and self.w3 is not None:
+            self.start()
+        with self._locked() as state:
+            if state['gaps']:
+                nonce = min(state['gaps'])
+                state['gaps'].remove(nonce)
+            else:
+                nonce = state['next']
+                state['next'] = nonce + 1
+            state['in_flight'][str(nonce)] = time.time()
+            return Nonce(nonce)
+
+    def mark_sent(self, nonce: int):
+        with self._locked() as state:
+            state['in_flight'].pop(str(nonce), None)
+            state['sent'][str(nonce)] = time.time()
+
+    def release(self, nonce: int):
+        """交易没发出去，nonce 还回去给下一笔用"""
+        with self._locked() as state:
+            state['in_flight'].pop(str(nonce), None)
+            if nonce == state['next'] - 1:
+                state['next'] = nonce
+            elif nonce not in state['gaps']:
+                state['gaps'].append(nonce)
+
+    def resync(self):
+        # latest/pending 两个计数放在一个 JSON-RPC batch 里读
+        with RPCBatch(self.w3) as batch:
+            latest = batch.get_transaction_count(self.address, 'latest')
+            pending = batch.get_transaction_count(self.address, 'pending')
+        self.update(latest.result(), pending.result())
+
+    def update(self, latest: int, pending: int):
+        """用链上的 latest/pending 交易数校正本地状态"""
+        now = time.time()
+        with self._locked() as state:
+            if state['next'] is None or pending > state['next']:
+                # 第一次同步，或者有其他地方用这个钱包发了交易
+                state['next'] = pending
+            for key in ('in_flight', 'sent'):
+                state[key] = {n: t for n, t in state[key].items() if int(n) >= latest}
+            busy = {int(n) for n, t in state['in_flight'].items() if now - t < self.stale_seconds}
+            busy.update(int(n) for n, t in state['sent'].items() if now - t < self.stale_seconds)
+            gaps = set(n for n in state['gaps'] if n >= latest)
+            # pending 只统计连续的交易，[pending, next) 里没人占用的就是空洞
+            gaps.update(n for n in range(pending, state['next']) if n not in busy)
+            state['gaps'] = sorted(gaps)
+
+    def start(self, interval: float = NONCE_RESYNC_INTERVAL):
+        """Start a daemon thread that resyncs every `interval` seconds."""
+        if self._resync_thread is not None:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.resync()
+                except Exception as e:
+                    print(e)
+
+        self._resync_thread = threading.Thread(target=run, name='nonce-resync', daemon=True)
+        self._resync_thread.start()
+
+    def stop(self):
+        self.auto_start = False
+        self._stop.set()
+        self._resync_thread = None
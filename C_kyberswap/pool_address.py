@@ -0,0 +1,110 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地用 CREATE2 算 Elastic 池子地址，不调用 factory.getPool：
+    pool = keccak256(0xff ++ factory ++ keccak256(abi.encode(token0, token1, swapFeeUnits)) ++ poolInitHash)[12:]
+token0/token1 是按地址排序后的两个 token，swapFeeUnits 是 Elastic 的 fee 单位（十万分之一，feeTier / 10）。
+
+init code hash 不写死，先用 load_init_code_hash 从 factory 读 poolInitHash()，同时用 getPool 核对
+MARKET_INFO_DICT 里每个已登记的池子：getPool 返回的地址和本地算出来的地址都要和登记的一致才返回，否则抛异常。
+
+    init_code_hash = load_init_code_hash(w3, factory, get_market_registry())
+    compute_pool_address(factory, usdt, weth, 300, init_code_hash)       # checksum 地址，token 不分顺序
+    derive_pool_addresses(factory, get_market_registry(), init_code_hash) # 注册表里所有 token 两两组合 x fee
+
+同一个 (factory, init code hash, token0, token1, fee) 只算一次。
+"""
+import functools
+import itertools
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from eth_utils import keccak
+from web3 import Web3
+from market_registry import FEE_TIER_PER_ELASTIC_FEE_UNIT, Market, MarketRegistry, address_key
+from multicall import Multicall, output_types
+from utils import _load_contract_json
+
+_CREATE2_PREFIX = b'\xff'
+_WORD_PADDING = b'\x00' * 12
+
+
+@functools.lru_cache(maxsize=None)
+def _derive(factory: bytes, init_code_hash: bytes, token0: bytes, token1: bytes, fee: int) -> bytes:
+    # abi.encode(address, address, uint24)：每个参数左补零到 32 字节，直接拼比 eth_abi 编码快
+    salt = keccak(_WORD_PADDING + token0 + _WORD_PADDING + token1 + fee.to_bytes(32, 'big'))
+    return keccak(_CREATE2_PREFIX + factory + salt + init_code_hash)[12:]
+
+
+@functools.lru_cache(maxsize=None)
+def _checksum(address: bytes) -> str:
+    return Web3.toChecksumAddress(address)
+
+
+def _fee_units(market: Market) -> int:
+    return market.fee // FEE_TIER_PER_ELASTIC_FEE_UNIT
+
+
+def compute_pool_address(factory: Union[str, bytes], token_a: Union[str, bytes], token_b: Union[str, bytes],
+                         fee_units: int, init_code_hash: Union[str, bytes]) -> str:
+    key_a, key_b = address_key(token_a), address_key(token_b)
+    token0, token1 = (key_a, key_b) if key_a < key_b else (key_b, key_a)
+    if token0 == token1:
+        raise Exception(f"pool tokens must differ: {_checksum(token0)}")
+    return _checksum(_derive(address_key(factory), address_key(init_code_hash), token0, token1, fee_units))
+
+
+def derive_pool_addresses(factory: Union[str, bytes], registry: MarketRegistry, init_code_hash: Union[str, bytes],
+                          fees: Optional[Iterable[int]] = None) -> Dict[Tuple[bytes, bytes, int], bytes]:
+    """
+    注册表里所有 token 两两组合、每个 fee 的池子地址，{(token0, token1, swapFeeUnits): pool}。
+    和 MarketRegistry 的 pair 索引一样地址都是 20 字节，要 checksum 时再 Web3.toChecksumAddress。
+    fees 是 Elastic 的 fee 单位，默认是注册表里已登记池子用到的 fee。算出来的地址池子不一定已经创建
+    """
+    factory, init_code_hash = address_key(factory), address_key(init_code_hash)
+    fees = sorted(set(fees if fees is not None else (_fee_units(market) for market in registry.markets().values())))
+    tokens = sorted({token.address_bytes for token in registry.tokens()})
+    pools = {}
+    for token0, token1 in itertools.combinations(tokens, 2):
+        for fee in fees:
+            pools[(token0, token1, fee)] = _derive(factory, init_code_hash, token0, token1, fee)
+    return pools
+
+
+def verify_init_code_hash(factory: Union[str, bytes], registry: MarketRegistry,
+                          init_code_hash: Union[str, bytes]) -> List[Tuple[Market, str]]:
+    """注册表里算出来和登记地址对不上的池子，[(market, 算出来的地址)]；空列表说明 init code hash 对得上"""
+    return [(market, derived) for market, derived in
+            ((market, compute_pool_address(factory, market.token0.address_bytes, market.token1.address_bytes,
+                                           _fee_units(market), init_code_hash))
+             for market in registry.markets().values())
+            if address_key(derived) != market.pool_bytes]
+
+
+def load_init_code_hash(w3: Web3, factory: Union[str, bytes], registry: MarketRegistry) -> str:
+    """
+    factory 的 poolInitHash()，一次 multicall 连同每个已登记池子的 getPool 一起读。
+    getPool 和本地算出来的地址都和注册表一致才返回，任何一个对不上就抛异常，不返回没核对过的 hash
+    """
+    factory = Web3.toChecksumAddress(factory)
+    contract = _load_contract_json(w3, "ElasticFactory", factory)
+    markets = list(registry.markets().values())
+    calls = [(factory, contract.encodeABI("poolInitHash"))]
+    calls.extend((factory, contract.encodeABI("getPool", [market.token0.address, market.token1.address,
+                                                          _fee_units(market)]))
+                 for market in markets)
+    multicall = Multicall(w3)
+    block_number, results = multicall.aggregate(calls)
+    init_code_hash = multicall.decode(output_types(contract, "poolInitHash"), results[0])
+    if init_code_hash is None:
+        raise Exception(f"poolInitHash() failed for factory {factory} at block {block_number}")
+    init_code_hash = Web3.toHex(init_code_hash[0])
+    pool_types = output_types(contract, "getPool")
+    for market, result in zip(markets, results[1:]):
+        pool = multicall.decode(pool_types, result)
+        if pool is None or address_key(pool[0]) != market.pool_bytes:
+            raise Exception(f"factory {factory} getPool({market.symbol}, {_fee_units(market)}) returned "
+                            f"{pool[0] if pool else None}, registered pool is {market.pool}")
+    mismatches = verify_init_code_hash(factory, registry, init_code_hash)
+    if mismatches:
+        raise Exception(f"poolInitHash {init_code_hash} of factory {factory} does not derive "
+                        f"{', '.join(f'{market.symbol} ({market.pool} != {derived})' for market, derived in mismatches)}")
+    return init_code_hash
@@ -0,0 +1,122 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from web3 import Web3
+from web3.types import BlockIdentifier
+from multicall import Multicall, output_types
+from utils import _load_contract_json
+
+POOL_STATE_CACHE_SIZE = 1024
+# 同一个区块内的查询共用一次 eth_blockNumber，以太坊主网出块 12s，1s 内的查询基本都在同一个区块
+BLOCK_NUMBER_TTL = 1.0
+
+
+class PoolState(NamedTuple):
+    block: int
+    sqrtPriceX96: int     # Elastic: getPoolState().sqrtP
+    tick: int             # Elastic: getPoolState().currentTick
+    liquidity: int        # Elastic: getLiquidityState().baseL
+    tickSpacing: int      # Elastic: tickDistance()
+
+
+# 每种池子合约读状态用的三个函数：(价格和 tick, 当前流动性, tick 间距)。
+# 三个函数的返回值都是第一个字段是要的值，价格函数的第二个字段是 tick
+POOL_STATE_FUNCTIONS = {
+    'ElasticPool': ('getPoolState', 'getLiquidityState', 'tickDistance'),
+    'UniswapV3Pool': ('slot0', 'liquidity', 'tickSpacing'),
+}
+
+
+class PoolStateCache():
+    """
+    池子状态缓存，key 是 (pool address, block number)。
+    价格/tick、流动性、tick 间距用一次 multicall 读回来，同一个区块里任意多个 position 查询共用这一次读取。
+    tick 间距不会变，每个池子只读一次。
+    默认读 KyberSwap Elastic 池子（getPoolState/getLiquidityState/tickDistance），
+    pool_abi='UniswapV3Pool' 时读 Uniswap v3 的 slot0/liquidity/tickSpacing。
+    """
+
+    def __init__(self, w3: Web3, maxsize: int = POOL_STATE_CACHE_SIZE, block_ttl: float = BLOCK_NUMBER_TTL,
+                 pool_abi: str = 'ElasticPool'):
+        self.w3 = w3
+        self.pool_abi = pool_abi
+        self.price_fn, self.liquidity_fn, self.tick_spacing_fn = POOL_STATE_FUNCTIONS[pool_abi]
+        self.maxsize = maxsize
+        self.block_ttl = block_ttl
+        self.multicall = Multicall(w3)
+        self._cache = OrderedDict()
+        self._tick_spacing = {}
+        self._block = None
+        self._block_time = 0.0
+        self._lock = threading.Lock()
+
+    def block_number(self) -> int:
+        """Latest block number, fetched at most once per `block_ttl` seconds."""
+        now = time.monotonic()
+        if self._block is None or now - self._block_time > self.block_ttl:
+            self._block = self.w3.eth.block_number
+            self._block_time = now
+        return self._block
+
+    def get(self, pool_address, block: BlockIdentifier = 'latest') -> PoolState:
+        pool_address = Web3.toChecksumAddress(pool_address)
+        if block == 'latest':
+            block = self.block_number()
+        with self._lock:
+            state = self._cache.get((pool_address, block))
+            if state is not None:
+                self._cache.move_to_end((pool_address, block))
+                return state
+        state = self._fetch(pool_address, block)
+        self.put(pool_address, state)
+        return state
+
+    def put(self, pool_address, state: PoolState):
+        pool_address = Web3.toChecksumAddress(pool_address)
+        with self._lock:
+            self._tick_spacing[pool_address] = state.tickSpacing
+            self._cache[(pool_address, state.block)] = state
+            self._cache.move_to_end((pool_address, state.block))
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def decode(self, pool_address, block_number: int, price_result, liquidity_result,
+               tick_spacing_result=None) -> Optional[PoolState]:
+        """Build a PoolState from raw multicall results (used by callers that batch these reads themselves)."""
+        pool = _load_contract_json(self.w3, self.pool_abi, pool_address)
+        price = self.multicall.decode(output_types(pool, self.price_fn), price_result)
+        liquidity = self.multicall.decode(output_types(pool, self.liquidity_fn), liquidity_result)
+        tick_spacing = self._tick_spacing.get(Web3.toChecksumAddress(pool_address))
+        if tick_spacing_result is not None:
+            decoded = self.multicall.decode(output_types(pool, self.tick_spacing_fn), tick_spacing_result)
+            tick_spacing = decoded[0] if decoded else tick_spacing
+        if price is None or liquidity is None:
+            return None
+        return PoolState(block_number, price[0], price[1], liquidity[0], tick_spacing)
+
+    def calls(self, pool_address):
+        """(target, calldata) pairs for the price, liquidity and, if not yet known, tick spacing reads."""
+        pool_address = Web3.toChecksumAddress(pool_address)
+        pool = _load_contract_json(self.w3, self.pool_abi, pool_address)
+        calls = [(pool_address, pool.encodeABI(self.price_fn)), (pool_address, pool.encodeABI(self.liquidity_fn))]
+        if pool_address not in self._tick_spacing:
+            calls.append((pool_address, pool.encodeABI(self.tick_spacing_fn)))
+        return calls
+
+    def _fetch(self, pool_address, block: int) -> PoolState:
+        calls = self.calls(pool_address)
+        block_number, results = self.multicall.aggregate(calls, block=block)
+        state = self.decode(pool_address, block_number, *results)
+        if state is None:
+            raise Exception(f"{self.price_fn}/{self.liquidity_fn} call failed for pool {pool_address} at block {block}")
+        return state
+
+
+@functools.lru_cache()
+def get_pool_state_cache(w3: Web3, pool_abi: str = 'ElasticPool') -> PoolStateCache:
+    """同一个 Web3、同一种池子合约的 client 共用一个 PoolStateCache"""
+    return PoolStateCache(w3, pool_abi=pool_abi)
@@ -0,0 +1,260 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+钱包 position 的常驻估值：全部 position 放在内存里，按池子分组，每个区块只重算 tick 变了的池子。
+
+- refresh(block)：所有池子的 getPoolState/getLiquidityState 一次 multicall；tick 变了的池子再用一次 multicall 读手续费输入，
+  只重算这些池子里的 position，汇总按差值更新。每个区块的计算量和变动的池子数成正比，和 position 总数无关。
+- on_swap(swap_log)：订阅到池子 Swap 事件时直接用日志里的 sqrtPriceX96/tick 更新数量，手续费在下一次 refresh 补。
+- snapshot()：每次更新后预先生成好的 PortfolioSnapshot，读取是 O(1)。
+
+    valuer = PortfolioValuer(w3, nft_manager_address).load(owner).start()
+    snap = valuer.snapshot()
+    snap.amounts['ETH'], snap.fees['USDT']
+"""
+import threading
+from typing import Dict, Iterable, NamedTuple, Optional
+from web3 import Web3
+from web3.types import BlockIdentifier
+from config import TICK_SPACING
+from fee_engine import BLOCK_POLL_INTERVAL
+from market_registry import MarketRegistry, get_market_registry
+from multicall import Multicall
+from pool_state import PoolState, get_pool_state_cache
+from position_fees import FeeReader
+from position_index import get_position_index
+from tick_math import get_amounts_for_liquidity, sqrt_ratio_at_tick
+
+
+class PositionValue(NamedTuple):
+    token_id: int
+    pool: str
+    token0: str
+    token1: str
+    amount0: int
+    amount1: int
+    fee0: int
+    fee1: int
+
+
+class PortfolioSnapshot(NamedTuple):
+    block: Optional[int]
+    positions: int
+    amounts: Dict[str, float]       # token -> 区间内的数量（不含手续费），按 decimals 换算
+    fees: Dict[str, float]          # token -> 未领取手续费
+    pools_changed: int              # 这次更新重算的池子数
+
+
+_EMPTY_SNAPSHOT = PortfolioSnapshot(None, 0, {}, {}, 0)
+
+
+class PortfolioValuer():
+
+    def __init__(self, w3: Web3, nft_manager_address, registry: MarketRegistry = None):
+        self.w3 = w3
+        self.nft_manager_address = Web3.toChecksumAddress(nft_manager_address)
+        self.registry = registry or get_market_registry()
+        # 和 FeeReader 一样读 Elastic 池子
+        self.pool_state_cache = get_pool_state_cache(w3, 'ElasticPool')
+        self.multicall = Multicall(w3)
+        self.fee_reader = FeeReader(w3, self.multicall)
+        self._positions = {}          # token_id -> positions() 结果
+        self._pools = {}              # pool -> {token_id}
+        self._pool_of = {}            # token_id -> pool
+        self._ticks = {}              # pool -> 上次估值用的 tick
+        self._states = {}             # pool -> 上次估值用的 PoolState
+        self._fees = {}               # token_id -> PositionFees
+        self._values = {}             # token_id -> PositionValue
+        self._amounts = {}            # token 地址 -> 原始数量合计
+        self._fee_totals = {}
+        self._dirty = set()           # 价格已经按日志更新、手续费还没重读的池子
+        self._snapshot = _EMPTY_SNAPSHOT
+        self._refreshed_block = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._poll_thread = None
+        self._owners = []
+
+    def snapshot(self) -> PortfolioSnapshot:
+        return self._snapshot
+
+    def position(self, token_id: int) -> Optional[PositionValue]:
+        return self._values.get(token_id)
+
+    def _pool_address(self, position_info) -> Optional[str]:
+        """positions() 结果对应的已登记池子，fee 是 Elastic 的单位；没登记的返回 None"""
+        token0, fee, token1 = position_info[1]
+        market = self.registry.elastic_pool(token0, token1, fee)
+        return market.pool if market is not None else None
+
+    def load(self, owner, block: BlockIdentifier = 'latest') -> 'PortfolioValuer':
+        """owner 的全部 position 放进来（PositionIndex），之后 refresh 时跟着 Transfer 增减"""
+        owner = Web3.toChecksumAddress(owner)
+        if owner not in self._owners:
+            self._owners.append(owner)
+        index = get_position_index(self.w3, self.nft_manager_address)
+        self.set_positions(index.list_positions(owner, with_positions=True, block=block))
+        return self
+
+    def set_positions(self, positions: Dict[int, tuple]):
+        """
+        加入/更新 position（{token_id: positions() 结果}），所在池子下次 refresh 时重算。
+        已有 position 增减流动性不会有 Transfer，调用方改完仓位后用新的 positions() 结果调一次
+        """
+        with self._lock:
+            for token_id, position_info in positions.items():
+                if position_info is None:
+                    continue
+                pool = self._pool_address(position_info)
+                if pool is None:
+                    # 池子没登记在 MARKET_INFO_DICT 里，估不了值，跳过
+                    print(f"position {token_id}: pool {position_info[1]} is not registered, skipped")
+                    continue
+                self._positions[token_id] = position_info
+                self._pool_of[token_id] = pool
+                self._pools.setdefault(pool, set()).add(token_id)
+                self._dirty.add(pool)
+
+    def remove_positions(self, token_ids: Iterable[int]):
+        with self._lock:
+            for token_id in token_ids:
+                self._positions.pop(token_id, None)
+                pool = self._pool_of.pop(token_id, None)
+                if pool is not None:
+                    self._pools[pool].discard(token_id)
+                    if not self._pools[pool]:
+                        del self._pools[pool]
+                        self._ticks.pop(pool, None)
+                        self._states.pop(pool, None)
+                self._fees.pop(token_id, None)
+                self._apply(token_id, None)
+            self._publish(self._snapshot.block, 0)
+
+    def _sync_owners(self, block: int):
+        """钱包的 position 有增减时（mint/burn/转入转出）同步进来，positions() 只读新增的"""
+        if not self._owners:
+            return
+        index = get_position_index(self.w3, self.nft_manager_address)
+        index.sync(block)
+        held = {token_id for owner in self._owners for token_id in index.token_ids(owner)}
+        removed = [token_id for token_id in self._positions if token_id not in held]
+        added = [token_id for token_id in held if token_id not in self._positions]
+        if removed:
+            self.remove_positions(removed)
+        if added:
+            self.set_positions(index.positions(added, block))
+
+    def refresh(self, block: BlockIdentifier = 'latest') -> int:
+        """
+        读所有池子的 getPoolState，重算 tick 变了（或者有新 position、按日志更新过价格）的池子，返回重算的池子数。
+        池子状态和手续费输入都固定在同一个区块
+        """
+        if block == 'latest':
+            block = self.pool_state_cache.block_number()
+        self._sync_owners(block)
+        pools = list(self._pools)
+        if not pools:
+            return 0
+        pool_calls = [self.pool_state_cache.calls(pool) for pool in pools]
+        block_number, results = self.multicall.aggregate([call for calls in pool_calls for call in calls], block=block)
+        self._refreshed_block = block_number
+        changed = {}
+        i = 0
+        for pool, calls in zip(pools, pool_calls):
+            state = self.pool_state_cache.decode(pool, block_number, *results[i:i + len(calls)])
+            i += len(calls)
+            if state is None:
+                continue
+            self.pool_state_cache.put(pool, state)
+            if pool in self._dirty or self._ticks.get(pool) != state.tick:
+                changed[pool] = state
+        if changed:
+            positions = {token_id: self._positions[token_id] for pool in changed for token_id in self._pools[pool]}
+            fees = self.fee_reader.read(positions, [self._pool_of[token_id] for token_id in positions], block_number)
+            with self._lock:
+                self._fees.update(fees)
+                for pool, state in changed.items():
+                    self._revalue(pool, state)
+                    self._dirty.discard(pool)
+                self._publish(block_number, len(changed))
+        elif self._snapshot.block != block_number:
+            self._snapshot = self._snapshot._replace(block=block_number, pools_changed=0)
+        return len(changed)
+
+    def on_swap(self, swap_log):
+        """log_ingester.SwapLog：不读链，直接按日志里的价格重算这个池子"""
+        pool = self.registry.market(swap_log.symbol).pool
+        with self._lock:
+            if pool not in self._pools or self._ticks.get(pool) == swap_log.tick:
+                return
+            previous = self._states.get(pool)
+            spacing = previous.tickSpacing if previous is not None else None
+            state = PoolState(swap_log.blockNumber, swap_log.sqrtPriceX96, swap_log.tick, swap_log.liquidity, spacing)
+            self._revalue(pool, state)
+            # 手续费跟着 Swap 变了，下次 refresh 重读
+            self._dirty.add(pool)
+            self._publish(max(swap_log.blockNumber, self._snapshot.block or 0), 1)
+
+    def _revalue(self, pool: str, state: PoolState):
+        spacing = state.tickSpacing or TICK_SPACING['MEDIUM']
+        for token_id in self._pools[pool]:
+            pos, info = self._positions[token_id]
+            amount0, amount1 = get_amounts_for_liquidity(state.sqrtPriceX96, sqrt_ratio_at_tick(pos[3], spacing),
+                                                         sqrt_ratio_at_tick(pos[4], spacing), pos[5])
+            fees = self._fees.get(token_id)
+            self._apply(token_id, PositionValue(token_id, pool, info[0], info[2], amount0, amount1,
+                                                fees.amount0 if fees else 0, fees.amount1 if fees else 0))
+        self._ticks[pool] = state.tick
+        self._states[pool] = state
+
+    def _apply(self, token_id: int, value: Optional[PositionValue]):
+        """汇总按差值更新：减掉旧值，加上新值"""
+        old = self._values.pop(token_id, None)
+        for sign, v in ((-1, old), (1, value)):
+            if v is None:
+                continue
+            for totals, token, amount in ((self._amounts, v.token0, v.amount0), (self._amounts, v.token1, v.amount1),
+                                          (self._fee_totals, v.token0, v.fee0), (self._fee_totals, v.token1, v.fee1)):
+                totals[token] = totals.get(token, 0) + sign * amount
+        if value is not None:
+            self._values[token_id] = value
+
+    def _scaled(self, totals: Dict[str, int]) -> Dict[str, float]:
+        scaled = {}
+        for address, amount in totals.items():
+            token = self.registry.token_by_address(address)
+            if token is None:
+                scaled[address] = amount
+            else:
+                scaled[token.symbol] = amount / 10 ** token.decimals
+        return scaled
+
+    def _publish(self, block: Optional[int], pools_changed: int):
+        """生成新的快照，读的一方拿到的永远是完整的一份；只按 token 数汇总，不遍历 position"""
+        self._snapshot = PortfolioSnapshot(block, len(self._values), self._scaled(self._amounts),
+                                           self._scaled(self._fee_totals), pools_changed)
+
+    def on_new_block(self, block_number: int):
+        if self._refreshed_block is None or block_number > self._refreshed_block:
+            self.refresh(block_number)
+
+    def start(self, interval: float = BLOCK_POLL_INTERVAL) -> 'PortfolioValuer':
+        """Start a daemon thread that polls the block number and refreshes on every new block."""
+        if self._poll_thread is not None:
+            return self
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.on_new_block(self.w3.eth.block_number)
+                except Exception as e:
+                    print(e)
+
+        self._poll_thread = threading.Thread(target=run, name='portfolio', daemon=True)
+        self._poll_thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._poll_thread = None
@@ -0,0 +1,177 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地计算 position 未领取的手续费，不用逐个 position 静态调用 collect/removeLiquidity。
+
+Elastic 池子的手续费是 reinvest 进池子的 rToken，只有一个累加器 feeGrowthGlobal（每单位 liquidity 的 rToken，
+放大 2^96），和 positions() 返回的 feeGrowthInsideLast / rTokenOwed 对应：
+    feeGrowthInside = 按当前 tick 和两个边界 tick 的 feeGrowthOutside 算出的区间内增长（uint256 回绕）
+    rToken          = rTokenOwed + liquidity * (feeGrowthInside - feeGrowthInsideLast) / 2^96
+    token0, token1  = rToken 按 reinvestL / totalSupply 换成流动性，再按当前价格换成两个 token（burnRTokens 的算法）
+还没 mint 的 reinvest 手续费（reinvestL - reinvestLLast）先按合约 _syncFeeGrowth 的算法补进 feeGrowthGlobal 和 totalSupply：
+其中 governmentFeeUnits / 1e5（factory.feeConfiguration()）mint 给 feeTo，只有剩下的部分计入 feeGrowthGlobal。
+
+    reader = FeeReader(w3)
+    fees = reader.read(positions, pool_addresses, block)    # {token_id: PositionFees}
+
+一批 position 涉及的所有池子状态和边界 tick 用一次 multicall 在同一个区块读，计算用 numpy object 数组，整数精确。
+"""
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+import numpy as np
+from web3 import Web3
+from web3.types import BlockIdentifier
+from multicall import Multicall, output_types
+from utils import _load_contract_json
+
+Q96 = 2 ** 96
+UINT256 = 2 ** 256
+# governmentFeeUnits 的分母，和 Elastic 的 swapFeeUnits 一样是十万分之一
+FEE_UNITS = 100000
+ELASTIC_FACTORY_ADDRESS = "0xC7a590291e07B9fe9E64b86c58fD8fC764308C4A"
+
+
+class PoolFeeState(NamedTuple):
+    block: int
+    sqrtP: int
+    tick: int
+    feeGrowthGlobal: int
+    baseL: int
+    reinvestL: int
+    reinvestLLast: int
+    totalSupply: int
+    feeGrowthOutside: Dict[int, int]     # tick -> feeGrowthOutside，只包含读过的 tick
+    governmentFeeUnits: int = 0          # factory.feeConfiguration()，十万分之一
+
+
+class PositionFees(NamedTuple):
+    token_id: int
+    rToken: int
+    amount0: int
+    amount1: int
+
+
+def _r_mint_qty(reinvest_l: int, reinvest_l_last: int, base_l: int, total_supply: int) -> int:
+    """ReinvestmentMath.calcrMintQty：上次同步之后累积的 reinvest 手续费对应要 mint 的 rToken"""
+    if reinvest_l <= reinvest_l_last or reinvest_l_last == 0:
+        return 0
+    lp_contribution = base_l * (reinvest_l - reinvest_l_last) // (base_l + reinvest_l)
+    return total_supply * lp_contribution // reinvest_l_last
+
+
+def synced_fee_growth(state: PoolFeeState) -> Tuple[int, int]:
+    """
+    补上未 mint 的 reinvest 手续费之后的 (feeGrowthGlobal, rToken totalSupply)。
+    _deductGovermentFee 先把 governmentFeeUnits 那部分 mint 给 feeTo，totalSupply 加的还是全部 rMintQty
+    """
+    r_mint = _r_mint_qty(state.reinvestL, state.reinvestLLast, state.baseL, state.totalSupply)
+    fee_growth = state.feeGrowthGlobal
+    if r_mint and state.baseL:
+        r_lp = r_mint - r_mint * state.governmentFeeUnits // FEE_UNITS
+        fee_growth = (fee_growth + r_lp * Q96 // state.baseL) % UINT256
+    return fee_growth, state.totalSupply + r_mint
+
+
+def compute_fees(positions: Dict[int, tuple], pool_addresses: Sequence[str],
+                 states: Dict[str, PoolFeeState]) -> Dict[int, PositionFees]:
+    """
+    positions 是 {token_id: positions() 结果}，pool_addresses 和它顺序一致，states 是每个池子的 PoolFeeState。
+    所有 position 一起按数组算
+    """
+    token_ids = list(positions)
+    if not token_ids:
+        return {}
+    pools = [states[Web3.toChecksumAddress(address)] for address in pool_addresses]
+    synced = {id(state): synced_fee_growth(state) for state in pools}
+
+    def column(values):
+        return np.array(list(values), dtype=object)
+
+    pos = [positions[token_id][0] for token_id in token_ids]
+    lower, upper = column(p[3] for p in pos), column(p[4] for p in pos)
+    liquidity, r_token_owed, last = column(p[5] for p in pos), column(p[6] for p in pos), column(p[7] for p in pos)
+    tick = column(state.tick for state in pools)
+    fee_growth = column(synced[id(state)][0] for state in pools)
+    total_supply = column(synced[id(state)][1] for state in pools)
+    reinvest_l = column(state.reinvestL for state in pools)
+    sqrt_p = column(state.sqrtP for state in pools)
+    lower_outside = column(state.feeGrowthOutside[p[3]] for state, p in zip(pools, pos))
+    upper_outside = column(state.feeGrowthOutside[p[4]] for state, p in zip(pools, pos))
+
+    inside = np.where(tick < lower, lower_outside - upper_outside,
+                      np.where(tick >= upper, upper_outside - lower_outside,
+                               fee_growth - lower_outside - upper_outside)) % UINT256
+    r_token = r_token_owed + liquidity * ((inside - last) % UINT256) // Q96
+    burn_l = np.where(total_supply > 0, r_token * reinvest_l // np.where(total_supply > 0, total_supply, 1), 0)
+    amount0 = np.where(sqrt_p > 0, burn_l * Q96 // np.where(sqrt_p > 0, sqrt_p, 1), 0)
+    amount1 = burn_l * sqrt_p // Q96
+    return {token_id: PositionFees(token_id, int(r), int(a0), int(a1))
+            for token_id, r, a0, a1 in zip(token_ids, r_token, amount0, amount1)}
+
+
+class FeeReader():
+    """
+    一批 position 的手续费输入：factory 的 feeConfiguration，
+    每个池子 getPoolState/getFeeGrowthGlobal/getLiquidityState/totalSupply + 边界 tick
+    """
+
+    def __init__(self, w3: Web3, multicall: Multicall = None, factory_address=ELASTIC_FACTORY_ADDRESS):
+        self.w3 = w3
+        self.multicall = multicall or Multicall(w3)
+        self.factory = _load_contract_json(w3, "ElasticFactory", factory_address)
+
+    def _pool(self, pool_address):
+        return _load_contract_json(self.w3, "ElasticPool", pool_address)
+
+    def calls(self, pool_ticks: Dict[str, List[int]]) -> List[Tuple[str, str]]:
+        calls = [(self.factory.address, self.factory.encodeABI("feeConfiguration"))]
+        for pool_address, ticks in pool_ticks.items():
+            pool = self._pool(pool_address)
+            calls.extend((pool_address, pool.encodeABI(fn_name))
+                         for fn_name in ("getPoolState", "getFeeGrowthGlobal", "getLiquidityState", "totalSupply"))
+            calls.extend((pool_address, pool.encodeABI("ticks", [tick])) for tick in ticks)
+        return calls
+
+    def decode(self, pool_ticks: Dict[str, List[int]], block_number: int, results) -> Dict[str, PoolFeeState]:
+        fee_configuration = self.multicall.decode(output_types(self.factory, "feeConfiguration"), results[0])
+        if fee_configuration is None:
+            raise Exception(f"feeConfiguration() failed for factory {self.factory.address} at block {block_number}")
+        government_fee_units = fee_configuration[1]
+        states = {}
+        i = 1
+        for pool_address, ticks in pool_ticks.items():
+            pool = self._pool(pool_address)
+            decoded = [self.multicall.decode(output_types(pool, fn_name), result) for fn_name, result in
+                       zip(("getPoolState", "getFeeGrowthGlobal", "getLiquidityState", "totalSupply"), results[i:i + 4])]
+            if any(value is None for value in decoded):
+                raise Exception(f"fee state calls failed for pool {pool_address} at block {block_number}")
+            pool_state, fee_growth, liquidity_state, total_supply = decoded
+            i += 4
+            outside = {}
+            tick_types = output_types(pool, "ticks")
+            for tick, result in zip(ticks, results[i:i + len(ticks)]):
+                tick_info = self.multicall.decode(tick_types, result)
+                if tick_info is None:
+                    raise Exception(f"ticks({tick}) call failed for pool {pool_address} at block {block_number}")
+                outside[tick] = tick_info[2]
+            i += len(ticks)
+            states[pool_address] = PoolFeeState(block_number, pool_state[0], pool_state[1], fee_growth[0],
+                                                *liquidity_state, total_supply[0], outside, government_fee_units)
+        return states
+
+    @staticmethod
+    def pool_ticks(positions: Dict[int, tuple], pool_addresses: Sequence[str]) -> Dict[str, List[int]]:
+        """每个池子要读的边界 tick，{pool: [tick]}，calls/decode 的输入"""
+        pool_ticks = {}
+        for token_id, address in zip(positions, pool_addresses):
+            ticks = pool_ticks.setdefault(Web3.toChecksumAddress(address), {})
+            ticks.update(dict.fromkeys(positions[token_id][0][3:5]))
+        return {address: list(ticks) for address, ticks in pool_ticks.items()}
+
+    def read(self, positions: Dict[int, tuple], pool_addresses: Sequence[str],
+             block: BlockIdentifier = 'latest') -> Dict[int, PositionFees]:
+        """positions 的未领取手续费，需要的池子状态一次 multicall 读完"""
+        pool_ticks = self.pool_ticks(positions, pool_addresses)
+        if not pool_ticks:
+            return {}
+        block_number, results = self.multicall.aggregate(self.calls(pool_ticks), block=block)
+        return compute_fees(positions, pool_addresses, self.decode(pool_ticks, block_number, results))
@@ -0,0 +1,162 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+钱包持有的 position（NFT token id）本地索引。
+
+第一次查某个 owner 时 bootstrap：multicall 读 balanceOf，再把 tokenOfOwnerByIndex(owner, 0..n-1) 一次读完，
+两次读取固定在同一个区块。之后只拉这个区块之后 NFT manager 的 Transfer 事件增量更新
+（转出、burn 是 from = owner，转入、mint 是 to = owner），所有 owner 的查询放在一个 JSON-RPC batch 里。
+
+    index = get_position_index(w3, nft_manager_address)
+    index.list_positions(owner)                        # [token_id, ...]
+    index.list_positions(owner, with_positions=True)   # {token_id: positions() 结果}
+"""
+import functools
+import threading
+from typing import Dict, Iterable, List, Optional
+from eth_utils import event_abi_to_log_topic
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.types import BlockIdentifier
+from batch import RPCBatch
+from encoders import encode_positions
+from multicall import Multicall, output_types
+from utils import _load_contract_json
+
+
+def _address_topic(address) -> str:
+    return '0x' + '00' * 12 + Web3.toChecksumAddress(address)[2:].lower()
+
+
+class PositionIndex():
+    """owner -> token id 集合，每个 owner 记录自己同步到的区块；不处理 reorg"""
+
+    def __init__(self, w3: Web3, nft_manager_address):
+        self.w3 = w3
+        self.nft_manager_address = Web3.toChecksumAddress(nft_manager_address)
+        self.nft_manager = _load_contract_json(w3, "NonfungiblePositionManager", self.nft_manager_address)
+        self.multicall = Multicall(w3)
+        transfer_abi = next(e for e in self.nft_manager.abi if e.get('type') == 'event' and e['name'] == 'Transfer')
+        self._transfer_topic = Web3.toHex(event_abi_to_log_topic(transfer_abi))
+        self._tokens = {}
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def owners(self) -> List[str]:
+        return list(self._tokens)
+
+    def bootstrap(self, owner, block: BlockIdentifier = 'latest') -> int:
+        """balanceOf + tokenOfOwnerByIndex 读 owner 当前的全部 token，返回读取的区块号"""
+        owner = Web3.toChecksumAddress(owner)
+        block_number, results = self.multicall.aggregate(
+            [(self.nft_manager_address, self.nft_manager.encodeABI("balanceOf", [owner]))], block=block)
+        balance = self.multicall.decode(output_types(self.nft_manager, "balanceOf"), results[0])
+        if balance is None:
+            raise Exception(f"balanceOf({owner}) call failed")
+        calls = [(self.nft_manager_address, self.nft_manager.encodeABI("tokenOfOwnerByIndex", [owner, i]))
+                 for i in range(balance[0])]
+        tokens = set()
+        if calls:
+            _, results = self.multicall.aggregate(calls, block=block_number)
+            types = output_types(self.nft_manager, "tokenOfOwnerByIndex")
+            for i, result in enumerate(results):
+                token_id = self.multicall.decode(types, result)
+                if token_id is None:
+                    raise Exception(f"tokenOfOwnerByIndex({owner}, {i}) call failed")
+                tokens.add(token_id[0])
+        self.set_tokens(owner, tokens, block_number)
+        return block_number
+
+    def set_tokens(self, owner, tokens: Iterable[int], block_number: int):
+        """owner 在 block_number 时持有的全部 token（自己读 balanceOf/tokenOfOwnerByIndex 的调用方用）"""
+        with self._lock:
+            self._tokens[Web3.toChecksumAddress(owner)] = set(tokens)
+            self._blocks[Web3.toChecksumAddress(owner)] = block_number
+
+    def apply_log(self, log):
+        """一条 Transfer 日志，只更新已经索引、并且日志在它同步区块之后的 owner"""
+        topics = log['topics']
+        sender = Web3.toChecksumAddress(HexBytes(topics[1])[-20:])
+        recipient = Web3.toChecksumAddress(HexBytes(topics[2])[-20:])
+        token_id = int.from_bytes(HexBytes(topics[3]), 'big')
+        block_number = log['blockNumber']
+        block_number = int(block_number, 16) if isinstance(block_number, str) else block_number
+        with self._lock:
+            if sender in self._tokens and block_number > self._blocks[sender]:
+                self._tokens[sender].discard(token_id)
+            if recipient in self._tokens and block_number > self._blocks[recipient]:
+                self._tokens[recipient].add(token_id)
+
+    def apply_logs(self, logs: Iterable, to_block: int, owners: Optional[Iterable[str]] = None) -> int:
+        """
+        按 (区块, logIndex) 顺序应用，然后把 owners（默认全部）的同步区块推进到 to_block。
+        owner 之间互相转的 token 两个方向的查询都会返回，按 (transactionHash, logIndex) 去重，返回去重后的条数
+        """
+        logs = {(HexBytes(log['transactionHash']), log['logIndex']): log for log in logs}
+        for log in sorted(logs.values(), key=lambda log: (log['blockNumber'], log['logIndex'])):
+            self.apply_log(log)
+        with self._lock:
+            for owner in (owners if owners is not None else list(self._blocks)):
+                self._blocks[owner] = max(self._blocks[owner], to_block)
+        return len(logs)
+
+    def log_filters(self, to_block: int):
+        """落后于 to_block 的 owner，以及它们转出/转入两个方向的 Transfer 日志过滤条件"""
+        owners = [owner for owner, block in self._blocks.items() if block < to_block]
+        filters = []
+        for owner in owners:
+            for topics in ([self._transfer_topic, _address_topic(owner)],
+                           [self._transfer_topic, None, _address_topic(owner)]):
+                filters.append({
+                    'address': self.nft_manager_address,
+                    'fromBlock': self._blocks[owner] + 1,
+                    'toBlock': to_block,
+                    'topics': topics,
+                })
+        return owners, filters
+
+    def sync(self, to_block: BlockIdentifier = 'latest') -> int:
+        """所有已索引 owner 追到 to_block，全部过滤条件放在一个 batch 里查，返回日志条数"""
+        if not self._tokens:
+            return 0
+        if to_block == 'latest':
+            to_block = self.w3.eth.block_number
+        owners, filters = self.log_filters(to_block)
+        if not owners:
+            return 0
+        with RPCBatch(self.w3) as batch:
+            futures = [batch.get_logs(log_filter) for log_filter in filters]
+        return self.apply_logs([log for future in futures for log in future.result()], to_block, owners)
+
+    def token_ids(self, owner) -> List[int]:
+        with self._lock:
+            return sorted(self._tokens.get(Web3.toChecksumAddress(owner), ()))
+
+    def list_positions(self, owner, with_positions: bool = False, block: BlockIdentifier = 'latest'):
+        """
+        owner 的 token id（从小到大）。没索引过的 owner 先 bootstrap，之后每次只补同步区块之后的 Transfer。
+        with_positions 时返回 {token_id: positions() 结果}，positions 用一次 multicall 在同一个区块读
+        """
+        owner = Web3.toChecksumAddress(owner)
+        if owner not in self._tokens:
+            self.bootstrap(owner, block)
+        else:
+            self.sync(block)
+        token_ids = self.token_ids(owner)
+        if not with_positions:
+            return token_ids
+        return self.positions(token_ids, block)
+
+    def positions(self, token_ids: List[int], block: BlockIdentifier = 'latest') -> Dict[int, tuple]:
+        if not token_ids:
+            return {}
+        _, results = self.multicall.aggregate(
+            [(self.nft_manager_address, encode_positions(token_id)) for token_id in token_ids], block=block)
+        types = output_types(self.nft_manager, "positions")
+        return {token_id: self.multicall.decode(types, result) for token_id, result in zip(token_ids, results)}
+
+
+@functools.lru_cache()
+def get_position_index(w3: Web3, nft_manager_address) -> PositionIndex:
+    """同一个 Web3 和 NFT manager 共用一个 PositionIndex"""
+    return PositionIndex(w3, nft_manager_address)
@@ -0,0 +1,305 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多个 RPC 节点的连接池 provider：每个节点一个长连接 session，按延迟和错误率选最快的健康节点。
+
+读请求（HEDGED_METHODS）做 hedging：先发给最快的节点，超过这个节点的 p95 延迟还没回来，
+就把同一个请求再发给第二快的节点，谁先回来用谁，慢节点/卡住的节点不再决定我们的尾延迟。
+发交易之类的写请求不 hedge，只在连接失败时换下一个节点。
+
+    w3 = _get_web3(('https://node-a', 'https://node-b', 'https://node-c'))
+    w3.provider.stats()
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, List, Sequence
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from web3.providers.async_base import AsyncJSONBaseProvider
+from web3.providers.base import JSONBaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+RPC_POOL_MAXSIZE = 32
+RPC_TIMEOUT = 10
+# 还没有延迟样本时 hedge 的等待时间，以及 hedge 等待的下限
+HEDGE_MIN_DELAY = 0.05
+LATENCY_WINDOW = 200
+# 连续失败这么多次后暂停使用这个节点，暂停时间指数增长
+FAILURES_BEFORE_COOLDOWN = 3
+COOLDOWN_MAX = 60.0
+
+HEDGED_METHODS = frozenset((
+    'eth_blockNumber',
+    'eth_call',
+    'eth_chainId',
+    'eth_estimateGas',
+    'eth_feeHistory',
+    'eth_gasPrice',
+    'eth_getBalance',
+    'eth_getBlockByNumber',
+    'eth_getCode',
+    'eth_getStorageAt',
+    'eth_getTransactionByHash',
+    'eth_getTransactionCount',
+    'eth_getTransactionReceipt',
+    'eth_maxPriorityFeePerGas',
+    'net_version',
+))
+
+
+class EndpointStats():
+    """一个节点最近 LATENCY_WINDOW 次请求的延迟，以及错误率（指数平均）和连续失败次数"""
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.requests = 0
+        self.errors = 0
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        self._samples = deque(maxlen=LATENCY_WINDOW)
+        self._sorted = None
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool):
+        with self._lock:
+            self.requests += 1
+            self.error_rate = self.error_rate * 0.9 + (0.0 if ok else 0.1)
+            if ok:
+                self._samples.append(latency)
+                self._sorted = None
+                self.consecutive_failures = 0
+                self.down_until = 0.0
+            else:
+                self.errors += 1
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= FAILURES_BEFORE_COOLDOWN:
+                    backoff = 2 ** (self.consecutive_failures - FAILURES_BEFORE_COOLDOWN)
+                    self.down_until = time.monotonic() + min(backoff, COOLDOWN_MAX)
+
+    def percentile(self, q: float) -> float:
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            if self._sorted is None:
+                self._sorted = sorted(self._samples)
+            return self._sorted[min(int(len(self._sorted) * q), len(self._sorted) - 1)]
+
+    @property
+    def healthy(self) -> bool:
+        return self.down_until <= time.monotonic()
+
+    def score(self) -> float:
+        """越小越好：中位延迟按错误率加权。还没请求过的节点排最前面先探测一次，只失败过的排最后"""
+        if not self._samples:
+            return float('inf') if self.errors else 0.0
+        return self.percentile(0.5) * (1 + 10 * self.error_rate)
+
+    def as_dict(self) -> dict:
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'error_rate': round(self.error_rate, 4),
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'healthy': self.healthy,
+        }
+
+
+class _EndpointRouter():
+    """同步和异步 provider 共用的节点排序和统计"""
+
+    def __init__(self, endpoint_uris: Sequence[str], hedge_min_delay: float):
+        if not endpoint_uris:
+            raise ValueError("at least one endpoint is required")
+        self.endpoints = [EndpointStats(uri) for uri in endpoint_uris]
+        self.hedge_min_delay = hedge_min_delay
+
+    def ranked(self) -> List[EndpointStats]:
+        """健康节点按 score 从小到大，暂停中的节点放最后（全部暂停时仍然会尝试）"""
+        healthy = sorted((e for e in self.endpoints if e.healthy), key=EndpointStats.score)
+        cooling = sorted((e for e in self.endpoints if not e.healthy), key=lambda e: e.down_until)
+        return healthy + cooling
+
+    def hedge_delay(self, endpoint: EndpointStats) -> float:
+        return max(endpoint.percentile(0.95), self.hedge_min_delay)
+
+    def stats(self) -> dict:
+        return {e.uri: e.as_dict() for e in self.endpoints}
+
+
+class PooledHTTPProvider(JSONBaseProvider):
+    """同步版本，hedge 的请求在线程池里发，输掉的那个请求照常跑完，延迟也计入统计"""
+
+    def __init__(self, endpoint_uris: Sequence[str], pool_maxsize: int = RPC_POOL_MAXSIZE,
+                 timeout: float = RPC_TIMEOUT, hedge_methods=HEDGED_METHODS, hedge_min_delay: float = HEDGE_MIN_DELAY):
+        super().__init__()
+        self.router = _EndpointRouter(endpoint_uris, hedge_min_delay)
+        self.timeout = timeout
+        self.hedge_methods = hedge_methods
+        self._sessions = {}
+        for endpoint in self.router.endpoints:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Content-Type': 'application/json'})
+            self._sessions[endpoint.uri] = session
+        self._executor = ThreadPoolExecutor(max_workers=pool_maxsize, thread_name_prefix='rpc-pool')
+
+    def __str__(self):
+        return f"Pooled RPC connection {[e.uri for e in self.router.endpoints]}"
+
+    def stats(self) -> dict:
+        return self.router.stats()
+
+    def _post(self, endpoint: EndpointStats, request_data: bytes) -> bytes:
+        start = time.monotonic()
+        try:
+            response = self._sessions[endpoint.uri].post(endpoint.uri, data=request_data, timeout=self.timeout)
+            response.raise_for_status()
+        except Exception:
+            endpoint.record(time.monotonic() - start, False)
+            raise
+        endpoint.record(time.monotonic() - start, True)
+        return response.content
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        return self.decode_rpc_response(self.send_raw(self.encode_rpc_request(method, params), method))
+
+    def send_raw(self, request_data: bytes, method: str = None) -> bytes:
+        """发一个已经编码好的 JSON-RPC payload，返回原始响应"""
+        endpoints = self.router.ranked()
+        if method in self.hedge_methods and len(endpoints) > 1:
+            return self._hedged(request_data, endpoints)
+        error = None
+        for endpoint in endpoints:
+            try:
+                return self._post(endpoint, request_data)
+            except requests.RequestException as e:
+                error = e
+        raise error
+
+    def _hedged(self, request_data: bytes, endpoints: List[EndpointStats]) -> bytes:
+        pending = {self._executor.submit(self._post, endpoints[0], request_data)}
+        done, _ = wait(pending, timeout=self.router.hedge_delay(endpoints[0]))
+        backups = iter(endpoints[1:])
+        if not done:
+            pending.add(self._executor.submit(self._post, next(backups), request_data))
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except requests.RequestException as e:
+                    error = e
+            if not pending:
+                # 发出去的都失败了，换下一个节点
+                endpoint = next(backups, None)
+                if endpoint is not None:
+                    pending.add(self._executor.submit(self._post, endpoint, request_data))
+        raise error
+
+    def isConnected(self) -> bool:
+        try:
+            response = self.make_request(RPCEndpoint('web3_clientVersion'), [])
+        except Exception:
+            return False
+        return 'error' not in response
+
+
+class AsyncPooledHTTPProvider(AsyncJSONBaseProvider):
+    """asyncio 版本，给 AsyncKyberswapv3Client 用，每个节点一个 aiohttp.ClientSession"""
+
+    def __init__(self, endpoint_uris: Sequence[str], pool_maxsize: int = RPC_POOL_MAXSIZE,
+                 timeout: float = RPC_TIMEOUT, hedge_methods=HEDGED_METHODS, hedge_min_delay: float = HEDGE_MIN_DELAY):
+        super().__init__()
+        self.router = _EndpointRouter(endpoint_uris, hedge_min_delay)
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.hedge_methods = hedge_methods
+        self._sessions = {}
+
+    def __str__(self):
+        return f"Async pooled RPC connection {[e.uri for e in self.router.endpoints]}"
+
+    def stats(self) -> dict:
+        return self.router.stats()
+
+    def _session(self, endpoint: EndpointStats) -> aiohttp.ClientSession:
+        # session 绑定创建它的事件循环，第一次用的时候再建
+        session = self._sessions.get(endpoint.uri)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_maxsize, keepalive_timeout=60),
+                headers={'Content-Type': 'application/json'},
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._sessions[endpoint.uri] = session
+        return session
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    async def _post(self, endpoint: EndpointStats, request_data: bytes) -> bytes:
+        start = time.monotonic()
+        try:
+            async with self._session(endpoint).post(endpoint.uri, data=request_data) as response:
+                response.raise_for_status()
+                content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            endpoint.record(time.monotonic() - start, False)
+            raise
+        endpoint.record(time.monotonic() - start, True)
+        return content
+
+    async def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        return self.decode_rpc_response(await self.send_raw(self.encode_rpc_request(method, params), method))
+
+    async def send_raw(self, request_data: bytes, method: str = None) -> bytes:
+        endpoints = self.router.ranked()
+        if method in self.hedge_methods and len(endpoints) > 1:
+            return await self._hedged(request_data, endpoints)
+        error = None
+        for endpoint in endpoints:
+            try:
+                return await self._post(endpoint, request_data)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+        raise error
+
+    async def _hedged(self, request_data: bytes, endpoints: List[EndpointStats]) -> bytes:
+        pending = {asyncio.ensure_future(self._post(endpoints[0], request_data))}
+        done, _ = await asyncio.wait(pending, timeout=self.router.hedge_delay(endpoints[0]))
+        backups = iter(endpoints[1:])
+        if not done:
+            pending.add(asyncio.ensure_future(self._post(next(backups), request_data)))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e
+                    continue
+                # 输掉的请求不取消，让它跑完把延迟记进统计
+                return result
+            if not pending:
+                endpoint = next(backups, None)
+                if endpoint is not None:
+                    pending.add(asyncio.ensure_future(self._post(endpoint, request_data)))
+        raise error
+
+    async def isConnected(self) -> bool:
+        try:
+            response = await self.make_request(RPCEndpoint('web3_clientVersion'), [])
+        except Exception:
+            return False
+        return 'error' not in response
@@ -0,0 +1,90 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程签名：ECDSA 签名和 RLP 编码是纯 CPU 计算并且占着 GIL，批量交易放到进程池里并行签。
+
+私钥只在进程池启动时通过 initializer 传给每个 worker 一次，之后每个任务只传交易 dict。
+
+    with SigningService([private_key]) as signer:
+        raw_txs = signer.sign_many(transactions)     # 顺序和 transactions 一致
+
+transactions 要已经填好 nonce/gas/手续费/chainId（fill_transaction_defaults 之后的 dict），
+用 'from' 对应的私钥签，不带 'from' 时用第一个私钥。
+"""
+import multiprocessing
+import os
+from typing import Dict, Iterable, List, Optional
+from eth_account import Account
+from web3 import Web3
+
+# 少于这么多笔交易时直接在当前进程签，进程间传输的开销比签名本身还大
+SIGN_PARALLEL_MIN = 8
+SIGN_CHUNK_SIZE = 16
+
+# worker 进程里的 {address: LocalAccount}，dict 保持插入顺序，第一个是默认账户
+_worker_accounts = {}
+
+
+def _load_accounts(private_keys: List[str]) -> Dict[str, object]:
+    accounts = [Account.from_key(key) for key in private_keys]
+    return {account.address: account for account in accounts}
+
+
+def _init_worker(private_keys: List[str]):
+    global _worker_accounts
+    _worker_accounts = _load_accounts(private_keys)
+
+
+def _sign(accounts: Dict[str, object], transaction: dict) -> bytes:
+    sender = transaction.get('from')
+    account = accounts.get(Web3.toChecksumAddress(sender)) if sender else next(iter(accounts.values()), None)
+    if account is None:
+        raise Exception(f"no private key loaded for {sender}")
+    return bytes(account.sign_transaction(transaction).rawTransaction)
+
+
+def _sign_chunk(transactions: List[dict]) -> List[bytes]:
+    return [_sign(_worker_accounts, transaction) for transaction in transactions]
+
+
+class SigningService():
+
+    def __init__(self, private_keys: Iterable[str], processes: Optional[int] = None,
+                 chunk_size: int = SIGN_CHUNK_SIZE, parallel_min: int = SIGN_PARALLEL_MIN):
+        self.private_keys = [key for key in private_keys if key]
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.parallel_min = parallel_min
+        # 小批量和单笔在当前进程签
+        self._accounts = _load_accounts(self.private_keys)
+        self.addresses = list(self._accounts)
+        self._pool = None
+
+    def start(self) -> 'SigningService':
+        if self._pool is None and self.processes > 1:
+            self._pool = multiprocessing.Pool(self.processes, initializer=_init_worker,
+                                              initargs=(self.private_keys,))
+        return self
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self) -> 'SigningService':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def sign(self, transaction: dict) -> bytes:
+        return _sign(self._accounts, transaction)
+
+    def sign_many(self, transactions: List[dict]) -> List[bytes]:
+        """一批交易的签名后 raw bytes，顺序和 transactions 一致"""
+        transactions = list(transactions)
+        if self._pool is None or len(transactions) < self.parallel_min:
+            return [_sign(self._accounts, transaction) for transaction in transactions]
+        chunks = [transactions[i:i + self.chunk_size] for i in range(0, len(transactions), self.chunk_size)]
+        return [raw for raws in self._pool.imap(_sign_chunk, chunks) for raw in raws]
@@ -0,0 +1,263 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+websocket eth_subscribe 推送新区块和池子日志，代替轮询。
+
+一个连接上订阅 newHeads 和 logs（address 是 MARKET_INFO_DICT 里的池子，topic 是要的池子事件），
+日志用 log_ingester 的 EventDecoder 解成 SwapLog/MintLog/...，分发给每个消费者自己的 asyncio.Queue：
+
+    subscriber = Subscriber('ws://127.0.0.1:8546', ['ETH_USDT'])
+    asyncio.ensure_future(subscriber.run())
+    async for head in subscriber.heads():
+        fee_engine.on_new_block(head.number)
+    async for record in subscriber.logs():
+        if isinstance(record, SwapLog):
+            valuer.on_swap(record)
+
+断线后按指数退避重连，重新订阅之后用 eth_getLogs 补上断线期间（从最后收到的区块开始）的日志；
+补日志期间推送过来的日志先缓存，补完再按 (区块, logIndex) 去重后一起发出去，消费者看到的顺序不变。
+newHeads 断线期间漏掉的区块不补，重连后只发最新的区块头。不处理 reorg（removed 的日志直接丢掉）。
+补日志时节点报结果太多/范围太大就和 LogIngester 一样缩小范围重试，被限流就退避后重试同一段；
+其他 JSON-RPC 错误（订阅失败、缩到一个区块还是太多）断开重连，run() 不会因此退出。
+"""
+import asyncio
+import itertools
+import json
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional
+import aiohttp
+from hexbytes import HexBytes
+from web3 import Web3
+from constant import MARKET_INFO_DICT
+from log_ingester import (POOL_EVENT_RECORDS, RATE_LIMIT_DELAY_MAX, RATE_LIMIT_DELAY_MIN, RATE_LIMITED,
+                          TOO_MANY_RESULTS, classify_log_error, pool_event_decoders)
+
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30.0
+# 重连后补日志时每次 eth_getLogs 的区块跨度，节点报结果太多时缩小，之后的重连沿用
+BACKFILL_SPAN = 2000
+REQUEST_TIMEOUT = 30.0
+WS_HEARTBEAT = 30.0
+
+
+class NewHead(NamedTuple):
+    number: int
+    hash: str
+    parentHash: str
+    timestamp: int
+    baseFeePerGas: Optional[int]
+
+
+def _to_int(value) -> int:
+    return int(value, 16) if isinstance(value, str) else value
+
+
+class Subscriber():
+
+    def __init__(self, ws_url: str, symbols: Optional[List[str]] = None, events=tuple(POOL_EVENT_RECORDS),
+                 start_block: Optional[int] = None, queue_size: int = 0):
+        """symbols 默认是 MARKET_INFO_DICT['kyberswapv3'] 里的全部池子；start_block 给了时第一次连上就从它开始补日志"""
+        market_info = MARKET_INFO_DICT['kyberswapv3']
+        symbols = symbols if symbols is not None else [s for s, info in market_info.items() if 'feeTier' in info]
+        self.ws_url = ws_url
+        self.symbols = {market_info[symbol]['id'].lower(): symbol for symbol in symbols}
+        self.addresses = [Web3.toChecksumAddress(address) for address in self.symbols]
+        # 只用 codec 解码，不需要 provider
+        self.decoders = pool_event_decoders(Web3(), events)
+        self.queue_size = queue_size
+        self.head: Optional[NewHead] = None
+        self.connects = 0
+        self.backfill_span = BACKFILL_SPAN
+        self._from_block = start_block
+        self._last_log = (-1, -1)
+        self._head_queues: List[asyncio.Queue] = []
+        self._log_queues: List[asyncio.Queue] = []
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._handlers = {}
+        self._buffer: Optional[list] = None
+        self._closed = False
+        self._ws = None
+        self._delay = RECONNECT_DELAY_MIN
+
+    def heads(self) -> AsyncIterator[NewHead]:
+        return self._iterate(self._head_queues)
+
+    def logs(self) -> AsyncIterator[tuple]:
+        return self._iterate(self._log_queues)
+
+    async def _iterate(self, queues: List[asyncio.Queue]):
+        # 每个消费者一个队列，慢的消费者不会挡住别人
+        queue = asyncio.Queue(self.queue_size)
+        queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            queues.remove(queue)
+
+    @staticmethod
+    def _publish(queues: List[asyncio.Queue], item):
+        for queue in queues:
+            if queue.full():
+                # 队列满了丢最旧的
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    async def close(self):
+        self._closed = True
+        if self._ws is not None:
+            await self._ws.close()
+
+    async def run(self):
+        """一直运行到 close()：连接、订阅、补日志、收推送，断线后重连"""
+        self._delay = RECONNECT_DELAY_MIN
+        async with aiohttp.ClientSession() as session:
+            while not self._closed:
+                try:
+                    async with session.ws_connect(self.ws_url, max_msg_size=0, heartbeat=WS_HEARTBEAT) as ws:
+                        self._ws = ws
+                        self.connects += 1
+                        await self._session(ws)
+                    if not self._closed:
+                        print(f"websocket {self.ws_url} closed, reconnecting in {self._delay}s")
+                except (aiohttp.ClientError, OSError, asyncio.TimeoutError, ValueError) as e:
+                    # ValueError 是节点返回的 JSON-RPC error，重连后重新订阅、重新补日志
+                    if not self._closed:
+                        print(f"websocket {self.ws_url} disconnected: {e!r}, reconnecting in {self._delay}s")
+                finally:
+                    self._ws = None
+                    self._handlers.clear()
+                if self._closed:
+                    break
+                await asyncio.sleep(self._delay)
+                self._delay = min(self._delay * 2, RECONNECT_DELAY_MAX)
+
+    async def _session(self, ws):
+        # 订阅之后 head 会被新推送的区块覆盖，补日志的起点要在订阅前定下来
+        from_block = self._resume_block()
+        reader = asyncio.ensure_future(self._read(ws))
+        try:
+            # 先缓存推送再订阅，补完日志才放出来，补的和推的之间不会漏也不会乱序
+            self._buffer = []
+            heads_id = await self._request(ws, 'eth_subscribe', ['newHeads'])
+            self._handlers[heads_id] = self._on_head
+            logs_id = await self._request(ws, 'eth_subscribe', ['logs', {
+                'address': self.addresses,
+                'topics': [[decoder.topic.hex() for decoder in self.decoders.values()]],
+            }])
+            self._handlers[logs_id] = lambda log: self._on_logs([log])
+            if from_block is not None:
+                await self._backfill(ws, from_block)
+            buffered, self._buffer = self._buffer, None
+            self._on_logs(buffered)
+            # 订阅和补日志都成功了才重置退避，一直报错的节点不会被每 RECONNECT_DELAY_MIN 秒重连一次
+            self._delay = RECONNECT_DELAY_MIN
+            await reader
+        finally:
+            self._buffer = None
+            reader.cancel()
+
+    async def _read(self, ws):
+        try:
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                message = json.loads(message.data)
+                if message.get('method') == 'eth_subscription':
+                    params = message['params']
+                    handler = self._handlers.get(params['subscription'])
+                    if handler is not None:
+                        handler(params['result'])
+                    continue
+                future = self._pending.pop(message.get('id'), None)
+                if future is None or future.done():
+                    continue
+                if 'error' in message:
+                    future.set_exception(ValueError(message['error']))
+                else:
+                    future.set_result(message.get('result'))
+        finally:
+            # 连接断了，还在等响应的请求马上失败，不用等 REQUEST_TIMEOUT
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"websocket {self.ws_url} closed"))
+            self._pending.clear()
+
+    async def _request(self, ws, method: str, params: list):
+        request_id = next(self._ids)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        await ws.send_str(json.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params}))
+        return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+
+    def _resume_block(self) -> Optional[int]:
+        """断线前最后收到的区块（含），还没连上过时是 start_block"""
+        if self.head is not None:
+            return self.head.number
+        if self._last_log[0] >= 0:
+            return self._last_log[0]
+        return self._from_block
+
+    async def _backfill(self, ws, from_block: int):
+        """
+        from_block 补到当前区块。补到的日志和期间推送的一样先进缓存，放出来时一起排序，
+        已经发过的按 (区块, logIndex) 去掉
+        """
+        to_block = _to_int(await self._request(ws, 'eth_blockNumber', []))
+        topics = [[decoder.topic.hex() for decoder in self.decoders.values()]]
+        start = from_block
+        delay = RATE_LIMIT_DELAY_MIN
+        while start <= to_block:
+            end = min(start + self.backfill_span - 1, to_block)
+            try:
+                logs = await self._request(ws, 'eth_getLogs', [{
+                    'address': self.addresses, 'fromBlock': hex(start), 'toBlock': hex(end), 'topics': topics}])
+            except ValueError as e:
+                kind, suggested = classify_log_error(e.args[0] if e.args else e)
+                if kind == TOO_MANY_RESULTS and end > start:
+                    if suggested is not None and start <= suggested < end:
+                        self.backfill_span = suggested - start + 1
+                    else:
+                        self.backfill_span = max((end - start + 1) // 2, 1)
+                    continue
+                if kind == RATE_LIMITED:
+                    print(f"eth_getLogs [{start}, {end}] rate limited, retrying in {delay}s")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RATE_LIMIT_DELAY_MAX)
+                    continue
+                raise
+            self._on_logs(logs)
+            start = end + 1
+            delay = RATE_LIMIT_DELAY_MIN
+
+    def _on_head(self, head: dict):
+        number = _to_int(head['number'])
+        if self.head is not None and number <= self.head.number:
+            return
+        base_fee = head.get('baseFeePerGas')
+        self.head = NewHead(number, head['hash'], head['parentHash'], _to_int(head['timestamp']),
+                            _to_int(base_fee) if base_fee is not None else None)
+        self._publish(self._head_queues, self.head)
+
+    def _on_logs(self, logs: List[dict]):
+        if self._buffer is not None:
+            self._buffer.extend(logs)
+            return
+        fresh = [log for log in logs if not log.get('removed')
+                 and (_to_int(log['blockNumber']), _to_int(log['logIndex'])) > self._last_log]
+        if not fresh:
+            return
+        groups = {}
+        for log in fresh:
+            groups.setdefault(HexBytes(log['topics'][0]), []).append(log)
+        records = []
+        for topic, group in groups.items():
+            decoder = self.decoders.get(topic)
+            if decoder is not None:
+                records.extend(decoder.decode(group, self.symbols))
+        records.sort(key=lambda record: (record.blockNumber, record.logIndex))
+        for record in records:
+            if (record.blockNumber, record.logIndex) <= self._last_log:
+                continue
+            self._last_log = (record.blockNumber, record.logIndex)
+            self._publish(self._log_queues, record)
@@ -0,0 +1,126 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SqrtPriceMath / SwapMath 的整数实现，舍入方向和合约逐行对应
+https://github.com/Uniswap/v3-core/blob/main/contracts/libraries/SqrtPriceMath.sol
+https://github.com/Uniswap/v3-core/blob/main/contracts/libraries/SwapMath.sol
+
+python int 没有溢出，FullMath.mulDiv 就是 a * b // c；合约里用溢出判断分支的地方保留了同样的分支。
+"""
+from tick_math import Q96
+
+FEE_UNITS = 10 ** 6
+MAX_UINT160 = (1 << 160) - 1
+MAX_UINT256 = (1 << 256) - 1
+
+
+def mul_div_rounding_up(a: int, b: int, denominator: int) -> int:
+    return -(-(a * b) // denominator)
+
+
+def div_rounding_up(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+def get_amount0_delta(sqrt_ratio_a: int, sqrt_ratio_b: int, liquidity: int, round_up: bool) -> int:
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a, sqrt_ratio_b = sqrt_ratio_b, sqrt_ratio_a
+    numerator1 = liquidity << 96
+    numerator2 = sqrt_ratio_b - sqrt_ratio_a
+    if round_up:
+        return div_rounding_up(mul_div_rounding_up(numerator1, numerator2, sqrt_ratio_b), sqrt_ratio_a)
+    return numerator1 * numerator2 // sqrt_ratio_b // sqrt_ratio_a
+
+
+def get_amount1_delta(sqrt_ratio_a: int, sqrt_ratio_b: int, liquidity: int, round_up: bool) -> int:
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a, sqrt_ratio_b = sqrt_ratio_b, sqrt_ratio_a
+    if round_up:
+        return mul_div_rounding_up(liquidity, sqrt_ratio_b - sqrt_ratio_a, Q96)
+    return liquidity * (sqrt_ratio_b - sqrt_ratio_a) // Q96
+
+
+def _next_sqrt_price_from_amount0_rounding_up(sqrt_price: int, liquidity: int, amount: int, add: bool) -> int:
+    if amount == 0:
+        return sqrt_price
+    numerator1 = liquidity << 96
+    product = amount * sqrt_price
+    if add:
+        if product <= MAX_UINT256 and numerator1 + product <= MAX_UINT256:
+            return mul_div_rounding_up(numerator1, sqrt_price, numerator1 + product)
+        return div_rounding_up(numerator1, numerator1 // sqrt_price + amount)
+    if product > MAX_UINT256 or numerator1 <= product:
+        raise ValueError("not enough liquidity for amount0 output")
+    result = mul_div_rounding_up(numerator1, sqrt_price, numerator1 - product)
+    if result > MAX_UINT160:
+        raise ValueError("sqrt price overflow")
+    return result
+
+
+def _next_sqrt_price_from_amount1_rounding_down(sqrt_price: int, liquidity: int, amount: int, add: bool) -> int:
+    if add:
+        return sqrt_price + (amount << 96) // liquidity
+    quotient = div_rounding_up(amount << 96, liquidity)
+    if sqrt_price <= quotient:
+        raise ValueError("not enough liquidity for amount1 output")
+    return sqrt_price - quotient
+
+
+def get_next_sqrt_price_from_input(sqrt_price: int, liquidity: int, amount_in: int, zero_for_one: bool) -> int:
+    if zero_for_one:
+        return _next_sqrt_price_from_amount0_rounding_up(sqrt_price, liquidity, amount_in, True)
+    return _next_sqrt_price_from_amount1_rounding_down(sqrt_price, liquidity, amount_in, True)
+
+
+def get_next_sqrt_price_from_output(sqrt_price: int, liquidity: int, amount_out: int, zero_for_one: bool) -> int:
+    if zero_for_one:
+        return _next_sqrt_price_from_amount1_rounding_down(sqrt_price, liquidity, amount_out, False)
+    return _next_sqrt_price_from_amount0_rounding_up(sqrt_price, liquidity, amount_out, False)
+
+
+def compute_swap_step(sqrt_ratio_current: int, sqrt_ratio_target: int, liquidity: int, amount_remaining: int,
+                      fee_pips: int):
+    """SwapMath.computeSwapStep，返回 (sqrtRatioNextX96, amountIn, amountOut, feeAmount)"""
+    zero_for_one = sqrt_ratio_current >= sqrt_ratio_target
+    exact_in = amount_remaining >= 0
+    if exact_in:
+        amount_remaining_less_fee = amount_remaining * (FEE_UNITS - fee_pips) // FEE_UNITS
+        if zero_for_one:
+            amount_in = get_amount0_delta(sqrt_ratio_target, sqrt_ratio_current, liquidity, True)
+        else:
+            amount_in = get_amount1_delta(sqrt_ratio_current, sqrt_ratio_target, liquidity, True)
+        if amount_remaining_less_fee >= amount_in:
+            sqrt_ratio_next = sqrt_ratio_target
+        else:
+            sqrt_ratio_next = get_next_sqrt_price_from_input(sqrt_ratio_current, liquidity,
+                                                             amount_remaining_less_fee, zero_for_one)
+    else:
+        if zero_for_one:
+            amount_out = get_amount1_delta(sqrt_ratio_target, sqrt_ratio_current, liquidity, False)
+        else:
+            amount_out = get_amount0_delta(sqrt_ratio_current, sqrt_ratio_target, liquidity, False)
+        if -amount_remaining >= amount_out:
+            sqrt_ratio_next = sqrt_ratio_target
+        else:
+            sqrt_ratio_next = get_next_sqrt_price_from_output(sqrt_ratio_current, liquidity,
+                                                              -amount_remaining, zero_for_one)
+
+    reached = sqrt_ratio_target == sqrt_ratio_next
+    if zero_for_one:
+        if not (reached and exact_in):
+            amount_in = get_amount0_delta(sqrt_ratio_next, sqrt_ratio_current, liquidity, True)
+        if not (reached and not exact_in):
+            amount_out = get_amount1_delta(sqrt_ratio_next, sqrt_ratio_current, liquidity, False)
+    else:
+        if not (reached and exact_in):
+            amount_in = get_amount1_delta(sqrt_ratio_current, sqrt_ratio_next, liquidity, True)
+        if not (reached and not exact_in):
+            amount_out = get_amount0_delta(sqrt_ratio_current, sqrt_ratio_next, liquidity, False)
+
+    if not exact_in and amount_out > -amount_remaining:
+        amount_out = -amount_remaining
+    if exact_in and sqrt_ratio_next != sqrt_ratio_target:
+        fee_amount = amount_remaining - amount_in
+    else:
+        fee_amount = mul_div_rounding_up(amount_in, fee_pips, FEE_UNITS - fee_pips)
+    return sqrt_ratio_next, amount_in, amount_out, fee_amount
@@ -0,0 +1,285 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 swap 模拟，替代 quoter 的 eth_call。
+
+和 UniswapV3Pool.swap 一样按 tickBitmap 的 word 边界分步（不只停在 initialized tick），
+每一步用 swap_math.compute_swap_step，跨过 initialized tick 时加减 liquidityNet，所以结果和链上逐位一致。
+池子状态来自 PoolStateCache（slot0/liquidity/tickSpacing），tick 分布来自 TickIndex，fee 是池子的 fee（百万分之一）。
+
+只覆盖 Uniswap v3 池子。MARKET_INFO_DICT（market_registry）里登记的 market 全部是 KyberSwap Elastic 池子，
+都不在覆盖范围内，from_pool 对它们直接报错：Elastic 的 fee 是 swapFeeUnits（十万分之一），手续费作为
+reinvestment liquidity 留在池子里参与之后的价格计算，按这里的算法算会和 Elastic 的 quoter 对不上。
+TickIndex 能读 Elastic 池子的 tick 分布，但 Elastic 的 swap 步骤这里没有实现。
+
+和 quoter 的对比可以离线重放：record_quoter_vectors 在同一个区块读池子状态、全部 tick 和 quoter 的结果写成 json，
+SwapSimulator.from_vectors 不访问网络还原出同一个池子，tests/test_swap_simulator.py 重放 tests/fixtures 里的
+quoter_*.json。录制要连 mainnet 节点，还没有录好的文件时重放测试跳过。
+
+同一个区块里要试很多个 exact input 数量时用 quote_exact_input_many：完整走完的每一步和输入数量无关，
+只算一次，之后每个数量二分找到最后一个走完的步，再从那里接着算剩下的一两步。
+"""
+import bisect
+import json
+from typing import List, NamedTuple, Optional
+from web3 import Web3
+from web3.types import BlockIdentifier
+from market_registry import get_market_registry
+from pool_state import PoolState, get_pool_state_cache
+from swap_math import FEE_UNITS, compute_swap_step, mul_div_rounding_up
+from tick_index import TickIndex
+from tick_math import MAX_SQRT_RATIO, MAX_TICK, MIN_SQRT_RATIO, MIN_TICK, get_sqrt_ratio_at_tick, get_tick_at_sqrt_ratio
+from utils import _load_contract
+
+
+class SwapResult(NamedTuple):
+    amount0: int
+    amount1: int
+    amountIn: int
+    amountOut: int
+    sqrtPriceX96: int
+    tick: int
+    liquidity: int
+    ticksCrossed: int
+
+
+class _SwapState(NamedTuple):
+    sqrtPriceX96: int
+    tick: int
+    liquidity: int
+    ticksCrossed: int
+
+
+class SwapSimulator():
+    """
+        sim = SwapSimulator.from_pool(w3, '0x8ad599c3a0ff1de082011efddc58f1908eb6e6d8', 3000)     # Uniswap v3 USDC/ETH
+        sim.quote_exact_input(zero_for_one=True, amount_in=10 ** 18)
+        sim.quote_exact_input_many(True, [10 ** 15 * i for i in range(1, 5000)])
+    """
+
+    def __init__(self, state: PoolState, index: TickIndex, fee: int):
+        self.state = state
+        self.index = index
+        self.fee = fee
+        self.tick_spacing = state.tickSpacing
+        self._paths = {}
+
+    @classmethod
+    def from_pool(cls, w3: Web3, pool_address, fee: int, block: BlockIdentifier = 'latest') -> 'SwapSimulator':
+        """Uniswap v3 池子，fee 是池子的 fee()（百万分之一），slot0/liquidity 和 tick 分布读自同一个区块"""
+        if get_market_registry().market_by_pool(pool_address) is not None:
+            raise Exception(f"{pool_address} is a KyberSwap Elastic pool, SwapSimulator only covers Uniswap v3 pools")
+        state = get_pool_state_cache(w3, 'UniswapV3Pool').get(pool_address, block)
+        index = TickIndex(w3, pool_address, pool_abi='UniswapV3Pool').bootstrap(state.block)
+        return cls(state, index, fee)
+
+    @classmethod
+    def from_vectors(cls, vectors: dict) -> 'SwapSimulator':
+        """record_quoter_vectors 写下的池子状态和 tick 分布，不访问网络"""
+        index = TickIndex(Web3(), vectors['pool'], pool_abi='UniswapV3Pool')
+        index.block = vectors['block']
+        index.tick_spacing = vectors['tickSpacing']
+        index.ticks = list(vectors['ticks'])
+        index.liquidity_gross = list(vectors['liquidityGross'])
+        index.liquidity_net = list(vectors['liquidityNet'])
+        state = PoolState(vectors['block'], vectors['sqrtPriceX96'], vectors['tick'], vectors['liquidity'],
+                          vectors['tickSpacing'])
+        return cls(state, index, vectors['fee'])
+
+    def _next_initialized_tick_within_one_word(self, tick: int, lte: bool):
+        """TickBitmap.nextInitializedTickWithinOneWord，返回 (tickNext, initialized)"""
+        spacing = self.tick_spacing
+        compressed = tick // spacing
+        if lte:
+            word_start = (compressed >> 8) << 8
+            tick_next = self.index.next_initialized_tick(compressed * spacing, lte=True)
+            if tick_next is not None and tick_next // spacing >= word_start:
+                return tick_next, True
+            return word_start * spacing, False
+        word_end = (((compressed + 1) >> 8) << 8) + 255
+        tick_next = self.index.next_initialized_tick(compressed * spacing, lte=False)
+        if tick_next is not None and tick_next // spacing <= word_end:
+            return tick_next, True
+        return word_end * spacing, False
+
+    def _step(self, state: _SwapState, zero_for_one: bool, amount_remaining: int, sqrt_price_limit: int):
+        """swap 循环的一次迭代，返回 (新状态, amountIn, feeAmount, amountOut)"""
+        tick_next, initialized = self._next_initialized_tick_within_one_word(state.tick, zero_for_one)
+        tick_next = min(max(tick_next, MIN_TICK), MAX_TICK)
+        sqrt_price_next = get_sqrt_ratio_at_tick(tick_next)
+        if zero_for_one:
+            target = sqrt_price_limit if sqrt_price_next < sqrt_price_limit else sqrt_price_next
+        else:
+            target = sqrt_price_limit if sqrt_price_next > sqrt_price_limit else sqrt_price_next
+        sqrt_price, amount_in, amount_out, fee_amount = compute_swap_step(
+            state.sqrtPriceX96, target, state.liquidity, amount_remaining, self.fee)
+
+        tick, liquidity, crossed = state.tick, state.liquidity, state.ticksCrossed
+        if sqrt_price == sqrt_price_next:
+            if initialized:
+                liquidity_net = self.index.tick_info(tick_next)[1]
+                liquidity += -liquidity_net if zero_for_one else liquidity_net
+                crossed += 1
+            tick = tick_next - 1 if zero_for_one else tick_next
+        elif sqrt_price != state.sqrtPriceX96:
+            tick = get_tick_at_sqrt_ratio(sqrt_price)
+        return _SwapState(sqrt_price, tick, liquidity, crossed), amount_in, fee_amount, amount_out
+
+    def _default_limit(self, zero_for_one: bool) -> int:
+        return MIN_SQRT_RATIO + 1 if zero_for_one else MAX_SQRT_RATIO - 1
+
+    def _run(self, state: _SwapState, zero_for_one: bool, amount_specified: int, sqrt_price_limit: int,
+             amount_remaining: int, amount_calculated: int) -> SwapResult:
+        exact_input = amount_specified > 0
+        while amount_remaining != 0 and state.sqrtPriceX96 != sqrt_price_limit:
+            state, amount_in, fee_amount, amount_out = self._step(state, zero_for_one, amount_remaining,
+                                                                  sqrt_price_limit)
+            if exact_input:
+                amount_remaining -= amount_in + fee_amount
+                amount_calculated -= amount_out
+            else:
+                amount_remaining += amount_out
+                amount_calculated += amount_in + fee_amount
+        if zero_for_one == exact_input:
+            amount0, amount1 = amount_specified - amount_remaining, amount_calculated
+        else:
+            amount0, amount1 = amount_calculated, amount_specified - amount_remaining
+        amount_in, amount_out = (amount0, -amount1) if zero_for_one else (amount1, -amount0)
+        return SwapResult(amount0, amount1, amount_in, amount_out, state.sqrtPriceX96, state.tick, state.liquidity,
+                          state.ticksCrossed)
+
+    def swap(self, zero_for_one: bool, amount_specified: int, sqrt_price_limit_x96: Optional[int] = None) -> SwapResult:
+        """
+        UniswapV3Pool.swap：amount_specified > 0 是 exact input，< 0 是 exact output。
+        amount0/amount1 是池子视角的增减，amountIn/amountOut 是交易者视角
+        """
+        if amount_specified == 0:
+            raise ValueError("amount_specified must not be 0")
+        limit = sqrt_price_limit_x96 or self._default_limit(zero_for_one)
+        if zero_for_one and not MIN_SQRT_RATIO < limit < self.state.sqrtPriceX96 or \
+                not zero_for_one and not self.state.sqrtPriceX96 < limit < MAX_SQRT_RATIO:
+            raise ValueError("SPL")
+        state = _SwapState(self.state.sqrtPriceX96, self.state.tick, self.state.liquidity, 0)
+        return self._run(state, zero_for_one, amount_specified, limit, amount_specified, 0)
+
+    def quote_exact_input(self, zero_for_one: bool, amount_in: int) -> int:
+        """Quoter.quoteExactInputSingle，sqrtPriceLimitX96 = 0"""
+        return self.swap(zero_for_one, amount_in).amountOut
+
+    def quote_exact_output(self, zero_for_one: bool, amount_out: int) -> int:
+        """Quoter.quoteExactOutputSingle，sqrtPriceLimitX96 = 0"""
+        return self.swap(zero_for_one, -amount_out).amountIn
+
+    def _path(self, zero_for_one: bool) -> '_ExactInputPath':
+        path = self._paths.get(zero_for_one)
+        if path is None:
+            path = self._paths[zero_for_one] = _ExactInputPath(self, zero_for_one)
+        return path
+
+    def quote_exact_input_many(self, zero_for_one: bool, amounts: List[int]) -> List[SwapResult]:
+        """一批 exact input 数量的 swap 结果，和逐个调用 swap 的结果完全相同"""
+        path = self._path(zero_for_one)
+        path.extend(max(amounts) if amounts else 0)
+        limit = self._default_limit(zero_for_one)
+        results = []
+        for amount in amounts:
+            if amount <= 0:
+                raise ValueError("exact input amount must be positive")
+            k = bisect.bisect_right(path.thresholds, amount)
+            if k:
+                consumed, produced, state = path.consumed[k - 1], path.produced[k - 1], path.states[k - 1]
+            else:
+                consumed, produced = 0, 0
+                state = _SwapState(self.state.sqrtPriceX96, self.state.tick, self.state.liquidity, 0)
+            results.append(self._run(state, zero_for_one, amount, limit, amount - consumed, -produced))
+        return results
+
+
+class _ExactInputPath():
+    """
+    exact input 时完整走完的步序列。第 k 步能走完的条件是
+    floor(剩余输入 * (1e6 - fee) / 1e6) >= 这一步的 amountIn，即输入 >= consumed[k-1] + ceil(amountIn * 1e6 / (1e6 - fee))，
+    thresholds 取前缀最大值后单调。走完这一步消耗 amountIn + mulDivRoundingUp(amountIn, fee, 1e6 - fee)，和输入总量无关。
+    """
+
+    def __init__(self, simulator: SwapSimulator, zero_for_one: bool):
+        self.simulator = simulator
+        self.zero_for_one = zero_for_one
+        self.limit = simulator._default_limit(zero_for_one)
+        s = simulator.state
+        self.state = _SwapState(s.sqrtPriceX96, s.tick, s.liquidity, 0)
+        self.thresholds, self.consumed, self.produced, self.states = [], [], [], []
+        self.done = False
+
+    def extend(self, amount: int):
+        """把步序列算到能覆盖 amount 为止"""
+        fee = self.simulator.fee
+        while not self.done and (not self.thresholds or self.thresholds[-1] <= amount):
+            if self.state.sqrtPriceX96 == self.limit:
+                self.done = True
+                break
+            consumed = self.consumed[-1] if self.consumed else 0
+            produced = self.produced[-1] if self.produced else 0
+            # 剩余输入足够大时这一步一定走到 target，target 是价格上限时之后不会再有完整的步
+            state, amount_in, fee_amount, amount_out = self.simulator._step(
+                self.state, self.zero_for_one, 1 << 255, self.limit)
+            if state.sqrtPriceX96 == self.limit:
+                self.done = True
+                break
+            # 输入正好等于 consumed 时合约在上一步之后就停了，这一步至少要多 1
+            threshold = consumed + max(mul_div_rounding_up(amount_in, FEE_UNITS, FEE_UNITS - fee), 1)
+            if self.thresholds:
+                threshold = max(threshold, self.thresholds[-1])
+            self.thresholds.append(threshold)
+            self.consumed.append(consumed + amount_in + fee_amount)
+            self.produced.append(produced + amount_out)
+            self.states.append(state)
+            self.state = state
+
+
+def check_against_quoter(w3: Web3, quoter_address, pool_address, token0, token1, fee: int, zero_for_one: bool,
+                         amounts: List[int], block: BlockIdentifier = 'latest'):
+    """
+    本地结果和 Uniswap v3 quoter.quoteExactInputSingle 在同一个区块对比，返回 [(amount_in, 本地 amountOut, quoter amountOut)]。
+    quoter 按 (tokenIn, tokenOut, fee) 从它自己的 factory 找池子，pool_address 要是这个 factory 里 (token0, token1, fee) 的池子
+    """
+    simulator = SwapSimulator.from_pool(w3, pool_address, fee, block)
+    return _compare_quoter(w3, quoter_address, simulator, token0, token1, zero_for_one, amounts)
+
+
+def _compare_quoter(w3: Web3, quoter_address, simulator: SwapSimulator, token0, token1, zero_for_one: bool,
+                    amounts: List[int]):
+    token_in, token_out = (token0, token1) if zero_for_one else (token1, token0)
+    quoter = _load_contract(w3, "abi/quoter", quoter_address)
+    local = simulator.quote_exact_input_many(zero_for_one, amounts)
+    rows = []
+    for amount, result in zip(amounts, local):
+        onchain = quoter.functions.quoteExactInputSingle(token_in, token_out, simulator.fee, amount, 0).call(
+            block_identifier=simulator.state.block)
+        rows.append((amount, result.amountOut, onchain))
+    return rows
+
+
+def quoter_vectors(simulator: SwapSimulator, zero_for_one: bool, rows: List[tuple]) -> dict:
+    """from_vectors 需要的池子状态、tick 分布，加上 check_against_quoter 的 [(amount_in, 本地, quoter)]"""
+    state, index = simulator.state, simulator.index
+    return {
+        'pool': index.pool_address, 'block': state.block, 'fee': simulator.fee, 'tickSpacing': state.tickSpacing,
+        'sqrtPriceX96': state.sqrtPriceX96, 'tick': state.tick, 'liquidity': state.liquidity,
+        'ticks': index.ticks, 'liquidityGross': index.liquidity_gross, 'liquidityNet': index.liquidity_net,
+        'zeroForOne': zero_for_one, 'amountsIn': [row[0] for row in rows], 'quoterAmountsOut': [row[2] for row in rows],
+    }
+
+
+def record_quoter_vectors(w3: Web3, quoter_address, pool_address, token0, token1, fee: int, zero_for_one: bool,
+                          amounts: List[int], path: str, block: BlockIdentifier = 'latest') -> dict:
+    """
+    check_against_quoter 的结果连同池子状态写到 path（json），离线重放用，返回写下的内容。
+    本地结果不写，重放时重新算，和 quoterAmountsOut 对比
+    """
+    simulator = SwapSimulator.from_pool(w3, pool_address, fee, block)
+    rows = _compare_quoter(w3, quoter_address, simulator, token0, token1, zero_for_one, amounts)
+    vectors = quoter_vectors(simulator, zero_for_one, rows)
+    with open(path, 'w') as f:
+        json.dump(vectors, f)
+    return vectors
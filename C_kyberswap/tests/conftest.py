@@ -0,0 +1,7 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# 模块之间直接 import（from utils import ...），测试和运行脚本一样从 C_kyberswap 目录导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
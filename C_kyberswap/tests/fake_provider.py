@@ -0,0 +1,54 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试用的同步 provider：eth_call 按 (合约地址, selector) 分发给 handlers，
+Multicall3.tryBlockAndAggregate 拆开逐个分发，没有 handler 的调用返回失败。
+"""
+from eth_abi import decode_abi, encode_abi
+from web3 import Web3
+from web3.providers.base import BaseProvider
+
+_AGGREGATE = Web3.keccak(text='tryBlockAndAggregate(bool,(address,bytes)[])')[:4]
+
+
+def selector(signature: str) -> bytes:
+    return bytes(Web3.keccak(text=signature)[:4])
+
+
+class FakeProvider(BaseProvider):
+
+    def __init__(self, handlers: dict, block: int = 123):
+        # handlers: {(checksum 地址, selector): calldata -> 返回的 abi 编码}，
+        # 其他方法放 {方法名: params -> result}
+        self.handlers = handlers
+        self.block = block
+        self.calls = []
+
+    def _call(self, to, data: bytes):
+        handler = self.handlers.get((Web3.toChecksumAddress(to), data[:4]))
+        return None if handler is None else handler(data)
+
+    def make_request(self, method, params):
+        self.calls.append((method, params))
+        if method in self.handlers:
+            return {'result': self.handlers[method](params)}
+        if method == 'eth_chainId':
+            return {'result': '0x1'}
+        if method == 'eth_blockNumber':
+            return {'result': hex(self.block)}
+        if method == 'eth_call':
+            data = bytes.fromhex(params[0]['data'][2:])
+            if data[:4] == _AGGREGATE:
+                _, calls = decode_abi(['bool', '(address,bytes)[]'], data[4:])
+                results = [(output is not None, output or b'') for output in
+                           (self._call(to, calldata) for to, calldata in calls)]
+                return {'result': '0x' + encode_abi(['uint256', 'bytes32', '(bool,bytes)[]'],
+                                                    [self.block, b'\0' * 32, results]).hex()}
+            output = self._call(params[0]['to'], data)
+            if output is None:
+                return {'error': {'code': -32000, 'message': 'execution reverted'}}
+            return {'result': '0x' + output.hex()}
+        raise NotImplementedError(method)
+
+    def isConnected(self):
+        return True
@@ -0,0 +1,37 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import gc
+from types import SimpleNamespace
+import pytest
+from batch import AsyncBatchCoalescer, _BatchMethods
+
+
+class AsyncProviderStub():
+
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    async def make_request(self, method, params):
+        await self.release.wait()
+        return {'jsonrpc': '2.0', 'result': '0x7b' if method == 'eth_blockNumber' else '0x1'}
+
+
+def test_batch_methods_require_add():
+    with pytest.raises(TypeError):
+        _BatchMethods()
+
+
+def test_coalescer_keeps_pending_sends_alive():
+    async def main():
+        provider = AsyncProviderStub()
+        coalescer = AsyncBatchCoalescer(SimpleNamespace(provider=provider), window=0.001)
+        futures = [coalescer.block_number(), coalescer.chain_id()]
+        await asyncio.sleep(0.01)
+        # 发送中的 task 只被 coalescer 引用，回收之后还要能完成
+        assert len(coalescer._tasks) == 1
+        gc.collect()
+        provider.release.set()
+        results = await asyncio.wait_for(asyncio.gather(*futures), 1)
+        assert results == [123, 1] and not coalescer._tasks
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pytest
+import requests
+from eth_abi import encode_abi
+from web3 import Web3
+from constant import MARKET_INFO_DICT
+from fake_provider import FakeProvider
+import log_ingester
+from log_ingester import BurnRTokensLog, LogIngester, SwapLog, pool_event_decoders
+
+
+class GetLogsProvider(FakeProvider):
+    """eth_getLogs 按顺序返回 responses 里的响应（dict 或要抛的异常），记下每次请求的区块范围"""
+
+    def __init__(self, responses, block=123):
+        super().__init__({}, block)
+        self.responses = list(responses)
+        self.ranges = []
+
+    def make_request(self, method, params):
+        if method != 'eth_getLogs':
+            return super().make_request(method, params)
+        self.ranges.append((int(params[0]['fromBlock'], 16), int(params[0]['toBlock'], 16)))
+        response = self.responses.pop(0) if self.responses else {'result': []}
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def _http_429():
+    response = requests.Response()
+    response.status_code = 429
+    return requests.exceptions.HTTPError("429 Client Error: Too Many Requests", response=response)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(log_ingester.time, 'sleep', delays.append)
+    return delays
+
+
+def _ingest(provider, span=100):
+    ingester = LogIngester(Web3(provider), ['ETH_USDT'], start_block=0, end_block=199, span=span, max_span=100)
+    assert list(ingester) == []
+    return ingester
+
+
+@pytest.mark.parametrize('error', [
+    {'code': -32005, 'message': 'query returned more than 10000 results'},
+    {'code': -32602, 'message': 'Log response size exceeded. You can make eth_getLogs requests with up to a 2K '
+                                'block range and no limit on the response size'},
+    {'code': -32000, 'message': 'block range is too wide'},
+    {'code': -32614, 'message': 'eth_getLogs is limited to a 10,000 range'},
+])
+def test_too_many_results_splits_range(error, sleeps):
+    provider = GetLogsProvider([{'error': error}])
+    _ingest(provider)
+    assert provider.ranges[:2] == [(0, 99), (0, 49)]
+    assert sleeps == []
+
+
+def test_suggested_range():
+    provider = GetLogsProvider([{'error': {'code': -32602, 'message': 'Log response size exceeded. this block range '
+                                                                      'should work: [0x0, 0x13]'}}])
+    _ingest(provider)
+    assert provider.ranges[:2] == [(0, 99), (0, 19)]
+
+
+@pytest.mark.parametrize('error', [
+    _http_429(),
+    {'error': {'code': 429, 'message': 'Too Many Requests'}},
+    {'error': {'code': -32005, 'message': 'project ID request rate exceeded'}},
+    {'error': {'code': -32005, 'message': 'daily request count exceeded, request rate limited'}},
+    {'error': {'code': -32000, 'message': 'Your app has exceeded its compute units per second capacity'}},
+])
+def test_rate_limit_retries_same_range(error, sleeps):
+    provider = GetLogsProvider([error, error])
+    ingester = _ingest(provider)
+    # 同一段重试两次之后成功，范围不变
+    assert provider.ranges == [(0, 99), (0, 99), (0, 99), (100, 199)]
+    assert sleeps == [log_ingester.RATE_LIMIT_DELAY_MIN, log_ingester.RATE_LIMIT_DELAY_MIN * 2]
+    assert ingester.span == 100
+
+
+def test_rate_limit_gives_up(sleeps):
+    provider = GetLogsProvider([{'error': {'code': 429, 'message': 'rate limited'}}] * log_ingester.RATE_LIMIT_RETRIES)
+    with pytest.raises(ValueError, match='rate limited'):
+        _ingest(provider)
+    assert set(provider.ranges) == {(0, 99)}
+
+
+def test_other_errors_raise(sleeps):
+    with pytest.raises(ValueError):
+        _ingest(GetLogsProvider([{'error': {'code': -32000, 'message': 'header not found'}}]))
+    assert sleeps == []
+
+
+def _log(topics, types, values, block=7, index=0):
+    return {'address': MARKET_INFO_DICT['kyberswapv3']['ETH_USDT']['id'].lower(), 'blockNumber': hex(block),
+            'logIndex': hex(index), 'transactionHash': '0x' + '33' * 32, 'topics': topics,
+            'data': '0x' + encode_abi(types, values).hex()}
+
+
+def test_decodes_elastic_pool_events():
+    decoders = pool_event_decoders(Web3())
+    topics = {decoder.record_type: topic for topic, decoder in decoders.items()}
+    # Swap/Mint/Burn 的 topic 和 Uniswap v3 一样，Collect 换成 BurnRTokens
+    assert topics[SwapLog] == Web3.keccak(text='Swap(address,address,int256,int256,uint160,uint128,int24)')
+    assert topics[BurnRTokensLog] == Web3.keccak(text='BurnRTokens(address,uint256,uint256,uint256)')
+    assert set(log_ingester.POOL_EVENT_RECORDS) == {'Swap', 'Mint', 'Burn', 'BurnRTokens'}
+    owner = '0x' + '00' * 12 + '2b1c7b41f6a8f2b2bc45c3233a5d5fb3cd6dc9a8'
+    log = _log([topics[BurnRTokensLog].hex(), owner], ['uint256', 'uint256', 'uint256'], [10 ** 15, 3, 4])
+    record, = decoders[topics[BurnRTokensLog]].decode([log], {log['address']: 'ETH_USDT'})
+    assert record == BurnRTokensLog('ETH_USDT', 7, '0x' + '33' * 32, 0,
+                                    Web3.toChecksumAddress(owner[-40:]), 10 ** 15, 3, 4)
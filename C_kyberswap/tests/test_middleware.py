@@ -0,0 +1,39 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from web3 import Web3
+from middleware import EthCallCacheMiddleware
+
+CONTRACT = '0x' + '42' * 20
+ALICE = '0x' + '11' * 20
+BOB = '0x' + '22' * 20
+
+
+def _cached():
+    """返回 (被缓存包起来的 make_request, 实际发到节点的 eth_call 参数)"""
+    calls = []
+
+    def make_request(method, params):
+        if method == 'eth_blockNumber':
+            return {'result': '0x7b'}
+        calls.append(params[0])
+        # 结果取决于 msg.sender，和 collect 的静态调用一样
+        return {'result': '0x' + params[0].get('from', '0x')[2:].rjust(64, '0')}
+    return EthCallCacheMiddleware()(make_request, Web3()), calls
+
+
+def test_eth_call_cache_is_per_sender():
+    request, calls = _cached()
+    alice = request('eth_call', [{'from': ALICE, 'to': CONTRACT, 'data': '0x1234'}, 'latest'])
+    bob = request('eth_call', [{'from': BOB, 'to': CONTRACT, 'data': '0x1234'}, 'latest'])
+    assert alice != bob and len(calls) == 2
+    assert request('eth_call', [{'from': ALICE.upper().replace('0X', '0x'), 'to': CONTRACT, 'data': '0x1234'},
+                                'latest']) == alice
+    assert len(calls) == 2
+
+
+def test_eth_call_cache_is_per_value():
+    request, calls = _cached()
+    request('eth_call', [{'from': ALICE, 'to': CONTRACT, 'data': '0x1234', 'value': 1}, 'latest'])
+    request('eth_call', [{'from': ALICE, 'to': CONTRACT, 'data': '0x1234', 'value': 2}, 'latest'])
+    request('eth_call', [{'from': ALICE, 'to': CONTRACT, 'data': '0x1234', 'value': 2}, 'latest'])
+    assert len(calls) == 2
@@ -0,0 +1,34 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import threading
+from web3 import Web3
+from fake_provider import FakeProvider
+from kyberswap import Kyberswapv3f3000ApiTrade
+from nonce_manager import NonceManager
+
+ADDRESS = '0x' + '11' * 20
+
+
+def _resync_threads():
+    return [thread for thread in threading.enumerate() if thread.name == 'nonce-resync']
+
+
+def test_resync_thread_starts_on_first_allocate():
+    w3 = Web3(FakeProvider({'eth_getTransactionCount': lambda params: '0x5'}))
+    manager = NonceManager(w3, ADDRESS, auto_start=True)
+    assert manager._resync_thread is None
+    assert manager.allocate() == 5 and manager.allocate() == 6
+    assert manager._resync_thread is not None and manager._resync_thread.is_alive()
+    manager.stop()
+    # stop() 之后再分配不会重新起线程
+    manager.allocate()
+    assert manager._resync_thread is None
+
+
+def test_client_construction_starts_no_threads():
+    before = len(_resync_threads())
+    clients = [Kyberswapv3f3000ApiTrade(pub_key=ADDRESS, secret_key='', uniswapv3_rpc_url='http://127.0.0.1:8545')
+               for _ in range(5)]
+    assert len(_resync_threads()) == before
+    for client in clients:
+        client.close()
@@ -0,0 +1,91 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import pytest
+from eth_abi import decode_abi, encode_abi
+from web3 import Web3
+from fake_provider import FakeProvider, selector
+from kyberswap import _Kyberswapv3Base
+from market_registry import MarketRegistry, get_market_registry
+from pool_address import compute_pool_address, derive_pool_addresses, load_init_code_hash, verify_init_code_hash
+
+WETH = '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2'
+USDC = '0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48'
+USDT = '0xdAC17F958D2ee523a2206206994597C13D831ec7'
+KNC = '0xdeFA4e8a7bcBA345F687a2f1456F5Edd9CE97202'
+FACTORY = '0x' + '42' * 20
+INIT_CODE_HASH = '0x' + 'ab' * 32
+
+
+def test_create2_reproduces_uniswap_v3_pool():
+    # Uniswap v3 USDC/WETH 0.3%：salt 编码和 Elastic 一样是 abi.encode(token0, token1, uint24)
+    pool = compute_pool_address('0x1F98431c8aD98523631AE4a59f267346ea31F984', WETH, USDC, 3000,
+                                '0xe34f199b19b2b4f47f68442619d555527d244f78a3297ea89325f843f87b8b54')
+    assert pool == '0x8ad599c3A0ff1De082011EFDDc58f1908eb6e6D8'
+
+
+def _registry(fee_tiers):
+    """池子地址用 Elastic fee 单位（feeTier / 10）在 FACTORY/INIT_CODE_HASH 下算出来的注册表"""
+    info = {'ETH': {'id': WETH, 'decimals': 18}, 'USDT': {'id': USDT, 'decimals': 6},
+            'KNC': {'id': KNC, 'decimals': 18}}
+    for symbol, token, fee_tier in fee_tiers:
+        info[symbol] = {'id': compute_pool_address(FACTORY, WETH, token, fee_tier // 10, INIT_CODE_HASH),
+                        'feeTier': fee_tier}
+    return MarketRegistry(info)
+
+
+def test_verify_uses_elastic_fee_units():
+    registry = _registry([('ETH_USDT', USDT, 3000), ('ETH_KNC', KNC, 20000)])
+    assert verify_init_code_hash(FACTORY, registry, INIT_CODE_HASH) == []
+    mismatches = verify_init_code_hash(FACTORY, registry, '0x' + 'cd' * 32)
+    assert sorted(market.symbol for market, _ in mismatches) == ['ETH_KNC', 'ETH_USDT']
+
+
+def test_derive_pool_addresses_keys_by_fee_units():
+    registry = _registry([('ETH_USDT', USDT, 3000)])
+    pools = derive_pool_addresses(FACTORY, registry, INIT_CODE_HASH)
+    market = registry.market('ETH_USDT')
+    assert pools[(market.token0.address_bytes, market.token1.address_bytes, 300)] == market.pool_bytes
+
+
+def _factory_w3(registry, init_code_hash, pools=None):
+    pools = pools if pools is not None else {
+        (market.token0.address_bytes, market.token1.address_bytes, market.fee // 10): market.pool
+        for market in registry.markets().values()}
+
+    def get_pool(data):
+        token0, token1, fee = decode_abi(['address', 'address', 'uint24'], data[4:])
+        key = (bytes.fromhex(token0[2:]), bytes.fromhex(token1[2:]), fee)
+        return encode_abi(['address'], [pools.get(key, '0x' + '00' * 20)])
+
+    factory = Web3.toChecksumAddress(FACTORY)
+    return Web3(FakeProvider({
+        (factory, selector('poolInitHash()')): lambda data: bytes.fromhex(init_code_hash[2:]),
+        (factory, selector('getPool(address,address,uint24)')): get_pool,
+    }))
+
+
+def test_load_init_code_hash_checks_factory():
+    registry = _registry([('ETH_USDT', USDT, 3000), ('ETH_KNC', KNC, 20000)])
+    assert load_init_code_hash(_factory_w3(registry, INIT_CODE_HASH), FACTORY, registry) == INIT_CODE_HASH
+    # factory 的 hash 算不出登记的池子
+    with pytest.raises(Exception, match='does not derive'):
+        load_init_code_hash(_factory_w3(registry, '0x' + 'cd' * 32), FACTORY, registry)
+    # getPool 返回的不是登记的池子（比如 fee 单位不对）
+    with pytest.raises(Exception, match='getPool'):
+        load_init_code_hash(_factory_w3(registry, INIT_CODE_HASH, pools={}), FACTORY, registry)
+
+
+def test_client_has_no_derived_pool_address():
+    assert not hasattr(_Kyberswapv3Base, 'pool_address')
+
+
+@pytest.mark.skipif(not os.environ.get('KYBERSWAP_RPC_URL'), reason="needs a mainnet node in KYBERSWAP_RPC_URL")
+def test_registered_pools_derive_from_factory():
+    # factory 的 poolInitHash/getPool 要能还原 MARKET_INFO_DICT 里登记的两个池子
+    w3 = Web3(Web3.HTTPProvider(os.environ['KYBERSWAP_RPC_URL']))
+    registry = get_market_registry()
+    init_code_hash = load_init_code_hash(w3, _Kyberswapv3Base.UNI_V3_FACTORY_ADDRESS, registry)
+    for market in registry.markets().values():
+        assert compute_pool_address(_Kyberswapv3Base.UNI_V3_FACTORY_ADDRESS, market.token0.address,
+                                    market.token1.address, market.fee // 10, init_code_hash) == market.pool
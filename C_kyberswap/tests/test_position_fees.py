@@ -0,0 +1,78 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pytest
+from eth_abi import decode_abi, encode_abi
+from web3 import Web3
+from constant import MARKET_INFO_DICT
+from fake_provider import FakeProvider, selector
+from position_fees import ELASTIC_FACTORY_ADDRESS, Q96, UINT256, FeeReader, PoolFeeState, PositionFees, \
+    compute_fees, synced_fee_growth
+
+POOL = Web3.toChecksumAddress(MARKET_INFO_DICT['kyberswapv3']['ETH_USDT']['id'])
+LIQUIDITY = 10 ** 18
+
+
+def _position(lower=-60, upper=60, liquidity=LIQUIDITY, r_token_owed=0, fee_growth_inside_last=0):
+    """positions() 的返回：(pos, info)，pos 是 (nonce, operator, poolId, tickLower, tickUpper, liquidity, rTokenOwed, feeGrowthInsideLast)"""
+    return (0, '0x' + '00' * 20, 1, lower, upper, liquidity, r_token_owed, fee_growth_inside_last), (0, 0, 0, 0)
+
+
+def _state(tick, fee_growth, outside, **kwargs):
+    """sqrtP = 2^96、reinvestL = totalSupply，这样 rToken 原样换成 amount0 = amount1"""
+    fields = dict(block=123, sqrtP=Q96, tick=tick, feeGrowthGlobal=fee_growth, baseL=3 * 10 ** 18,
+                  reinvestL=10 ** 18, reinvestLLast=10 ** 18, totalSupply=10 ** 18, feeGrowthOutside=outside)
+    fields.update(kwargs)
+    return PoolFeeState(**fields)
+
+
+@pytest.mark.parametrize('tick, fee_growth, lower_outside, upper_outside, last', [
+    # 当前 tick 在区间下面：inside = lower - upper
+    (-120, 10 * Q96, 5 * Q96, 2 * Q96, 0),
+    # 在区间里：inside = global - lower - upper
+    (0, 10 * Q96, 5 * Q96, 2 * Q96, 0),
+    # 在区间上面：inside = upper - lower 是负的，和 feeGrowthInsideLast 一样按 uint256 回绕
+    (120, 10 * Q96, 2 * Q96, Q96, UINT256 - 4 * Q96),
+], ids=['below', 'inside', 'above-wraparound'])
+def test_compute_fees_tick_cases(tick, fee_growth, lower_outside, upper_outside, last):
+    state = _state(tick, fee_growth, {-60: lower_outside, 60: upper_outside})
+    fees = compute_fees({7: _position(r_token_owed=5, fee_growth_inside_last=last)}, [POOL], {POOL: state})
+    assert fees == {7: PositionFees(7, 3 * LIQUIDITY + 5, 3 * LIQUIDITY + 5, 3 * LIQUIDITY + 5)}
+
+
+def test_synced_fee_growth_deducts_government_fee():
+    # lpContribution = 3e18 * 4e15 / 4e18 = 3e15，totalSupply == reinvestLLast 所以 rMintQty = 3e15
+    state = _state(0, Q96, {}, reinvestLLast=10 ** 18 - 4 * 10 ** 15, totalSupply=10 ** 18 - 4 * 10 ** 15)
+    assert synced_fee_growth(state) == (Q96 + 3 * 10 ** 15 * Q96 // (3 * 10 ** 18), 10 ** 18 - 10 ** 15)
+    # 2% 给 feeTo，totalSupply 仍然加上全部 rMintQty
+    assert synced_fee_growth(state._replace(governmentFeeUnits=2000)) == \
+        (Q96 + 294 * 10 ** 13 * Q96 // (3 * 10 ** 18), 10 ** 18 - 10 ** 15)
+    # 没有新的 reinvest 手续费就不变
+    assert synced_fee_growth(_state(0, Q96, {}, governmentFeeUnits=2000)) == (Q96, 10 ** 18)
+
+
+def test_reader_reads_fee_configuration_in_same_multicall():
+    state = _state(0, 10 * Q96, {-60: 5 * Q96, 60: 2 * Q96}, reinvestLLast=10 ** 18 - 4 * 10 ** 15,
+                   totalSupply=10 ** 18 - 4 * 10 ** 15, governmentFeeUnits=2000)
+
+    def pool_call(signature, types, values):
+        return (POOL, selector(signature)), lambda data: encode_abi(types, values)
+
+    handlers = dict([
+        pool_call('getPoolState()', ['uint160', 'int24', 'int24', 'bool'], [state.sqrtP, state.tick, state.tick, False]),
+        pool_call('getFeeGrowthGlobal()', ['uint256'], [state.feeGrowthGlobal]),
+        pool_call('getLiquidityState()', ['uint128', 'uint128', 'uint128'],
+                  [state.baseL, state.reinvestL, state.reinvestLLast]),
+        pool_call('totalSupply()', ['uint256'], [state.totalSupply]),
+    ])
+    handlers[(POOL, selector('ticks(int24)'))] = lambda data: encode_abi(
+        ['uint128', 'int128', 'uint256', 'uint128'],
+        [0, 0, state.feeGrowthOutside[decode_abi(['int24'], data[4:])[0]], 0])
+    handlers[(ELASTIC_FACTORY_ADDRESS, selector('feeConfiguration()'))] = \
+        lambda data: encode_abi(['address', 'uint24'], ['0x' + '22' * 20, state.governmentFeeUnits])
+    provider = FakeProvider(handlers)
+    positions = {7: _position()}
+
+    fees = FeeReader(Web3(provider)).read(positions, [POOL.lower()])
+    assert [method for method, _ in provider.calls if method == 'eth_call'] == ['eth_call']
+    assert fees == compute_fees(positions, [POOL], {POOL: state})
+    assert fees != compute_fees(positions, [POOL], {POOL: state._replace(governmentFeeUnits=0)})
@@ -0,0 +1,123 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import pytest
+from constant import MARKET_INFO_DICT
+import subscriptions
+from subscriptions import Subscriber
+from ws_stand_in import WsNode
+
+POOL = MARKET_INFO_DICT['kyberswapv3']['ETH_USDT']['id']
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(subscriptions, 'RECONNECT_DELAY_MIN', 0.05)
+    monkeypatch.setattr(subscriptions, 'RATE_LIMIT_DELAY_MIN', 0.01)
+
+
+async def _settle(condition, timeout=5.0):
+    deadline = asyncio.get_event_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_event_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.02)
+
+
+def _run(scenario, start_block=None):
+    """node 上跑 scenario(node, subscriber)，返回 (subscriber, 收到的日志, 收到的区块号)"""
+    async def main():
+        node = await WsNode(POOL).start()
+        subscriber = Subscriber(node.url, ['ETH_USDT'], start_block=start_block)
+        logs, heads = [], []
+
+        async def consume_logs():
+            async for record in subscriber.logs():
+                logs.append(record)
+
+        async def consume_heads():
+            async for head in subscriber.heads():
+                heads.append(head.number)
+
+        tasks = [asyncio.ensure_future(task) for task in (consume_logs(), consume_heads(), subscriber.run())]
+        try:
+            await scenario(node, subscriber, logs)
+        finally:
+            await subscriber.close()
+            await node.stop()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return subscriber, logs, heads
+    return asyncio.run(main())
+
+
+def _keys(logs):
+    return [(record.blockNumber, record.logIndex) for record in logs]
+
+
+def _expected(first, last):
+    return [(block, index) for block in range(first, last + 1) for index in (0, 1)]
+
+
+def test_reconnect_backfills_without_gaps_or_duplicates():
+    async def scenario(node, subscriber, logs):
+        await _settle(lambda: subscriber._handlers)
+        await node.mine(10)
+        await _settle(lambda: len(logs) == 20)
+        await node.drop()
+        # 断线期间出的块只能靠重连后的 eth_getLogs 补
+        await node.mine(5, push=False)
+        await _settle(lambda: subscriber.connects == 2 and subscriber._handlers)
+        await node.mine(5)
+        await _settle(lambda: len(logs) >= 40)
+
+    subscriber, logs, heads = _run(scenario)
+    assert subscriber.connects == 2
+    assert _keys(logs) == _expected(1, 20)
+    assert heads[-1] == 20 and heads == sorted(set(heads))
+    assert logs[5].symbol == 'ETH_USDT' and logs[5].amount0 == 3
+
+
+def test_backfill_splits_range_on_too_many_results():
+    def get_logs_error(params):
+        start, end = int(params[0]['fromBlock'], 16), int(params[0]['toBlock'], 16)
+        if end - start + 1 > 4:
+            return {'code': -32005, 'message': 'query returned more than 10000 results'}
+        return None
+
+    async def scenario(node, subscriber, logs):
+        await node.mine(20, push=False)
+        node.errors['eth_getLogs'] = get_logs_error
+        await _settle(lambda: len(logs) == 40)
+
+    subscriber, logs, _ = _run(scenario, start_block=1)
+    assert subscriber.connects == 1
+    assert subscriber.backfill_span <= 4
+    assert _keys(logs) == _expected(1, 20)
+
+
+def test_backfill_retries_rate_limited_range():
+    responses = [{'code': 429, 'message': 'Too Many Requests'}, None]
+
+    async def scenario(node, subscriber, logs):
+        await node.mine(5, push=False)
+        node.errors['eth_getLogs'] = lambda params: responses.pop(0) if responses else None
+        await _settle(lambda: len(logs) == 10)
+
+    subscriber, logs, _ = _run(scenario, start_block=1)
+    assert subscriber.connects == 1
+    assert subscriber.backfill_span == subscriptions.BACKFILL_SPAN
+    assert _keys(logs) == _expected(1, 5)
+
+
+def test_rpc_error_reconnects_instead_of_exiting():
+    failures = [{'code': -32000, 'message': 'subscription limit reached'}]
+
+    async def scenario(node, subscriber, logs):
+        node.errors['eth_subscribe'] = lambda params: failures.pop(0) if failures else None
+        await _settle(lambda: subscriber.connects == 2 and subscriber._handlers)
+        await node.mine(3)
+        await _settle(lambda: len(logs) == 6)
+
+    subscriber, logs, _ = _run(scenario)
+    assert _keys(logs) == _expected(1, 3)
@@ -0,0 +1,61 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from eth_abi import decode_abi, encode_abi
+from web3 import Web3
+from constant import MARKET_INFO_DICT
+from fake_provider import FakeProvider, selector
+from tick_index import TickIndex
+from tick_math import MAX_TICK, MIN_TICK
+
+UNISWAP_V3_POOL = '0x8ad599c3a0ff1de082011efddc58f1908eb6e6d8'
+ELASTIC_POOL = Web3.toChecksumAddress(MARKET_INFO_DICT['kyberswapv3']['ETH_USDT']['id'])
+
+
+def _elastic_provider(positions, spacing=60):
+    """Elastic 池子：initializedTicks 是 MIN_TICK -> ... -> MAX_TICK 链表，ticks() 来自 positions 累加"""
+    expected = TickIndex(Web3(), UNISWAP_V3_POOL)
+    for lower, upper, liquidity in positions:
+        expected.apply_position(lower, upper, liquidity)
+    linked = [MIN_TICK] + expected.ticks + [MAX_TICK]
+    nodes = {tick: (linked[max(i - 1, 0)], linked[min(i + 1, len(linked) - 1)]) for i, tick in enumerate(linked)}
+
+    def tick_arg(data):
+        return decode_abi(['int24'], data[4:])[0]
+
+    handlers = {
+        (ELASTIC_POOL, selector('getPoolState()')): lambda data: encode_abi(['uint160', 'int24', 'int24', 'bool'],
+                                                                             [2 ** 96, 0, 0, False]),
+        (ELASTIC_POOL, selector('getLiquidityState()')): lambda data: encode_abi(['uint128'] * 3, [10 ** 18] * 3),
+        (ELASTIC_POOL, selector('tickDistance()')): lambda data: encode_abi(['int24'], [spacing]),
+        (ELASTIC_POOL, selector('initializedTicks(int24)')): lambda data: encode_abi(
+            ['int24', 'int24'], nodes.get(tick_arg(data), (0, 0))),
+        (ELASTIC_POOL, selector('ticks(int24)')): lambda data: encode_abi(
+            ['uint128', 'int128', 'uint256', 'uint128'], (expected.tick_info(tick_arg(data)) or (0, 0)) + (0, 0)),
+    }
+    return FakeProvider(handlers), expected
+
+
+def test_bootstrap_elastic_pool():
+    # 全区间 position、当前价附近密集的 tick，和窗口外很远的 30000
+    positions = [(-887220, 887220, 10 ** 18), (-1200, 600, 200), (-600, 60, 50), (-60, 0, 7), (0, 30000, 30)]
+    provider, expected = _elastic_provider(positions)
+    index = TickIndex(Web3(provider), ELASTIC_POOL, chunk_size=20).bootstrap()
+    assert index.pool_abi == 'ElasticPool' and index.tick_spacing == 60 and index.block == 123
+    assert (index.ticks, index.liquidity_gross, index.liquidity_net) == \
+        (expected.ticks, expected.liquidity_gross, expected.liquidity_net)
+    assert index.liquidity_at(-30) == 10 ** 18 + 200 + 50 + 7
+    # 链表 11 个节点，窗口里接得上的一轮确认：一次 pool state + 6 轮 initializedTicks + 一次 ticks()
+    assert [method for method, _ in provider.calls].count('eth_call') == 8
+
+
+def test_apply_position():
+    index = TickIndex(Web3(), UNISWAP_V3_POOL)
+    index.apply_position(-120, 60, 100)
+    index.apply_position(0, 120, 50)
+    assert index.liquidity_at(-180) == 0
+    assert index.liquidity_at(-60) == 100
+    assert index.liquidity_at(0) == 150
+    assert index.liquidity_at(60) == 50
+    assert index.next_initialized_tick(0, False) == 60
+    index.apply_position(-120, 60, -100)
+    assert index.ticks == [0, 120]
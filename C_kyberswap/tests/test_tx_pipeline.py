@@ -0,0 +1,109 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from concurrent.futures import Future
+from types import SimpleNamespace
+import pytest
+from hexbytes import HexBytes
+from web3 import Web3
+from fake_provider import FakeProvider
+from nonce_manager import NonceManager
+from tx_pipeline import PendingTx, TxDropped, TxPipeline
+
+ADDRESS = '0x' + '11' * 20
+GWEI = 10 ** 9
+
+
+class FeeEngineStub():
+
+    def __init__(self):
+        self.tracked = set()
+
+    def track(self, tx_hash, transaction):
+        self.tracked.add(HexBytes(tx_hash))
+
+    def untrack(self, tx_hash):
+        self.tracked.discard(HexBytes(tx_hash))
+
+    def observe_receipt(self, tx_hash, receipt):
+        self.untrack(tx_hash)
+        return True
+
+    def suggest(self):
+        return SimpleNamespace(maxFeePerGas=30 * GWEI, maxPriorityFeePerGas=GWEI)
+
+
+def _pipeline(latest_nonce=5, mined=(), max_fee_cap=None):
+    """链上 latest nonce 是 pipeline.chain.latest_nonce，chain.mined 里的 hash 有 receipt；发送直接返回一个新 hash"""
+    chain = SimpleNamespace(latest_nonce=latest_nonce, mined=set(mined))
+    handlers = {
+        'eth_getTransactionCount': lambda params: hex(chain.latest_nonce),
+        'eth_getTransactionReceipt': lambda params: {'status': '0x1', 'transactionHash': params[0],
+                                                     'blockNumber': '0x7b', 'gasUsed': '0x5208', 'logs': []}
+        if HexBytes(params[0]) in chain.mined else None,
+    }
+    w3 = Web3(FakeProvider(handlers))
+    pipeline = TxPipeline(w3, None, NonceManager(w3, ADDRESS), FeeEngineStub(), replace_after=3, max_replacements=2,
+                          max_fee_cap=max_fee_cap)
+    pipeline.chain = chain
+    pipeline.sent = []
+
+    def sign_and_send(transaction):
+        pipeline.sent.append(transaction)
+        return HexBytes(Web3.keccak(text=str(len(pipeline.sent))))
+    pipeline._sign_and_send = sign_and_send
+    return pipeline
+
+
+def _track(pipeline, nonce=5, sent_block=100, max_fee=20 * GWEI):
+    transaction = {'nonce': nonce, 'gas': 21000, 'maxFeePerGas': max_fee, 'maxPriorityFeePerGas': GWEI}
+    tx = PendingTx(nonce, transaction, HexBytes(b'\x01' * 32), sent_block, Future(), {})
+    pipeline._pending[nonce] = tx
+    pipeline.fee_engine.track(tx.hashes[0], transaction)
+    return tx
+
+
+def test_mined_completes():
+    pipeline = _pipeline(latest_nonce=6, mined={HexBytes(b'\x01' * 32)})
+    tx = _track(pipeline)
+    pipeline.check(101)
+    assert tx.future.result()['receipt'].status == 1
+    assert pipeline.pending() == []
+
+
+def test_nonce_used_by_another_transaction():
+    pipeline = _pipeline(latest_nonce=6)
+    tx = _track(pipeline)
+    pipeline.check(101)
+    with pytest.raises(TxDropped, match='used by another transaction'):
+        tx.future.result(timeout=0)
+    assert pipeline.pending() == [] and pipeline.fee_engine.tracked == set()
+
+
+def test_keeps_watching_after_max_replacements():
+    pipeline = _pipeline()
+    tx = _track(pipeline)
+    for head in (103, 106):
+        pipeline.check(head)
+    assert tx.replacements == 2 and len(pipeline.sent) == 2
+    # 不再加价，但发出去的版本还可能上链，Future 不能提前失败
+    for head in (109, 120):
+        pipeline.check(head)
+    assert not tx.bumping and not tx.future.done() and len(pipeline.sent) == 2
+    assert pipeline.nonce_manager._state['sent'].keys() == {'5'}
+    pipeline.chain.mined.add(tx.hashes[1])
+    pipeline.chain.latest_nonce = 6
+    pipeline.check(121)
+    assert tx.future.result(timeout=0)['txn_hash'] == tx.hashes[1].hex()
+    assert pipeline.pending() == [] and pipeline.fee_engine.tracked == set()
+
+
+def test_stalled_transaction_fails_once_nonce_is_taken():
+    pipeline = _pipeline(max_fee_cap=20 * GWEI)
+    tx = _track(pipeline)
+    pipeline.check(103)
+    # 已经到了 max_fee_cap，加不上去
+    assert pipeline.sent == [] and not tx.bumping and not tx.future.done()
+    pipeline.chain.latest_nonce = 6
+    pipeline.check(104)
+    error = tx.future.exception(timeout=0)
+    assert isinstance(error, TxDropped) and error.nonce == 5 and error.hashes == tx.hashes
@@ -0,0 +1,106 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试用的 websocket 节点：aiohttp 起在本机随机端口，支持 eth_subscribe（newHeads/logs）、eth_blockNumber、eth_getLogs。
+每个区块一个池子的两条 Swap 日志，mine() 出块并推送给所有连接，drop() 断开所有连接。
+errors[method] 是 params -> error dict 或 None，返回 error 时这次请求以 JSON-RPC error 响应。
+"""
+import json
+from aiohttp import web
+from eth_abi import encode_abi
+from web3 import Web3
+
+SWAP_TOPIC = Web3.keccak(text='Swap(address,address,int256,int256,uint160,uint128,int24)').hex()
+_HEADS, _LOGS = '0xa', '0xb'
+
+
+class WsNode():
+
+    def __init__(self, pool: str, logs_per_block: int = 2):
+        self.pool = pool.lower()
+        self.logs_per_block = logs_per_block
+        self.block = 0
+        self.chain = []
+        self.errors = {}
+        self.requests = []
+        self.clients = set()
+        self.url = None
+        self._runner = None
+
+    def swap_log(self, block: int, index: int) -> dict:
+        data = encode_abi(['int256', 'int256', 'uint160', 'uint128', 'int24'],
+                          [block, -block, 2 ** 96, 10 ** 18, -200000 + block])
+        return {'address': self.pool, 'blockNumber': hex(block), 'logIndex': hex(index),
+                'transactionHash': '0x%064x' % (block * 10 + index), 'blockHash': '0x%064x' % block,
+                'transactionIndex': hex(index), 'topics': [SWAP_TOPIC, '0x' + '00' * 12 + '11' * 20,
+                                                           '0x' + '00' * 12 + '22' * 20],
+                'data': '0x' + data.hex(), 'removed': False}
+
+    async def start(self) -> 'WsNode':
+        app = web.Application()
+        app.router.add_get('/', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = 'ws://127.0.0.1:%d' % self._runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def drop(self):
+        for ws in list(self.clients):
+            await ws.close()
+
+    async def mine(self, count: int = 1, push: bool = True):
+        for _ in range(count):
+            self.block += 1
+            logs = [self.swap_log(self.block, i) for i in range(self.logs_per_block)]
+            self.chain.extend(logs)
+            if not push:
+                continue
+            head = {'number': hex(self.block), 'hash': '0x%064x' % self.block, 'parentHash': '0x%064x' % (self.block - 1),
+                    'timestamp': hex(self.block), 'baseFeePerGas': hex(10 ** 9)}
+            for ws in list(self.clients):
+                await self._push(ws, _HEADS, head)
+                for log in logs:
+                    await self._push(ws, _LOGS, log)
+
+    @staticmethod
+    async def _push(ws, subscription: str, result):
+        try:
+            await ws.send_str(json.dumps({'jsonrpc': '2.0', 'method': 'eth_subscription',
+                                          'params': {'subscription': subscription, 'result': result}}))
+        except ConnectionError:
+            pass
+
+    def _result(self, method: str, params: list):
+        if method == 'eth_subscribe':
+            return _HEADS if params[0] == 'newHeads' else _LOGS
+        if method == 'eth_blockNumber':
+            return hex(self.block)
+        if method == 'eth_getLogs':
+            start, end = int(params[0]['fromBlock'], 16), int(params[0]['toBlock'], 16)
+            return [log for log in self.chain if start <= int(log['blockNumber'], 16) <= end]
+        raise NotImplementedError(method)
+
+    async def _handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.clients.add(ws)
+        try:
+            async for message in ws:
+                message = json.loads(message.data)
+                method, params = message['method'], message['params']
+                self.requests.append((method, params))
+                error = self.errors[method](params) if method in self.errors else None
+                response = {'jsonrpc': '2.0', 'id': message['id']}
+                if error is not None:
+                    response['error'] = error
+                else:
+                    response['result'] = self._result(method, params)
+                await ws.send_str(json.dumps(response))
+        finally:
+            self.clients.discard(ws)
+        return ws
@@ -0,0 +1,276 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+池子的 initialized tick 流动性分布，本地维护，查询不访问网络。
+
+支持 KyberSwap Elastic 池子（MARKET_INFO_DICT 里的池子）和 Uniswap v3 池子，两者 ticks() 的前两个字段都是
+(liquidityGross, liquidityNet)，Mint/Burn 事件的 topic 和字段顺序也一样。区别在 initialized tick 怎么找：
+    Uniswap v3：tickBitmap，multicall 一次读回全部 word
+    Elastic：initializedTicks 链表 MIN_TICK -> ... -> MAX_TICK，每轮 multicall 读已知的下一个 tick 和它后面一窗口
+             按 tickDistance 对齐的候选 tick，候选里正好接上链表的 tick 当轮就确认，稀疏的地方每轮至少前进一个
+然后把找到的 tick 批量读 ticks()，所有读取固定在同一个区块。
+之后用 Mint/Burn 事件增量更新：Mint 在 tickLower 加 liquidityNet、tickUpper 减 liquidityNet，Burn 相反，
+liquidityGross 归零的 tick 从索引里删掉，和合约里 Tick.update / TickBitmap.flipTick 的逻辑一致。
+"""
+import bisect
+from itertools import accumulate
+from typing import Iterable, List, Optional, Tuple
+from eth_utils import event_abi_to_log_topic
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.types import BlockIdentifier
+from market_registry import get_market_registry
+from multicall import Multicall, output_types
+from pool_state import get_pool_state_cache
+from tick_math import MAX_TICK, MIN_TICK
+from utils import _load_contract_json
+
+# ticks() 调用比 slot0 重，500 个一批 eth_call gas 也在节点默认上限以内
+TICK_INDEX_CHUNK_SIZE = 500
+
+
+def _word_range(spacing: int) -> range:
+    return range((MIN_TICK // spacing) >> 8, ((MAX_TICK // spacing) >> 8) + 1)
+
+
+def _bitmap_ticks(word_pos: int, word: int, spacing: int) -> List[int]:
+    """tickBitmap 一个 word 里置位的 tick，从小到大"""
+    ticks = []
+    while word:
+        lowest = word & -word
+        ticks.append(((word_pos << 8) + lowest.bit_length() - 1) * spacing)
+        word ^= lowest
+    return ticks
+
+
+class TickIndex():
+    """
+    一个池子的 tick -> (liquidityGross, liquidityNet)，三个按 tick 排序的平行 list，查找用 bisect。
+    当前价格所在区间的活跃流动性 = tick 以下所有 liquidityNet 之和，前缀和在更新后懒计算。
+
+        index = TickIndex(w3, '0x8ad599c3a0ff1de082011efddc58f1908eb6e6d8')     # Uniswap v3 USDC/ETH 0.3%
+        index.bootstrap()
+        index.liquidity_in_range(-201000, -199000)
+        index.apply_logs(w3.eth.get_logs({...}))
+    """
+
+    def __init__(self, w3: Web3, pool_address, chunk_size: int = TICK_INDEX_CHUNK_SIZE, pool_abi: str = None):
+        """pool_abi 是 'ElasticPool' 或 'UniswapV3Pool'，不传时登记过的池子按 Elastic，其他按 Uniswap v3"""
+        self.w3 = w3
+        self.pool_address = Web3.toChecksumAddress(pool_address)
+        if pool_abi is None:
+            registered = get_market_registry().market_by_pool(self.pool_address) is not None
+            pool_abi = 'ElasticPool' if registered else 'UniswapV3Pool'
+        self.pool_abi = pool_abi
+        self.pool = _load_contract_json(w3, pool_abi, self.pool_address)
+        self.multicall = Multicall(w3, chunk_size=chunk_size)
+        self.block = None
+        self.tick_spacing = None
+        self.ticks = []
+        self.liquidity_gross = []
+        self.liquidity_net = []
+        self._prefix = None
+        self._mint_topic = event_abi_to_log_topic(self.pool.events.Mint._get_event_abi())
+        self._burn_topic = event_abi_to_log_topic(self.pool.events.Burn._get_event_abi())
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def _ticks_from_bitmap(self, spacing: int, block_number: int) -> List[int]:
+        """Uniswap v3：一轮 multicall 读全部 tickBitmap word"""
+        words = list(_word_range(spacing))
+        calls = [(self.pool_address, self.pool.encodeABI("tickBitmap", args=(word_pos,))) for word_pos in words]
+        _, results = self.multicall.aggregate(calls, block=block_number)
+        bitmap_types = output_types(self.pool, "tickBitmap")
+        ticks = []
+        for word_pos, result in zip(words, results):
+            word = self.multicall.decode(bitmap_types, result)
+            if word is None:
+                raise Exception(f"tickBitmap({word_pos}) failed for pool {self.pool_address} at block {block_number}")
+            ticks.extend(_bitmap_ticks(word_pos, word[0], spacing))
+        return ticks
+
+    def _ticks_from_list(self, spacing: int, block_number: int) -> List[int]:
+        """
+        Elastic：沿 initializedTicks 链表从 MIN_TICK 走到 MAX_TICK（两端是哨兵，也在链表里）。
+        每轮读 next 和它后面 chunk_size - 1 个按 spacing 对齐的候选，未初始化的 tick 返回 (0, 0)；
+        候选依次和链表对上就接着确认，对不上的说明中间隔得远，下一轮从 next 继续
+        """
+        list_types = output_types(self.pool, "initializedTicks")
+        ticks = []
+        next_tick = MIN_TICK
+        while ticks[-1:] != [MAX_TICK]:
+            start = next_tick - next_tick % spacing + spacing
+            stop = min(MAX_TICK, start + (self.multicall.chunk_size - 1) * spacing)
+            candidates = [next_tick] + list(range(start, stop, spacing))
+            calls = [(self.pool_address, self.pool.encodeABI("initializedTicks", args=(tick,)))
+                     for tick in candidates]
+            _, results = self.multicall.aggregate(calls, block=block_number)
+            for tick, result in zip(candidates, results):
+                if tick < next_tick:
+                    continue
+                if tick > next_tick:
+                    break
+                node = self.multicall.decode(list_types, result)
+                if node is None:
+                    raise Exception(f"initializedTicks({tick}) failed for pool {self.pool_address} "
+                                    f"at block {block_number}")
+                ticks.append(tick)
+                if tick == MAX_TICK:
+                    break
+                if node[1] <= tick:
+                    raise Exception(f"broken tick list at {tick} of pool {self.pool_address} at block {block_number}")
+                next_tick = node[1]
+        return ticks
+
+    def bootstrap(self, block: BlockIdentifier = 'latest'):
+        """找出全部 initialized tick 再读它们的 ticks()，结果都在同一个区块"""
+        state = get_pool_state_cache(self.w3, self.pool_abi).get(self.pool_address, block)
+        spacing = state.tickSpacing
+        block_number = state.block
+        if self.pool_abi == 'ElasticPool':
+            ticks = self._ticks_from_list(spacing, block_number)
+        else:
+            ticks = self._ticks_from_bitmap(spacing, block_number)
+
+        calls = [(self.pool_address, self.pool.encodeABI("ticks", args=(tick,))) for tick in ticks]
+        _, results = self.multicall.aggregate(calls, block=block_number) if calls else (block_number, [])
+        tick_types = output_types(self.pool, "ticks")
+        gross, net = [], []
+        for tick, result in zip(ticks, results):
+            info = self.multicall.decode(tick_types, result)
+            if info is None:
+                raise Exception(f"ticks({tick}) failed for pool {self.pool_address} at block {block_number}")
+            gross.append(info[0])
+            net.append(info[1])
+        if self.pool_abi == 'ElasticPool':
+            # 链表两端的 MIN_TICK/MAX_TICK 是哨兵，没有 position 用到时 liquidityGross 是 0
+            kept = [i for i, liquidity_gross in enumerate(gross) if liquidity_gross]
+            ticks, gross, net = [ticks[i] for i in kept], [gross[i] for i in kept], [net[i] for i in kept]
+
+        self.block = block_number
+        self.tick_spacing = spacing
+        self.ticks, self.liquidity_gross, self.liquidity_net = ticks, gross, net
+        self._prefix = None
+        return self
+
+    def update_tick(self, tick: int, liquidity_delta: int, upper: bool):
+        """Tick.update：下边界 liquidityNet 加 delta，上边界减 delta；gross 归零的 tick 删除"""
+        i = bisect.bisect_left(self.ticks, tick)
+        net_delta = -liquidity_delta if upper else liquidity_delta
+        if i < len(self.ticks) and self.ticks[i] == tick:
+            gross = self.liquidity_gross[i] + liquidity_delta
+            if gross == 0:
+                del self.ticks[i], self.liquidity_gross[i], self.liquidity_net[i]
+            else:
+                self.liquidity_gross[i] = gross
+                self.liquidity_net[i] += net_delta
+        elif liquidity_delta > 0:
+            self.ticks.insert(i, tick)
+            self.liquidity_gross.insert(i, liquidity_delta)
+            self.liquidity_net.insert(i, net_delta)
+        else:
+            raise Exception(f"burn on uninitialized tick {tick} of pool {self.pool_address}")
+        self._prefix = None
+
+    def apply_position(self, tick_lower: int, tick_upper: int, liquidity_delta: int):
+        """Mint 传正数，Burn 传负数"""
+        if liquidity_delta == 0:
+            # amount 为 0 的 burn 只是结算手续费，不改 tick
+            return
+        self.update_tick(tick_lower, liquidity_delta, upper=False)
+        self.update_tick(tick_upper, liquidity_delta, upper=True)
+
+    def apply_log(self, log) -> bool:
+        """应用一条 Mint/Burn 原始日志，bootstrap 区块及以前的日志忽略。返回是否改动了索引"""
+        if Web3.toChecksumAddress(log['address']) != self.pool_address:
+            return False
+        if self.block is not None and log['blockNumber'] <= self.block:
+            return False
+        topic = HexBytes(log['topics'][0])
+        if topic == self._mint_topic:
+            # Mint(address sender, address indexed owner, int24 indexed tickLower, int24 indexed tickUpper,
+            #      uint128 amount, uint256 amount0, uint256 amount1)
+            _, amount, _, _ = self.w3.codec.decode_abi(['address', 'uint128', 'uint256', 'uint256'],
+                                                       HexBytes(log['data']))
+        elif topic == self._burn_topic:
+            amount, _, _ = self.w3.codec.decode_abi(['uint128', 'uint256', 'uint256'], HexBytes(log['data']))
+            amount = -amount
+        else:
+            return False
+        tick_lower = self.w3.codec.decode_single('int24', HexBytes(log['topics'][2]))
+        tick_upper = self.w3.codec.decode_single('int24', HexBytes(log['topics'][3]))
+        self.apply_position(tick_lower, tick_upper, amount)
+        return True
+
+    def apply_logs(self, logs: Iterable, to_block: Optional[int] = None) -> int:
+        """
+        按区块顺序应用一批日志，返回改动的条数。to_block 是这批日志覆盖到的区块，
+        之后 block 推进到这里，没有日志的区块也算同步过了。
+        """
+        logs = sorted(logs, key=lambda log: (log['blockNumber'], log['logIndex']))
+        applied = sum(1 for log in logs if self.apply_log(log))
+        last_block = logs[-1]['blockNumber'] if logs else self.block
+        if to_block is not None and (last_block is None or to_block > last_block):
+            last_block = to_block
+        self.block = last_block
+        return applied
+
+    def sync(self, to_block: BlockIdentifier = 'latest') -> int:
+        """从 bootstrap/上次同步的区块拉 Mint/Burn 日志追到 to_block，不处理 reorg"""
+        if self.block is None:
+            self.bootstrap(to_block)
+            return 0
+        if to_block == 'latest':
+            to_block = self.w3.eth.block_number
+        if to_block <= self.block:
+            return 0
+        logs = self.w3.eth.get_logs({
+            'address': self.pool_address,
+            'fromBlock': self.block + 1,
+            'toBlock': to_block,
+            'topics': [[Web3.toHex(self._mint_topic), Web3.toHex(self._burn_topic)]],
+        })
+        return self.apply_logs(logs, to_block=to_block)
+
+    # ---- 本地查询 ----
+
+    def _liquidity_prefix(self) -> List[int]:
+        if self._prefix is None:
+            self._prefix = list(accumulate(self.liquidity_net))
+        return self._prefix
+
+    def liquidity_at(self, tick: int) -> int:
+        """价格在 tick 时的活跃流动性，即 tick 及以下所有 initialized tick 的 liquidityNet 之和"""
+        i = bisect.bisect_right(self.ticks, tick)
+        return self._liquidity_prefix()[i - 1] if i else 0
+
+    def liquidity_in_range(self, tick_lower: int, tick_upper: int) -> List[Tuple[int, int]]:
+        """
+        [tick_lower, tick_upper) 内的流动性分布，返回 [(区间起点 tick, 活跃流动性), ...]，
+        第一段从 tick_lower 开始，之后每个 initialized tick 开始新的一段。
+        """
+        prefix = self._liquidity_prefix()
+        start = bisect.bisect_right(self.ticks, tick_lower)
+        end = bisect.bisect_left(self.ticks, tick_upper)
+        segments = [(tick_lower, prefix[start - 1] if start else 0)]
+        segments.extend(zip(self.ticks[start:end], prefix[start:end]))
+        return segments
+
+    def next_initialized_tick(self, tick: int, lte: bool) -> Optional[int]:
+        """
+        lte=True: <= tick 的最大 initialized tick；lte=False: > tick 的最小 initialized tick。
+        和 TickBitmap.nextInitializedTickWithinOneWord 的方向约定一样，但不受 word 边界限制，没有时返回 None
+        """
+        if lte:
+            i = bisect.bisect_right(self.ticks, tick)
+            return self.ticks[i - 1] if i else None
+        i = bisect.bisect_right(self.ticks, tick)
+        return self.ticks[i] if i < len(self.ticks) else None
+
+    def tick_info(self, tick: int) -> Optional[Tuple[int, int]]:
+        """(liquidityGross, liquidityNet)，tick 未初始化返回 None"""
+        i = bisect.bisect_left(self.ticks, tick)
+        if i < len(self.ticks) and self.ticks[i] == tick:
+            return self.liquidity_gross[i], self.liquidity_net[i]
+        return None
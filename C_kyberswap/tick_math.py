@@ -0,0 +1,146 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TickMath 的整数实现，和链上结果完全一致
+https://github.com/Uniswap/v3-core/blob/main/contracts/libraries/TickMath.sol
+
+sqrtPriceX96 是 Q64.96 定点数，getSqrtRatioAtTick 用和合约相同的常数表，
+getTickAtSqrtRatio 先用 float log 估计，再用 getSqrtRatioAtTick 校正到精确值。
+"""
+import functools
+import math
+from config import TICK_SPACING
+
+MIN_TICK = -887272
+MAX_TICK = -MIN_TICK
+MIN_SQRT_RATIO = 4295128739
+MAX_SQRT_RATIO = 1461446703485210103287273052203988822378723970342
+Q96 = 1 << 96
+Q192 = 1 << 192
+MAX_UINT256 = (1 << 256) - 1
+
+_TICK_RATIOS = (
+    (0x2, 0xfff97272373d413259a46990580e213a),
+    (0x4, 0xfff2e50f5f656932ef12357cf3c7fdcc),
+    (0x8, 0xffe5caca7e10e4e61c3624eaa0941cd0),
+    (0x10, 0xffcb9843d60f6159c9db58835c926644),
+    (0x20, 0xff973b41fa98c081472e6896dfb254c0),
+    (0x40, 0xff2ea16466c96a3843ec78b326b52861),
+    (0x80, 0xfe5dee046a99a2a811c461f1969c3053),
+    (0x100, 0xfcbe86c7900a88aedcffc83b479aa3a4),
+    (0x200, 0xf987a7253ac413176f2b074cf7815e54),
+    (0x400, 0xf3392b0822b70005940c7a398e4b70f3),
+    (0x800, 0xe7159475a2c29b7443b29c7fa6e889d9),
+    (0x1000, 0xd097f3bdfd2022b8845ad8f792aa5825),
+    (0x2000, 0xa9f746462d870fdf8a65dc1f90e061e5),
+    (0x4000, 0x70d869a156d2a1b890bb3df62baf32f7),
+    (0x8000, 0x31be135f97d08fd981231505542fcfa6),
+    (0x10000, 0x9aa508b5b7a84e1c677de54f3e99bc9),
+    (0x20000, 0x5d6af8dedb81196699c329225ee604),
+    (0x40000, 0x2216e584f5fa1ea926041bedfe98),
+    (0x80000, 0x48a170391f7dc42444e8fa2),
+)
+_LOG_SQRT_10001 = math.log(math.sqrt(1.0001))
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def get_sqrt_ratio_at_tick(tick: int) -> int:
+    """sqrt(1.0001^tick) * 2^96, rounded up exactly like TickMath.getSqrtRatioAtTick."""
+    abs_tick = -tick if tick < 0 else tick
+    if abs_tick > MAX_TICK:
+        raise ValueError(f"tick {tick} out of range")
+    ratio = 0xfffcb933bd6fad37aa2d162d1a594001 if abs_tick & 0x1 else 0x100000000000000000000000000000000
+    for bit, multiplier in _TICK_RATIOS:
+        if abs_tick & bit:
+            ratio = (ratio * multiplier) >> 128
+    if tick > 0:
+        ratio = MAX_UINT256 // ratio
+    return (ratio >> 32) + (0 if ratio & 0xffffffff == 0 else 1)
+
+
+def get_tick_at_sqrt_ratio(sqrt_price_x96: int) -> int:
+    """Greatest tick whose sqrt ratio is <= sqrt_price_x96, same as TickMath.getTickAtSqrtRatio."""
+    if not MIN_SQRT_RATIO <= sqrt_price_x96 < MAX_SQRT_RATIO:
+        raise ValueError(f"sqrt_price_x96 {sqrt_price_x96} out of range")
+    tick = math.floor(math.log(sqrt_price_x96 / Q96) / _LOG_SQRT_10001)
+    tick = min(max(tick, MIN_TICK), MAX_TICK)
+    while tick > MIN_TICK and get_sqrt_ratio_at_tick(tick) > sqrt_price_x96:
+        tick -= 1
+    while tick < MAX_TICK and get_sqrt_ratio_at_tick(tick + 1) <= sqrt_price_x96:
+        tick += 1
+    return tick
+
+
+class SqrtRatioTable():
+    """
+    某个 tick spacing 的 sqrtPriceX96 表，按 tick // spacing 下标懒加载，
+    范围扫描里重复的 tick 转换就是一次 list 下标访问。
+    """
+
+    def __init__(self, spacing: int):
+        self.spacing = spacing
+        self.min_index = -(MAX_TICK // spacing)
+        self._table = [None] * (2 * (MAX_TICK // spacing) + 1)
+
+    def __getitem__(self, tick: int) -> int:
+        index, rem = divmod(tick, self.spacing)
+        if rem:
+            return get_sqrt_ratio_at_tick(tick)
+        index -= self.min_index
+        value = self._table[index]
+        if value is None:
+            value = self._table[index] = get_sqrt_ratio_at_tick(tick)
+        return value
+
+
+@functools.lru_cache()
+def sqrt_ratio_table(spacing: int) -> SqrtRatioTable:
+    return SqrtRatioTable(spacing)
+
+
+def sqrt_ratio_at_tick(tick: int, spacing: int = TICK_SPACING['MEDIUM']) -> int:
+    return sqrt_ratio_table(spacing)[tick]
+
+
+def sqrt_ratio_to_price(sqrt_price_x96: int, base_token_decimal=6, quote_token_decimal=18) -> float:
+    """utils.tick2price 的价格定义：2^192 / sqrtP^2 * 10^(quote_decimal - base_decimal)，整数运算后只做一次舍入"""
+    delta = quote_token_decimal - base_token_decimal
+    if delta >= 0:
+        return (Q192 * 10 ** delta) / (sqrt_price_x96 * sqrt_price_x96)
+    return Q192 / (sqrt_price_x96 * sqrt_price_x96 * 10 ** -delta)
+
+
+def price_to_sqrt_ratio(price: float, base_token_decimal=6, quote_token_decimal=18) -> int:
+    """sqrt_ratio_to_price 的反函数，向下取整"""
+    numerator, denominator = float(price).as_integer_ratio()
+    delta = quote_token_decimal - base_token_decimal
+    # sqrtP^2 = 2^192 * 10^delta / price
+    num = Q192 * denominator * (10 ** delta if delta > 0 else 1)
+    den = numerator * (10 ** -delta if delta < 0 else 1)
+    return math.isqrt(num // den)
+
+
+def get_amount0_for_liquidity(sqrt_ratio_a: int, sqrt_ratio_b: int, liquidity: int) -> int:
+    """LiquidityAmounts.getAmount0ForLiquidity"""
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a, sqrt_ratio_b = sqrt_ratio_b, sqrt_ratio_a
+    return ((liquidity << 96) * (sqrt_ratio_b - sqrt_ratio_a) // sqrt_ratio_b) // sqrt_ratio_a
+
+
+def get_amount1_for_liquidity(sqrt_ratio_a: int, sqrt_ratio_b: int, liquidity: int) -> int:
+    """LiquidityAmounts.getAmount1ForLiquidity"""
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a, sqrt_ratio_b = sqrt_ratio_b, sqrt_ratio_a
+    return liquidity * (sqrt_ratio_b - sqrt_ratio_a) // Q96
+
+
+def get_amounts_for_liquidity(sqrt_ratio_x96: int, sqrt_ratio_a: int, sqrt_ratio_b: int, liquidity: int):
+    """LiquidityAmounts.getAmountsForLiquidity，返回 token0/token1 的最小单位数量 (amount0, amount1)"""
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a, sqrt_ratio_b = sqrt_ratio_b, sqrt_ratio_a
+    if sqrt_ratio_x96 <= sqrt_ratio_a:
+        return get_amount0_for_liquidity(sqrt_ratio_a, sqrt_ratio_b, liquidity), 0
+    if sqrt_ratio_x96 < sqrt_ratio_b:
+        return (get_amount0_for_liquidity(sqrt_ratio_x96, sqrt_ratio_b, liquidity),
+                get_amount1_for_liquidity(sqrt_ratio_a, sqrt_ratio_x96, liquidity))
+    return 0, get_amount1_for_liquidity(sqrt_ratio_a, sqrt_ratio_b, liquidity)
@@ -0,0 +1,251 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+不阻塞的发交易流水线：提交后马上返回 Future，发送、等待上链、加价替换都在后台线程里做。
+
+- 发送线程：按提交顺序从队列里取任务，组交易（调用方给的 build 函数，可以包含读链上状态）、分配 nonce、
+  fee_engine 填 gas 和手续费、签名、发送。
+- 监视线程：每个新区块把所有未确认交易（包括被替换掉的旧 hash，它们也可能上链）的 receipt 放进一个 JSON-RPC batch 查询。
+  发出后 replace_after 个区块还没上链的，用同一个 nonce 把 maxFeePerGas / maxPriorityFeePerGas 至少提高
+  REPLACEMENT_BUMP（节点要求替换交易至少加价 10%）重新发送，最多 max_replacements 次。
+  替换次数用完或者到了 max_fee_cap 之后不再加价，但已经签名发出的交易还可能上链，所以继续查 receipt，直到这个 nonce 被用掉。
+  同一个 batch 里还读钱包的 latest nonce：nonce 已经被用掉、这个 nonce 发过的 hash 却都没上链（别的交易占了这个 nonce），
+  Future 以 TxDropped 结束，这时这个 nonce 上的交易都不会再上链。
+
+    pipeline = TxPipeline(w3, private_key, nonce_manager, fee_engine).start()
+    future = pipeline.submit(build)          # build() -> (tx_params, result dict)
+    future.add_done_callback(lambda f: print(f.result()['receipt'].status))
+
+Future 的结果是 build 返回的 result dict，加上上链的 txn_hash 和 receipt。
+receipt.status == 0 的交易也算完成，由调用方检查 status；nonce 被别的交易占用时 future.exception() 是 TxDropped。
+"""
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.transactions import fill_transaction_defaults
+from batch import RPCBatch
+from fee_engine import FeeEngine
+from nonce_manager import NonceManager
+
+REPLACE_AFTER_BLOCKS = 3
+MAX_REPLACEMENTS = 5
+REPLACEMENT_BUMP = 0.125
+RECEIPT_POLL_INTERVAL = 1.0
+# 替换时节点返回这些错误不算失败：旧交易已经上链或者已经在 mempool 里
+_REPLACEMENT_BENIGN_ERRORS = ('nonce too low', 'already known', 'underpriced')
+
+
+class TxDropped(Exception):
+    """nonce 被别的交易用掉，hashes（这个 nonce 发过的所有版本）都不会再上链，可以放心重新提交"""
+
+    def __init__(self, message: str, nonce: int, hashes: List[HexBytes]):
+        super().__init__(message)
+        self.nonce = nonce
+        self.hashes = hashes
+
+
+class PendingTx():
+    """一个 nonce 上已经发出的交易，hashes 是这个 nonce 发过的所有版本"""
+
+    def __init__(self, nonce: int, transaction: dict, tx_hash: HexBytes, sent_block: int, future: Future,
+                 result: dict):
+        self.nonce = nonce
+        self.transaction = transaction
+        self.hashes = [tx_hash]
+        self.sent_block = sent_block
+        self.replacements = 0
+        # 替换次数用完或者到了 max_fee_cap 之后为 False，只等上链不再加价
+        self.bumping = True
+        self.future = future
+        self.result = result
+
+
+class TxPipeline():
+
+    def __init__(self, w3: Web3, private_key, nonce_manager: NonceManager, fee_engine: FeeEngine,
+                 replace_after: int = REPLACE_AFTER_BLOCKS, max_replacements: int = MAX_REPLACEMENTS,
+                 bump: float = REPLACEMENT_BUMP, poll_interval: float = RECEIPT_POLL_INTERVAL,
+                 max_fee_cap: Optional[int] = None):
+        self.w3 = w3
+        self.private_key = private_key
+        self.nonce_manager = nonce_manager
+        self.fee_engine = fee_engine
+        self.replace_after = replace_after
+        self.max_replacements = max_replacements
+        self.bump = bump
+        self.poll_interval = poll_interval
+        # maxFeePerGas 的上限，替换加价不会超过它
+        self.max_fee_cap = max_fee_cap
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._head = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self) -> 'TxPipeline':
+        if self._threads:
+            return self
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._send_loop, name='tx-send', daemon=True),
+                         threading.Thread(target=self._watch_loop, name='tx-watch', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """停止后台线程，队列里还没发的任务和未确认的 Future 保持原样"""
+        self._stop.set()
+        self._queue.put(None)
+        self._threads = []
+
+    def submit(self, build: Callable[[], Tuple[dict, dict]]) -> Future:
+        """
+        build() 在发送线程里执行，返回 (tx_params, result)。tx_params 不带 nonce，
+        gas / 手续费没填的由 fee_engine 填
+        """
+        future = Future()
+        self._queue.put((build, future))
+        return future
+
+    def pending(self) -> List[PendingTx]:
+        with self._lock:
+            return list(self._pending.values())
+
+    def _current_block(self) -> int:
+        return self._head if self._head is not None else self.w3.eth.block_number
+
+    def _sign_and_send(self, transaction: dict) -> HexBytes:
+        signed_txn = self.w3.eth.account.sign_transaction(transaction, private_key=self.private_key)
+        return self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+
+    def _send_loop(self):
+        while not self._stop.is_set():
+            job = self._queue.get()
+            if job is None:
+                break
+            build, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            nonce = None
+            try:
+                tx_params, result = build()
+                nonce = self.nonce_manager.allocate()
+                transaction = fill_transaction_defaults(self.w3, self.fee_engine.fill(dict(tx_params, nonce=nonce)))
+                tx_hash = self._sign_and_send(transaction)
+            except Exception as e:
+                if nonce is not None:
+                    self.nonce_manager.release(nonce)
+                future.set_exception(e)
+                continue
+            self.nonce_manager.mark_sent(nonce)
+            self.fee_engine.track(tx_hash, transaction)
+            result['txn_hash'] = tx_hash.hex()
+            with self._lock:
+                self._pending[nonce] = PendingTx(nonce, transaction, tx_hash, self._current_block(), future, result)
+
+    def _watch_loop(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                head = self.w3.eth.block_number
+                if head == self._head:
+                    continue
+                self._head = head
+                self.check(head)
+            except Exception as e:
+                print(e)
+
+    def check(self, head: int):
+        """查一轮 receipt，上链的完成 Future，等太久的加价替换。监视线程每个新区块调一次"""
+        pending = self.pending()
+        if not pending:
+            return
+        with RPCBatch(self.w3) as batch:
+            # nonce 计数放在 receipt 前面：计数说已经用掉、之后的 receipt 又都查不到，才是被别的交易占了
+            latest_nonce = batch.get_transaction_count(self.nonce_manager.address, 'latest')
+            receipts = [(tx, tx_hash, batch.get_transaction_receipt(tx_hash)) for tx in pending for tx_hash in tx.hashes]
+        try:
+            latest_nonce = latest_nonce.result()
+        except Exception:
+            latest_nonce = None
+        mined = {}
+        for tx, tx_hash, future in receipts:
+            try:
+                receipt = future.result()
+            except Exception:
+                receipt = None
+            if receipt is not None:
+                mined[tx.nonce] = (tx_hash, receipt)
+        for tx in pending:
+            if tx.nonce in mined:
+                self._complete(tx, *mined[tx.nonce])
+            elif latest_nonce is not None and latest_nonce > tx.nonce:
+                self._fail(tx, f"nonce {tx.nonce} was used by another transaction, none of "
+                               f"{[HexBytes(h).hex() for h in tx.hashes]} was mined")
+            elif tx.bumping and head - tx.sent_block >= self.replace_after:
+                if tx.replacements >= self.max_replacements or not self._replace(tx, head):
+                    # 发出去的版本还在 mempool 里，不能当作失败，继续等 receipt 或者 nonce 被占用
+                    tx.bumping = False
+                    print(f"nonce {tx.nonce}: stopped bumping after {tx.replacements} replacements, "
+                          f"waiting for {HexBytes(tx.hashes[-1]).hex()}")
+
+    def _complete(self, tx: PendingTx, tx_hash: HexBytes, receipt):
+        with self._lock:
+            self._pending.pop(tx.nonce, None)
+        self.fee_engine.observe_receipt(tx_hash, receipt)
+        for other in tx.hashes:
+            if other != tx_hash:
+                self.fee_engine.untrack(other)
+        tx.result['txn_hash'] = HexBytes(tx_hash).hex()
+        tx.result['receipt'] = receipt
+        tx.future.set_result(tx.result)
+
+    def _fail(self, tx: PendingTx, message: str):
+        """nonce 已经被别的交易用掉：Future 以 TxDropped 结束，发过的 hash 都不再跟踪"""
+        with self._lock:
+            self._pending.pop(tx.nonce, None)
+        for tx_hash in tx.hashes:
+            self.fee_engine.untrack(tx_hash)
+        tx.future.set_exception(TxDropped(message, tx.nonce, list(tx.hashes)))
+
+    def _bumped(self, value: int, suggested: int) -> int:
+        return max(int(value * (1 + self.bump)) + 1, suggested)
+
+    def _replace(self, tx: PendingTx, head: int) -> bool:
+        """同一个 nonce 加价重发，data/gas 不变；已经到了 max_fee_cap 加不上去时返回 False"""
+        fees = self.fee_engine.suggest()
+        transaction = dict(tx.transaction)
+        if 'gasPrice' in transaction:
+            transaction['gasPrice'] = self._bumped(transaction['gasPrice'], fees.maxFeePerGas)
+        else:
+            transaction['maxPriorityFeePerGas'] = self._bumped(transaction['maxPriorityFeePerGas'],
+                                                               fees.maxPriorityFeePerGas)
+            transaction['maxFeePerGas'] = max(self._bumped(transaction['maxFeePerGas'], fees.maxFeePerGas),
+                                              transaction['maxPriorityFeePerGas'])
+        fee_key = 'gasPrice' if 'gasPrice' in transaction else 'maxFeePerGas'
+        if self.max_fee_cap is not None and transaction[fee_key] > self.max_fee_cap:
+            if tx.transaction[fee_key] >= self.max_fee_cap:
+                return False
+            transaction[fee_key] = self.max_fee_cap
+            if 'maxPriorityFeePerGas' in transaction:
+                transaction['maxPriorityFeePerGas'] = min(transaction['maxPriorityFeePerGas'], self.max_fee_cap)
+        tx.replacements += 1
+        tx.sent_block = head
+        try:
+            tx_hash = self._sign_and_send(transaction)
+        except Exception as e:
+            if any(message in str(e) for message in _REPLACEMENT_BENIGN_ERRORS):
+                # 加价不够时下一次在这次的基础上继续加
+                tx.transaction = transaction
+            else:
+                print(e)
+            return True
+        tx.transaction = transaction
+        tx.hashes.append(tx_hash)
+        self.fee_engine.track(tx_hash, transaction)
+        # 刷新 nonce_manager 里的发送时间，等待替换上链期间 resync 不会把这个 nonce 当成没人占用
+        self.nonce_manager.mark_sent(tx.nonce)
+        return True
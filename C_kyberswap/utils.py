@@ -2,12 +2,23 @@ import os
 import math
 import web3
 import json
+import pickle
+import hashlib
 import functools
 from web3 import Web3
 from web3.eth import Contract  # noqa: F401
 from web3.types import Address, ChecksumAddress
 # from web3.contract import encodeABI
-from typing import Union
+from typing import Sequence, Union
+from middleware import EthCallCacheMiddleware
+from rpc_pool import PooledHTTPProvider
+from tick_math import (
+    get_sqrt_ratio_at_tick,
+    get_tick_at_sqrt_ratio,
+    price_to_sqrt_ratio,
+    sqrt_ratio_at_tick,
+    sqrt_ratio_to_price,
+)
 
 AddressLike = Union[Address, ChecksumAddress]
 
@@ -24,9 +35,63 @@ def _load_contract(w3: Web3, abi_name: str, address: AddressLike) -> Contract:
     address = Web3.toChecksumAddress(address)
     return w3.eth.contract(address=address, abi=_load_abi(abi_name))
 
+@functools.lru_cache()
+def _load_abi_json(name: str) -> list:
+    """
+    读 abi/<name>.json 里的 abi 列表，同一个进程只解析一次。
+    hardhat 导出的 json 大部分是 bytecode，解析一次后只把 abi 部分按文件内容 hash pickle 到 abi/__pycache__，
+    下次启动直接 pickle.load。
+    """
+    abi_dir = f"{os.path.dirname(os.path.abspath(__file__))}/abi"
+    with open(os.path.abspath(f"{abi_dir}/{name}.json"), 'rb') as f:
+        raw = f.read()
+    cache_path = f"{abi_dir}/__pycache__/{name}.{hashlib.sha1(raw).hexdigest()[:16]}.pickle"
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    data = json.loads(raw)
+    abi = data["abi"] if isinstance(data, dict) else data
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(abi, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return abi
+
+
+@functools.lru_cache()
+def _load_contract_json(w3: Web3, name: str, address: AddressLike) -> Contract:
+    return w3.eth.contract(address=Web3.toChecksumAddress(address), abi=_load_abi_json(name))
+
+
+@functools.lru_cache()
+def _get_web3(provider_url: Union[str, Sequence[str]] = None) -> Web3:
+    """
+    同一个 rpc url 的 client 共用一个 Web3，合约对象也就能跨实例共用（_load_contract_json 按 w3 缓存）。
+    同一区块内重复的 eth_call 走缓存，命中情况看 w3.middleware_onion['eth_call_cache'].stats()
+    provider_url 是多个节点的 tuple 时用 PooledHTTPProvider：按延迟选节点，读请求 hedge，节点状态看 w3.provider.stats()
+    """
+    if isinstance(provider_url, (tuple, list)) and len(provider_url) > 1:
+        w3 = Web3(PooledHTTPProvider(provider_url))
+    else:
+        if isinstance(provider_url, (tuple, list)):
+            provider_url = provider_url[0]
+        w3 = Web3(Web3.HTTPProvider(provider_url))
+    w3.middleware_onion.add(EthCallCacheMiddleware(), 'eth_call_cache')
+    return w3
+
+
 def _load_contract_erc20(w3: Web3, address: AddressLike) -> Contract:
     return _load_contract(w3, "abi/erc20", address)
 
+def _load_contract_multicall(w3: Web3, address: AddressLike) -> Contract:
+    return _load_contract(w3, "abi/multicall", address)
+
 def _str_to_addr(s: Union[AddressLike, str]) -> Address:
     """Idempotent"""
     if isinstance(s, str):
@@ -50,19 +115,18 @@ def price2tick(price, base_token_decimal=6,quote_token_decimal=18, spacing=60):
     # =========================================================================
     # spcing is different in different fees structures.
     # =========================================================================
-    delta_decimal = 10 ** (quote_token_decimal - base_token_decimal)
-    x192 = 2 ** 192 / (price / delta_decimal)
-    x96 = math.sqrt(x192)
-    exact_tick = round(math.log(x96 / 2 ** 96, math.sqrt(1.0001)))
+    sqrt_price_x96 = price_to_sqrt_ratio(price, base_token_decimal, quote_token_decimal)
+    exact_tick = get_tick_at_sqrt_ratio(sqrt_price_x96)
+    # 和原来的 round(log) 一样取最近的 tick，避免 float 价格的舍入误差落到下一个 tick
+    if get_sqrt_ratio_at_tick(exact_tick + 1) - sqrt_price_x96 < sqrt_price_x96 - get_sqrt_ratio_at_tick(exact_tick):
+        exact_tick += 1
     spaced_tick = exact_tick - exact_tick % spacing
     return spaced_tick
 
-def tick2price(tick, base_token_decimal=6, quote_token_decimal=18):
-    if tick < 0:
-        tick = -tick
-    delta_decimal = 10 ** (quote_token_decimal - base_token_decimal)
-    sqrt_x96 = (math.sqrt(1.0001) ** tick) * (2 ** 96)
-    price = (2 ** 192) / (sqrt_x96 ** 2) * int(delta_decimal)
+def tick2price(tick, base_token_decimal=6, quote_token_decimal=18, spacing=60):
+    # 整数 TickMath 算 sqrtPriceX96，按 spacing 缓存，负 tick 保留符号
+    sqrt_x96 = sqrt_ratio_at_tick(tick, spacing)
+    price = sqrt_ratio_to_price(sqrt_x96, base_token_decimal, quote_token_decimal)
     return price
 
 
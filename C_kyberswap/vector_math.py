@@ -0,0 +1,84 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+utils.py 里 liquidity/amount 计算和 tick/price 转换的 numpy 版本，输入输出都是数组，
+支持广播：价格情景 shape (S, 1) 配 N 个 position 的 (N,) 参数，得到 (S, N) 的结果。
+
+公式和标量版本一致，sqrtX96 里的 2^96 在分子分母里约掉了，直接用 sqrt(price)。
+价格用的是 float，要和链上逐位一致用 tick_math。
+"""
+import math
+import numpy as np
+
+_LOG_10001 = math.log(1.0001)
+
+
+def tick2price(tick, base_token_decimal=6, quote_token_decimal=18):
+    """utils.tick2price: 10^(quote_decimal - base_decimal) / 1.0001^tick"""
+    tick = np.asarray(tick, dtype=np.float64)
+    return np.exp(-tick * _LOG_10001) * 10.0 ** (quote_token_decimal - base_token_decimal)
+
+
+def price2tick(price, base_token_decimal=6, quote_token_decimal=18, spacing=60):
+    """utils.price2tick: 最近的 tick，再向下对齐到 spacing"""
+    price = np.asarray(price, dtype=np.float64)
+    delta_decimal = 10.0 ** (quote_token_decimal - base_token_decimal)
+    exact_tick = np.rint(np.log(delta_decimal / price) / _LOG_10001).astype(np.int64)
+    return exact_tick - exact_tick % spacing
+
+
+def _ordered_sqrt(low, high):
+    sqrt_low = np.sqrt(np.minimum(low, high))
+    sqrt_high = np.sqrt(np.maximum(low, high))
+    return sqrt_low, sqrt_high
+
+
+def get_liquidity_for_base_amount(low, high, base_amount):
+    sqrt_low, sqrt_high = _ordered_sqrt(np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64))
+    return np.asarray(base_amount, dtype=np.float64) * sqrt_low * sqrt_high / (sqrt_high - sqrt_low)
+
+
+def get_base_amount_for_liquidity(low, high, liquidity):
+    sqrt_low, sqrt_high = _ordered_sqrt(np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64))
+    return np.asarray(liquidity, dtype=np.float64) * (sqrt_high - sqrt_low) / sqrt_high / sqrt_low
+
+
+def get_quote_amount_for_liquidity(low, high, liquidity):
+    sqrt_low, sqrt_high = _ordered_sqrt(np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64))
+    return np.asarray(liquidity, dtype=np.float64) * (sqrt_high - sqrt_low)
+
+
+def get_amounts_for_liquidity(price, low, high, liquidity, base_token_decimal=6, quote_token_decimal=18):
+    """
+    utils.get_amounts_for_liquidity 的向量版本，返回 (base_amount, quote_amount) 两个数组。
+    价格先夹到 [low, high]：低于区间时全是 base，高于区间时全是 quote，三种情况一次算完。
+    """
+    price = np.asarray(price, dtype=np.float64)
+    low = np.asarray(low, dtype=np.float64)
+    high = np.asarray(high, dtype=np.float64)
+    liquidity = np.asarray(liquidity, dtype=np.float64)
+    delta_decimal = 10.0 ** (quote_token_decimal - base_token_decimal)
+    sqrt_low, sqrt_high = _ordered_sqrt(low, high)
+    sqrt_price = np.clip(np.sqrt(price), sqrt_low, sqrt_high)
+    base_amount = liquidity * (sqrt_high - sqrt_price) / (sqrt_high * sqrt_price) / delta_decimal
+    quote_amount = liquidity * (sqrt_price - sqrt_low) / delta_decimal
+    return base_amount, quote_amount
+
+
+def compute_base_amount_from_quote_amount(quote_amount, price, low, high):
+    """
+    utils.compute_base_amount_from_quote_amount 的向量版本。
+    价格低于区间返回 0；标量版本在价格高于区间时抛异常，这里对应位置返回 nan。
+    """
+    quote_amount = np.asarray(quote_amount, dtype=np.float64)
+    price = np.asarray(price, dtype=np.float64)
+    low = np.asarray(low, dtype=np.float64)
+    high = np.asarray(high, dtype=np.float64)
+    sqrt_price = np.sqrt(price)
+    sqrt_low = np.sqrt(low)
+    sqrt_high = np.sqrt(high)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        liquidity = quote_amount * sqrt_price * sqrt_high / np.abs(sqrt_high - sqrt_price)
+        base_amount = liquidity * np.abs(sqrt_price - sqrt_low)
+    base_amount = np.where(price < low, 0.0, base_amount)
+    return np.where(price > high, np.nan, base_amount)